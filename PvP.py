@@ -1,13 +1,21 @@
+import argparse
 import pygame
+import numpy as np
 import math
 import random
+import select
 import socket
 import threading
-import json
 import time
 import os
+import matchmaking
+import net
+import replay
+import rollback
+from collections import OrderedDict
 
-pygame.init()
+# pygame is initialised by PvPGame, so importing this module for headless use
+# (balance sweeps, replays, servers) never touches the display or loads assets
 
 # Get the directory where this script is located
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -17,6 +25,46 @@ SCREEN_WIDTH = 1280
 SCREEN_HEIGHT = 720
 FPS = 60
 
+# Images are loaded in small batches while the loading screen is up
+LOAD_BUDGET = 0.008  # Seconds of loading per frame
+
+# Replays - with recording on (python3 PvP.py --record), every match played is saved here
+RECORD_REPLAYS = False
+REPLAY_DIR = os.path.join(SCRIPT_DIR, 'replays')
+
+# Resolution the arena is drawn at, as a fraction of the screen - lower is cheaper
+# to fill on weak devices. 'auto' picks from RENDER_SCALES by measured render time.
+RENDER_SCALE = 1.0
+RENDER_SCALES = (1.0, 0.75, 0.5)
+AUTO_SCALE_DOWN = 0.6  # Fraction of the frame budget spent rendering before dropping a step
+AUTO_SCALE_UP = 0.25  # ...and below which the next step up is tried again
+
+# Only redraw and present the parts of the screen that changed (see PvPGame.render_dirty)
+DIRTY_RECT_RENDERING = False
+DIRTY_RECT_LIMIT = 256  # More changed areas than this and one full-screen update is cheaper
+
+# Online play - the client picks the transport when it connects. 'udp' falls back
+# to TCP when the host doesn't answer over UDP. The host picks the netcode: snapshots
+# from the host's match, or rollback (both run the match and only swap inputs).
+NET_PORT = 5555
+NET_TRANSPORT = 'udp'
+NET_ROLLBACK = False
+
+# Quick match - the matchmaking service (matchmaking.py) pairs players and picks one
+# to host. There is no public matchmaker: by default the game looks for one running
+# on this computer, so set MATCHMAKER_HOST (or pass --matchmaker) to the machine that
+# runs it. With None an in-process stand-in is used instead, which only finds
+# opponents among games running in the same process.
+MATCHMAKER_HOST = 'localhost'
+MATCHMAKER_PORT = matchmaking.MATCHMAKER_PORT
+MATCHMAKER_REGION = 'any'  # Only players asking for the same region are paired
+MATCH_CONNECT_TIMEOUT = 15.0  # Seconds to wait for the other player to connect before giving up on them
+
+# Fixed simulation rate - speeds and cooldowns are per tick, independent of render rate
+SIM_HZ = 60
+SIM_DT = 1.0 / SIM_HZ
+MAX_CATCHUP_STEPS = 5  # Most ticks run in one frame before the game slows down instead
+
 # Colors
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
@@ -38,16 +86,7 @@ WEAPONS = {
     'gun': {'name': 'Gun', 'damage': 35, 'range': 600, 'cooldown': 18, 'color': (50, 50, 50), 'projectile': True, 'image': 'PvP images/PvP gun.png'}
 }
 
-# Load weapon images
-WEAPON_IMAGES = {}
-for weapon_key, weapon_data in WEAPONS.items():
-    try:
-        image_path = os.path.join(SCRIPT_DIR, weapon_data['image'])
-        img = pygame.image.load(image_path)
-        WEAPON_IMAGES[weapon_key] = pygame.transform.scale(img, (35, 35))
-    except Exception as e:
-        print(f"Could not load weapon image: {weapon_data['image']} - {e}")
-        WEAPON_IMAGES[weapon_key] = None
+WEAPON_IMAGE_SIZE = (35, 35)  # Weapon images are loaded through SpriteCache
 
 # Armor
 ARMOR_TYPES = {
@@ -56,20 +95,47 @@ ARMOR_TYPES = {
     'heavy': {'name': 'Heavy Armor', 'defense': 0.4, 'speed_mult': 0.7, 'color': (80, 80, 80)}
 }
 
+# Keyboard controls
+P1_CONTROLS = {'left': pygame.K_a, 'right': pygame.K_d, 'up': pygame.K_w,
+               'down': pygame.K_s, 'attack': pygame.K_SPACE}
+P2_CONTROLS = {'left': pygame.K_LEFT, 'right': pygame.K_RIGHT, 'up': pygame.K_UP,
+               'down': pygame.K_DOWN, 'attack': pygame.K_RETURN}
+
+# Per-tick player input is (buttons, aim): a bitfield of the flags below, plus an
+# (x, y) target when INPUT_FIRE is set. The simulation only ever sees these, so a
+# match can be replayed or driven headlessly from recorded inputs.
+INPUT_LEFT = 0x01
+INPUT_RIGHT = 0x02
+INPUT_UP = 0x04
+INPUT_DOWN = 0x08
+INPUT_FIRE = 0x10  # Ranged attack towards aim
+INPUT_MELEE = 0x20
+
+# Nothing held - AI players and headless matches
+NO_INPUT = (0, None)
+
+PROJECTILE_RADIUS = 10
+PROJECTILE_SPEED = 15
+PROJECTILE_LIFETIME = 100  # Ticks
+
 class Projectile:
+    """A shot fired by Player.attack - Match copies its values into the ProjectileStore,
+    which is where projectiles actually live, and drops it"""
+    __slots__ = ('x', 'y', 'damage', 'color', 'radius', 'owner', 'vx', 'vy', 'lifetime')
+
     def __init__(self, x, y, target_x, target_y, damage, color, owner=None):
         self.x = x
         self.y = y
         self.damage = damage
         self.color = color
-        self.radius = 10
+        self.radius = PROJECTILE_RADIUS
         self.owner = owner  # Track who fired this projectile
 
         dx = target_x - x
         dy = target_y - y
         dist = math.sqrt(dx**2 + dy**2)
 
-        speed = 15
+        speed = PROJECTILE_SPEED
         if dist > 0:
             self.vx = (dx / dist) * speed
             self.vy = (dy / dist) * speed
@@ -77,185 +143,683 @@ class Projectile:
             self.vx = 0
             self.vy = 0
 
-        self.alive = True
-        self.lifetime = 100
+        self.lifetime = PROJECTILE_LIFETIME
+
+class ProjectileStore:
+    """All live projectiles of a match as parallel NumPy arrays (structure of arrays).
+
+    Movement, lifetime and bounds culling are vectorized over every projectile at
+    once, and dead projectiles are removed by swapping live ones from the tail into
+    their slots, so nothing is copied or reallocated per tick. Owner is the index
+    of the player who fired (0 or 1). Ids are unique within a match, so a shot can
+    be followed across ticks (online snapshots).
+    """
+    FIELDS = ('x', 'y', 'prev_x', 'prev_y', 'vx', 'vy', 'lifetime', 'damage', 'owner', 'color', 'id')
+
+    # Pre-rendered projectile sprites by color and scale - blitting beats two draw.circle calls each
+    sprites = {}
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.capacity = capacity
+        self.indexed = False  # Whether the grid holds the current positions
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.prev_x = np.zeros(capacity)  # Position at the previous tick, for interpolated drawing
+        self.prev_y = np.zeros(capacity)
+        self.vx = np.zeros(capacity)
+        self.vy = np.zeros(capacity)
+        self.lifetime = np.zeros(capacity, dtype=np.int32)
+        self.damage = np.zeros(capacity, dtype=np.int32)
+        self.owner = np.zeros(capacity, dtype=np.int8)
+        self.color = np.zeros((capacity, 3), dtype=np.uint8)
+        self.id = np.zeros(capacity, dtype=np.int64)
+        self.next_id = 0
+
+    def __len__(self):
+        return self.count
+
+    def grow(self):
+        # Double capacity, keeping the live entries
+        self.capacity *= 2
+        for name in self.FIELDS:
+            old = getattr(self, name)
+            new = np.zeros((self.capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def spawn(self, x, y, vx, vy, damage, color, owner, lifetime=PROJECTILE_LIFETIME, shot_id=None):
+        if self.count == self.capacity:
+            self.grow()
+        if shot_id is None:
+            shot_id = self.next_id
+            self.next_id += 1
+        i = self.count
+        self.x[i] = self.prev_x[i] = x
+        self.y[i] = self.prev_y[i] = y
+        self.vx[i] = vx
+        self.vy[i] = vy
+        self.lifetime[i] = lifetime
+        self.damage[i] = damage
+        self.owner[i] = owner
+        self.color[i] = color
+        self.id[i] = shot_id
+        self.count += 1
+
+    def add(self, proj, owner):
+        """Copy a Projectile fired by Player.attack into the store"""
+        self.spawn(proj.x, proj.y, proj.vx, proj.vy, proj.damage, proj.color, owner, proj.lifetime)
+
+    def clear(self):
+        self.count = 0
+
+    def save_state(self):
+        """Copies of the live entries - for rollback"""
+        n = self.count
+        return (n, self.next_id) + tuple(getattr(self, name)[:n].copy() for name in self.FIELDS)
+
+    def load_state(self, state):
+        n, self.next_id = state[:2]
+        while self.capacity < n:
+            self.grow()
+        for name, values in zip(self.FIELDS, state[2:]):
+            getattr(self, name)[:n] = values
+        self.count = n
+
+    def remove(self, dead):
+        """Swap-remove the projectiles flagged in the boolean mask dead (length count)"""
+        n = self.count
+        new_count = n - int(np.count_nonzero(dead))
+        # Dead slots below the new end are filled by live projectiles above it
+        holes = np.flatnonzero(dead[:new_count])
+        fillers = np.flatnonzero(~dead[new_count:n]) + new_count
+        if len(holes):
+            for name in self.FIELDS:
+                arr = getattr(self, name)
+                arr[holes] = arr[fillers]
+        self.count = new_count
 
     def update(self):
-        self.x += self.vx
-        self.y += self.vy
-        self.lifetime -= 1
+        n = self.count
+        if n == 0:
+            return
+        x = self.x[:n]
+        y = self.y[:n]
+        self.prev_x[:n] = x
+        self.prev_y[:n] = y
+        x += self.vx[:n]
+        y += self.vy[:n]
+        self.lifetime[:n] -= 1
+
+        dead = (self.lifetime[:n] <= 0) | (x < 0) | (x > SCREEN_WIDTH) | (y < 0) | (y > SCREEN_HEIGHT)
+        if dead.any():
+            self.remove(dead)
+
+    def index(self, grid):
+        """Bucket current positions in the grid - call after update, before hits"""
+        self.indexed = self.count >= GRID_MIN_PROJECTILES
+        if self.indexed:
+            grid.index_points(self.x[:self.count], self.y[:self.count])
+
+    def hits(self, player, player_index, grid):
+        """Indices of projectiles touching player (circle vs box), ignoring its own shots"""
+        r = PROJECTILE_RADIUS
+        n = self.count
+        if n < HITS_MIN_VECTORIZED:
+            # A handful - a plain loop beats NumPy's per-call overhead (same arithmetic)
+            left = player.x
+            top = player.y
+            right = left + player.width
+            bottom = top + player.height
+            hits = []
+            for i, (x, y, owner) in enumerate(zip(self.x[:n].tolist(), self.y[:n].tolist(),
+                                                  self.owner[:n].tolist())):
+                if owner != player_index:
+                    dx = x - min(max(x, left), right)
+                    dy = y - min(max(y, top), bottom)
+                    if dx * dx + dy * dy <= r * r:
+                        hits.append(i)
+            return hits
+        if self.indexed:
+            nearby = grid.points_in(player.x - r, player.y - r, player.width + 2 * r, player.height + 2 * r)
+        else:
+            nearby = np.arange(self.count)
+        x = self.x[nearby]
+        y = self.y[nearby]
+        # Closest point on the player's box to each projectile center
+        cx = np.minimum(np.maximum(x, player.x), player.x + player.width)
+        cy = np.minimum(np.maximum(y, player.y), player.y + player.height)
+        touching = (x - cx) ** 2 + (y - cy) ** 2 <= r ** 2
+        return nearby[touching & (self.owner[nearby] != player_index)]
 
-        if self.lifetime <= 0 or self.x < 0 or self.x > SCREEN_WIDTH or self.y < 0 or self.y > SCREEN_HEIGHT:
-            self.alive = False
+    @classmethod
+    def sprite(cls, color, scale=1.0):
+        sprite = cls.sprites.get((color, scale))
+        if sprite is None:
+            radius = round(PROJECTILE_RADIUS * scale)
+            ring = round(3 * scale)
+            size = (radius + ring) * 2 + 1
+            center = (size // 2, size // 2)
+            sprite = pygame.Surface((size, size), pygame.SRCALPHA)
+            pygame.draw.circle(sprite, color, center, radius)
+            pygame.draw.circle(sprite, WHITE, center, radius + ring, max(1, round(2 * scale)))
+            cls.sprites[(color, scale)] = sprite
+        return sprite
+
+    def draw(self, screen, alpha=1.0, rects=None, scale=1.0):
+        """Blit every projectile - the areas drawn are appended to rects if given"""
+        n = self.count
+        if n == 0:
+            return
+        # Blend between the last two ticks, then offset to the sprite's corner
+        offset = round(PROJECTILE_RADIUS * scale) + round(3 * scale)
+        xs = ((self.prev_x[:n] + (self.x[:n] - self.prev_x[:n]) * alpha) * scale).astype(np.int32) - offset
+        ys = ((self.prev_y[:n] + (self.y[:n] - self.prev_y[:n]) * alpha) * scale).astype(np.int32) - offset
+        colors = [tuple(c) for c in self.color[:n].tolist()]
+        drawn = screen.blits([(self.sprite(c, scale), (x, y)) for c, x, y in zip(colors, xs.tolist(), ys.tolist())],
+                             doreturn=rects is not None)
+        if rects is not None:
+            rects.extend(drawn)
+
+# Sine/cosine lookup tables for effects - TRIG_STEPS entries over a full turn
+TRIG_STEPS = 1024
+TRIG_MASK = TRIG_STEPS - 1
+TRIG_SCALE = TRIG_STEPS / (2 * math.pi)  # Radians -> table index
+SIN_TABLE = np.sin(np.arange(TRIG_STEPS) * (2 * math.pi / TRIG_STEPS))
+COS_TABLE = np.cos(np.arange(TRIG_STEPS) * (2 * math.pi / TRIG_STEPS))
+SIN_LIST = SIN_TABLE.tolist()  # Single lookups are faster from a list
+
+PARTICLE_BUDGET = 256  # Most particles alive (and drawn) at once - spawns past it are dropped
+TRAIL_BUDGET = 192  # Trails stop at this many live particles, keeping room for hit sparks
+PARTICLE_DRAG = 0.9  # Velocity kept per tick
+
+class ParticleSystem:
+    """Pooled particles for hit sparks and projectile trails, plus the gem sparkles.
+
+    Particles live in preallocated NumPy arrays sized to the budget, so spawning
+    never allocates and effects can't grow past PARTICLE_BUDGET however busy the
+    match gets. They are updated in one vectorized pass per tick and drawn with a
+    single blits call from cached sprites. Effects are purely visual and use their
+    own random generator, so they never change how a seeded match plays out.
+    """
+    FIELDS = ('pos', 'vel', 'life', 'lifetime', 'radius', 'color')
+
+    # Pre-rendered dots by (color, radius)
+    sprites = {}
+
+    def __init__(self, budget=PARTICLE_BUDGET):
+        self.count = 0
+        self.budget = budget
+        self.pos = np.zeros((budget, 2))
+        self.vel = np.zeros((budget, 2))
+        self.life = np.zeros(budget, dtype=np.int32)  # Ticks left
+        self.lifetime = np.ones(budget, dtype=np.int32)  # Ticks at spawn
+        self.radius = np.zeros(budget)
+        self.color = np.zeros((budget, 3), dtype=np.uint8)
+        self.rng = np.random.default_rng()
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count = 0
+
+    def emit(self, xs, ys, vxs, vys, lifetime, radius, color, limit=None):
+        """Spawn particles from arrays of positions - velocities, lifetime, radius and
+        color may be arrays or one value for all. Returns how many fit the budget
+        (or limit, if that is lower)."""
+        n = self.count
+        k = min(min(limit or self.budget, self.budget) - n, len(xs))
+        if k <= 0:
+            return 0
+        new = slice(n, n + k)
+        for arr, value in ((self.pos[new, 0], xs), (self.pos[new, 1], ys), (self.vel[new, 0], vxs),
+                           (self.vel[new, 1], vys), (self.life[new], lifetime),
+                           (self.lifetime[new], lifetime), (self.radius[new], radius), (self.color[new], color)):
+            arr[...] = value[:k] if isinstance(value, np.ndarray) else value
+        self.count = n + k
+        return k
+
+    def burst(self, x, y, count, speed, lifetime, radius, color):
+        """Spray count particles out from (x, y) in random directions"""
+        angles = self.rng.integers(0, TRIG_STEPS, count)
+        speeds = self.rng.uniform(speed * 0.3, speed, count)
+        lifetimes = self.rng.integers(lifetime // 2, lifetime + 1, count)
+        self.emit(np.full(count, float(x)), np.full(count, float(y)),
+                  COS_TABLE[angles] * speeds, SIN_TABLE[angles] * speeds, lifetimes, radius, color)
 
-    def draw(self, screen):
-        pygame.draw.circle(screen, self.color, (int(self.x), int(self.y)), self.radius)
-        pygame.draw.circle(screen, WHITE, (int(self.x), int(self.y)), self.radius + 3, 2)
+    def update(self):
+        n = self.count
+        if n == 0:
+            return
+        self.pos[:n] += self.vel[:n]
+        self.vel[:n] *= PARTICLE_DRAG
+        self.life[:n] -= 1
+
+        # Compact survivors to the front, oldest first so draw order is stable
+        alive = self.life[:n] > 0
+        if not alive.all():
+            keep = np.flatnonzero(alive)
+            for name in self.FIELDS:
+                arr = getattr(self, name)
+                arr[:len(keep)] = arr[keep]
+            self.count = len(keep)
 
-class HealingGem:
-    # Load gem images once for all instances
-    gem_images = []
-    images_loaded = False
+    @classmethod
+    def sprite(cls, color, radius):
+        sprite = cls.sprites.get((color, radius))
+        if sprite is None:
+            sprite = pygame.Surface((radius * 2 + 1, radius * 2 + 1), pygame.SRCALPHA)
+            pygame.draw.circle(sprite, color, (radius, radius), radius)
+            cls.sprites[(color, radius)] = sprite
+        return sprite
+
+    def draw(self, screen, scale=1.0, rects=None):
+        """Blit every particle, shrinking as it fades - the areas drawn are appended to rects if given"""
+        n = self.count
+        if n == 0:
+            return
+        radii = np.maximum(np.ceil(self.radius[:n] * scale * self.life[:n] / self.lifetime[:n]), 1).astype(np.int32)
+        xs = (self.pos[:n, 0] * scale).astype(np.int32) - radii
+        ys = (self.pos[:n, 1] * scale).astype(np.int32) - radii
+        colors = [tuple(c) for c in self.color[:n].tolist()]
+        drawn = screen.blits([(self.sprite(c, r), (x, y))
+                              for c, r, x, y in zip(colors, radii.tolist(), xs.tolist(), ys.tolist())],
+                             doreturn=rects is not None)
+        if rects is not None:
+            rects.extend(drawn)
+
+    def draw_sparkles(self, screen, caves, scale=1.0):
+        """The four dots circling every uncollected gem, positioned from the trig
+        tables for all gems at once and drawn in one batch"""
+        gems = [gem for cave in caves for gem in cave.available_gems]
+        if not gems:
+            return
+        gem_size = scale_size(GEM_SIZE, scale)
+        has_image = np.array([SpriteCache.get(GEM_IMAGE_PATHS[gem.image_index], gem_size) is not None
+                              for gem in gems])
+        gx = np.array([gem.x for gem in gems], dtype=float)
+        gy = np.array([gem.y for gem in gems], dtype=float)
+        pulse = (np.array([gem.pulse for gem in gems]) * TRIG_SCALE + 0.5).astype(np.int64)
+
+        # Gem images bob with the pulse and have a wider ring than the fallback circle
+        bob = np.where(has_image, (SIN_TABLE[pulse & TRIG_MASK] * 3).astype(np.int64), 0)
+        reach = np.where(has_image, 25, 20)[:, None]
+        angles = (pulse[:, None] + np.arange(4) * (TRIG_STEPS // 4)) & TRIG_MASK
+        xs = ((gx[:, None] + COS_TABLE[angles] * reach) * scale).astype(np.int32)
+        ys = ((gy[:, None] + SIN_TABLE[angles] * reach + bob[:, None]) * scale).astype(np.int32)
+
+        radius = max(1, round(3 * scale))
+        sprite = self.sprite(YELLOW, radius)
+        screen.blits([(sprite, (x - radius, y - radius)) for x, y in zip(xs.ravel().tolist(), ys.ravel().tolist())],
+                     doreturn=False)
+
+GRID_CELL_SIZE = 80  # 1280x720 arena -> 16 x 9 cells
+GRID_MIN_PROJECTILES = 32  # Fewer than this are cheaper to test directly than to bucket
+HITS_MIN_VECTORIZED = 8  # Fewer than this are hit-tested in a plain loop rather than with NumPy
+
+class SpatialGrid:
+    """Uniform grid over the arena for collision and range queries.
+
+    Entities (players, caves, gems) are filed under every cell their box overlaps
+    and only re-filed when they cross a cell boundary. Projectiles live in NumPy
+    arrays, so they are bucketed as a batch of points each tick instead.
+    Queries are a broad phase - callers still do the exact overlap test.
+    """
+    def __init__(self, cell_size=GRID_CELL_SIZE, width=SCREEN_WIDTH, height=SCREEN_HEIGHT):
+        self.cell_size = cell_size
+        self.cols = -(-width // cell_size)
+        self.rows = -(-height // cell_size)
+        self.cells = [[] for _ in range(self.cols * self.rows)]
+        self.spans = {}  # entity -> (col0, row0, col1, row1) of the cells it is filed under
+
+        # Point batch, sorted by cell so a cell range is one searchsorted away
+        self.point_order = np.zeros(0, dtype=np.intp)
+        self.point_cells = np.zeros(0, dtype=np.int64)
+
+    def span(self, left, top, width, height):
+        cs = self.cell_size
+        col0 = min(max(int(left // cs), 0), self.cols - 1)
+        row0 = min(max(int(top // cs), 0), self.rows - 1)
+        col1 = min(max(int((left + width) // cs), 0), self.cols - 1)
+        row1 = min(max(int((top + height) // cs), 0), self.rows - 1)
+        return (col0, row0, col1, row1)
+
+    def cells_in(self, span):
+        col0, row0, col1, row1 = span
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                yield row * self.cols + col
+
+    def insert(self, entity, left, top, width, height):
+        span = self.span(left, top, width, height)
+        self.spans[entity] = span
+        for cell in self.cells_in(span):
+            self.cells[cell].append(entity)
+
+    def remove(self, entity):
+        span = self.spans.pop(entity, None)
+        if span is not None:
+            for cell in self.cells_in(span):
+                self.cells[cell].remove(entity)
+
+    def move(self, entity, left, top, width, height):
+        """Update an entity's box - only touches cells when it crosses a cell boundary"""
+        span = self.span(left, top, width, height)
+        if span != self.spans.get(entity):
+            self.remove(entity)
+            self.insert(entity, left, top, width, height)
+
+    def query(self, left, top, width, height, kind=None):
+        """Entities filed in cells overlapping the box, optionally only instances of kind"""
+        found = {}  # Keeps first-seen order so results are deterministic
+        for cell in self.cells_in(self.span(left, top, width, height)):
+            for entity in self.cells[cell]:
+                if kind is None or isinstance(entity, kind):
+                    found[entity] = True
+        return list(found)
+
+    def nearest(self, x, y, kind):
+        """Closest entity of kind to (x, y), measured to entity.x/entity.y, or None.
+
+        Searches rings of cells outwards and stops once no unvisited cell
+        can hold anything closer.
+        """
+        cs = self.cell_size
+        col = min(max(int(x // cs), 0), self.cols - 1)
+        row = min(max(int(y // cs), 0), self.rows - 1)
+        best = None
+        best_dist = float('inf')
+        for ring in range(max(self.cols, self.rows)):
+            if best is not None and best_dist <= (ring - 1) * cs:
+                break
+            for r in range(row - ring, row + ring + 1):
+                if r < 0 or r >= self.rows:
+                    continue
+                # Full rows at the top and bottom of the ring, just the two ends otherwise
+                step = 1 if abs(r - row) == ring else max(2 * ring, 1)
+                for c in range(col - ring, col + ring + 1, step):
+                    if c < 0 or c >= self.cols:
+                        continue
+                    for entity in self.cells[r * self.cols + c]:
+                        if isinstance(entity, kind):
+                            dist = math.sqrt((x - entity.x)**2 + (y - entity.y)**2)
+                            if dist < best_dist:
+                                best_dist = dist
+                                best = entity
+        return best
+
+    def index_points(self, xs, ys):
+        """Bucket a batch of points (projectile positions) by cell for points_in"""
+        # Points are already culled to the arena, so only the far edges need clamping
+        cs = self.cell_size
+        cols = np.minimum((xs // cs).astype(np.int64), self.cols - 1)
+        rows = np.minimum((ys // cs).astype(np.int64), self.rows - 1)
+        cells = rows * self.cols + cols
+        self.point_order = np.argsort(cells, kind='stable')
+        self.point_cells = cells[self.point_order]
+
+    def points_in(self, left, top, width, height):
+        """Indices of indexed points (from index_points) in cells overlapping the box"""
+        col0, row0, col1, row1 = self.span(left, top, width, height)
+        chunks = []
+        for row in range(row0, row1 + 1):
+            lo = np.searchsorted(self.point_cells, row * self.cols + col0, 'left')
+            hi = np.searchsorted(self.point_cells, row * self.cols + col1, 'right')
+            if hi > lo:
+                chunks.append(self.point_order[lo:hi])
+        if not chunks:
+            return self.point_order[:0]
+        return np.concatenate(chunks)
+
+class TextCache:
+    """Shared fonts and an LRU cache of rendered text.
+
+    Building a Font and rasterising glyphs are among the slowest things a frame
+    can do (especially in the browser build), and almost every string drawn is
+    the same from one frame to the next - so each one is rendered once and blitted
+    from here afterwards.
+    """
+    fonts = {}  # Size -> default Font
+    surfaces = OrderedDict()  # (text, font, color, antialias) -> Surface, oldest first
+    max_surfaces = 256
 
     @classmethod
-    def load_images(cls):
-        if not cls.images_loaded:
-            gem_paths = [
-                'PvP images/PvP gem red.png',
-                'PvP images/PvP gem green.png',
-                'PvP images/PvP gem blue.png'
-            ]
-            for path in gem_paths:
-                try:
-                    image_path = os.path.join(SCRIPT_DIR, path)
-                    img = pygame.image.load(image_path)
-                    # Scale gem to appropriate size
-                    img = pygame.transform.scale(img, (40, 40))
-                    cls.gem_images.append(img)
-                except Exception as e:
-                    print(f"Could not load gem image: {path} - {e}")
-            cls.images_loaded = True
+    def font(cls, size):
+        font = cls.fonts.get(size)
+        if font is None:
+            font = cls.fonts[size] = pygame.font.Font(None, size)
+        return font
+
+    @classmethod
+    def render(cls, text, font, color, antialias=True):
+        key = (text, font, color, antialias)
+        surface = cls.surfaces.get(key)
+        if surface is None:
+            surface = cls.surfaces[key] = font.render(text, antialias, color)
+            if len(cls.surfaces) > cls.max_surfaces:
+                cls.surfaces.popitem(last=False)
+        else:
+            cls.surfaces.move_to_end(key)
+        return surface
+
+def scale_size(size, scale):
+    """A (width, height) at a render scale - never smaller than a pixel"""
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
 
-    def __init__(self, x, y):
+class SpriteCache:
+    """Images loaded once, scaled, converted to the display's pixel format and
+    pre-flipped, so drawing a sprite is a single blit in either facing.
+
+    Unconverted images make every blit convert pixel formats on the fly, and
+    flipping per frame allocates a new Surface - neither is cheap, least of all in
+    the browser build.
+    """
+    sprites = {}  # (path, size) -> (facing right, facing left), or None if loading failed
+
+    @classmethod
+    def load(cls, path, size):
+        key = (path, size)
+        if key not in cls.sprites:
+            try:
+                img = pygame.image.load(os.path.join(SCRIPT_DIR, path))
+                img = pygame.transform.scale(img, size)
+                # Converting needs a display - offscreen use keeps the file's format
+                if pygame.display.get_surface():
+                    img = img.convert_alpha()
+                cls.sprites[key] = (img, pygame.transform.flip(img, True, False))
+            except Exception as e:
+                print(f"Could not load image: {path} - {e}")
+                cls.sprites[key] = None
+        return cls.sprites[key]
+
+    @classmethod
+    def get(cls, path, size, facing_right=True):
+        sprite = cls.sprites.get((path, size)) or cls.load(path, size)
+        if sprite is None:
+            return None
+        return sprite[0] if facing_right else sprite[1]
+
+GEM_SIZE = (40, 40)
+GEM_IMAGE_PATHS = [
+    'PvP images/PvP gem red.png',
+    'PvP images/PvP gem green.png',
+    'PvP images/PvP gem blue.png'
+]
+
+class HealingGem:
+    __slots__ = ('x', 'y', 'radius', 'heal_amount', 'rect', 'cave', '_collected', 'pulse',
+                 'respawn_timer', 'respawn_time', 'image_index', 'rng')
+
+    def __init__(self, x, y, rng=random):
         self.x = x
         self.y = y
+        self.rng = rng  # The match's world generator, so respawns are reproducible
         self.radius = 20  # Increased for image size
         self.heal_amount = 30
-        self.collected = False
+        # Gems never move, so the collision box is built once
+        self.rect = pygame.Rect(x - self.radius, y - self.radius, self.radius * 2, self.radius * 2)
+        self.cave = None  # Set by the owning Cave, which tracks which gems are available
+        self._collected = False
         self.pulse = 0
         self.respawn_timer = 0  # Timer for respawning after collection
-        self.respawn_time = random.randint(120, 300)  # 2-5 seconds at 60 FPS
+        self.respawn_time = rng.randint(120, 300)  # 2-5 seconds at 60 FPS
 
-        # Load images if not already loaded
-        HealingGem.load_images()
+        # Randomly select a gem image - only the index is kept so the simulation
+        # never needs the images loaded (headless matches don't draw)
+        self.image_index = rng.randrange(len(GEM_IMAGE_PATHS))
 
-        # Randomly select a gem image
-        if HealingGem.gem_images:
-            self.image = random.choice(HealingGem.gem_images)
-        else:
-            self.image = None
+    @property
+    def collected(self):
+        return self._collected
+
+    @collected.setter
+    def collected(self, value):
+        # Only flips reach the cave's availability index
+        if value != self._collected:
+            self._collected = value
+            if self.cave:
+                self.cave.gem_changed(self)
 
     def update(self):
         self.pulse += 0.1
 
         # Handle respawn timer
-        if self.collected:
+        if self._collected:
             self.respawn_timer += 1
             if self.respawn_timer >= self.respawn_time:
                 # Respawn the gem
                 self.collected = False
                 self.respawn_timer = 0
-                self.respawn_time = random.randint(120, 300)  # New random respawn time
+                self.respawn_time = self.rng.randint(120, 300)  # New random respawn time
                 # Pick a new random gem image
-                if HealingGem.gem_images:
-                    self.image = random.choice(HealingGem.gem_images)
+                self.image_index = self.rng.randrange(len(GEM_IMAGE_PATHS))
 
-    def draw(self, screen):
+    def draw(self, screen, scale=1.0):
+        # The sparkles around the gem are drawn by ParticleSystem.draw_sparkles
         if not self.collected:
-            if self.image:
+            # Loaded on first draw, shared by every gem
+            image = SpriteCache.get(GEM_IMAGE_PATHS[self.image_index], scale_size(GEM_SIZE, scale))
+            pulse = SIN_LIST[int(self.pulse * TRIG_SCALE + 0.5) & TRIG_MASK]
+            if image:
                 # Draw the gem image with pulsing effect
-                pulse_offset = int(math.sin(self.pulse) * 3)
-                draw_x = int(self.x - 20)  # Center the 40x40 image
-                draw_y = int(self.y - 20 + pulse_offset)
-                screen.blit(self.image, (draw_x, draw_y))
-
-                # Add sparkle effect around the gem
-                for i in range(4):
-                    angle = i * math.pi / 2 + self.pulse
-                    sx = self.x + math.cos(angle) * 25
-                    sy = self.y + math.sin(angle) * 25 + pulse_offset
-                    pygame.draw.circle(screen, YELLOW, (int(sx), int(sy)), 3)
+                pulse_offset = int(pulse * 3)
+                draw_x = int((self.x - 20) * scale)  # Center the 40x40 image
+                draw_y = int((self.y - 20 + pulse_offset) * scale)
+                screen.blit(image, (draw_x, draw_y))
             else:
                 # Fallback to original drawing if images didn't load
-                pulse_size = int(self.radius + math.sin(self.pulse) * 5)
-                pygame.draw.circle(screen, GREEN, (int(self.x), int(self.y)), pulse_size)
-                pygame.draw.circle(screen, WHITE, (int(self.x), int(self.y)), pulse_size + 2, 2)
-                # Sparkle
-                for i in range(4):
-                    angle = i * math.pi / 2 + self.pulse
-                    sx = self.x + math.cos(angle) * 20
-                    sy = self.y + math.sin(angle) * 20
-                    pygame.draw.circle(screen, YELLOW, (int(sx), int(sy)), 3)
+                center = (int(self.x * scale), int(self.y * scale))
+                pulse_size = int((self.radius + pulse * 5) * scale)
+                pygame.draw.circle(screen, GREEN, center, pulse_size)
+                pygame.draw.circle(screen, WHITE, center, pulse_size + max(1, round(2 * scale)), max(1, round(2 * scale)))
+
+# Cave positions and sizes (x, y, width, height)
+CAVE_LAYOUT = [
+    (100, 100, 200, 150),
+    (SCREEN_WIDTH - 300, 100, 200, 150),
+    (SCREEN_WIDTH // 2 - 100, SCREEN_HEIGHT - 200, 200, 150),
+    (50, SCREEN_HEIGHT // 2 - 75, 180, 150),
+    (SCREEN_WIDTH - 230, SCREEN_HEIGHT // 2 - 75, 180, 150),
+]
 
 class Cave:
-    # Load cave image once for all instances
-    cave_image = None
-
-    @classmethod
-    def load_image(cls):
-        if cls.cave_image is None:
-            try:
-                image_path = os.path.join(SCRIPT_DIR, 'PvP images/PvP cave.png')
-                cls.cave_image = pygame.image.load(image_path)
-            except Exception as e:
-                print(f"Could not load cave image: PvP images/PvP cave.png - {e}")
+    image_path = 'PvP images/PvP cave.png'
 
-    def __init__(self, x, y, width, height):
+    def __init__(self, x, y, width, height, rng=random):
         self.x = x
         self.y = y
         self.width = width
         self.height = height
         self.color = DARK_GRAY
         self.gems = []
+        self.rect = pygame.Rect(x, y, width, height)
+        self.on_gem_change = None  # Called with a gem whenever it is collected or respawns
 
-        # Load image if not already loaded
-        Cave.load_image()
+        # Add healing gems inside
+        for i in range(rng.randint(2, 4)):
+            gx = x + rng.randint(30, width - 30)
+            gy = y + rng.randint(30, height - 30)
+            self.gems.append(HealingGem(gx, gy, rng))
+
+        # Gems that can be picked up right now, and the box around all of them
+        self.available_gems = list(self.gems)
+        self.gem_bounds = self.gems[0].rect.unionall([gem.rect for gem in self.gems[1:]])
+        for gem in self.gems:
+            gem.cave = self
 
-        # Scale cave image to size
-        if Cave.cave_image:
-            self.scaled_image = pygame.transform.scale(Cave.cave_image, (width, height))
+    def gem_changed(self, gem):
+        if gem.collected:
+            self.available_gems.remove(gem)
         else:
-            self.scaled_image = None
+            self.available_gems.append(gem)
+        if self.on_gem_change:
+            self.on_gem_change(gem)
 
-        # Add healing gems inside
-        for i in range(random.randint(2, 4)):
-            gx = x + random.randint(30, width - 30)
-            gy = y + random.randint(30, height - 30)
-            self.gems.append(HealingGem(gx, gy))
+    def draw_background(self, surface, scale=1.0):
+        """Cave art never changes during a match, so it is drawn into the cached
+        background layer once rather than every frame"""
+        # Cave art is loaded on first draw so headless matches never load it
+        image = SpriteCache.get(Cave.image_path, scale_size((self.width, self.height), scale))
+        area = (self.x * scale, self.y * scale, self.width * scale, self.height * scale)
 
-    def draw(self, screen):
         # Draw cave image or fallback to ellipse
-        if self.scaled_image:
-            screen.blit(self.scaled_image, (self.x, self.y))
+        if image:
+            surface.blit(image, area[:2])
         else:
             # Fallback to original ellipse drawing
-            pygame.draw.ellipse(screen, self.color, (self.x, self.y, self.width, self.height))
-            pygame.draw.ellipse(screen, BLACK, (self.x, self.y, self.width, self.height), 3)
+            pygame.draw.ellipse(surface, self.color, area)
+            pygame.draw.ellipse(surface, BLACK, area, max(1, round(3 * scale)))
 
             # Cave text
-            font = pygame.font.Font(None, 24)
-            text = font.render("CAVE", True, YELLOW)
-            screen.blit(text, (self.x + self.width // 2 - 25, self.y + self.height // 2 - 10))
+            text = TextCache.render("CAVE", TextCache.font(round(24 * scale)), YELLOW)
+            surface.blit(text, ((self.x + self.width // 2 - 25) * scale, (self.y + self.height // 2 - 10) * scale))
 
-        # Draw gems
+    def draw(self, screen, rects=None, scale=1.0):
+        # Only the gems - the cave itself is part of the background layer
         for gem in self.gems:
-            gem.draw(screen)
+            gem.draw(screen, scale)
+            if rects is not None and not gem.collected:
+                # Image, pulse and sparkles all stay within this box
+                rects.append(gem.rect.inflate(20, 26))
+
+PLAYER_SIZE = (50, 70)
+P1_IMAGE = 'PvP images/PvP red.png'
+P2_IMAGE = 'PvP images/PvP blue.png'
 
 class Player:
+    # Everything about a player that a tick can change - saved and restored for rollback
+    STATE_FIELDS = ('x', 'y', 'prev_x', 'prev_y', 'health', 'damage_dealt', 'speed', 'attack_cooldown',
+                    'facing_right', 'alive', 'ai_timer', 'ai_action', 'ai_target_x', 'ai_target_y',
+                    'ai_reaction_time')
+
+    __slots__ = ('x', 'y', 'prev_x', 'prev_y', 'width', 'height', 'rect', 'color', 'name',
+                 'is_ai', 'ai_difficulty', 'image_path', 'health', 'max_health', 'damage_dealt',
+                 'base_speed', 'speed', 'weapon', 'armor', 'attack_cooldown', 'facing_right',
+                 'alive', 'controls', 'ai_timer', 'ai_action', 'ai_target_x', 'ai_target_y',
+                 'ai_reaction_time', 'rng')
+
     def __init__(self, x, y, color, controls, name, is_ai=False, ai_difficulty='medium', image_path=None):
         self.x = x
         self.y = y
-        self.width = 50
-        self.height = 70
+        self.prev_x = x  # Position at the previous tick, for interpolated drawing
+        self.prev_y = y
+        self.width, self.height = PLAYER_SIZE
+        self.rect = pygame.Rect(x, y, self.width, self.height)  # Collision box, synced in collect_gems
         self.color = color
         self.name = name
         self.is_ai = is_ai
         self.ai_difficulty = ai_difficulty
 
-        # Load player image if provided
-        self.image = None
+        # Load player image if provided - cached, so rematches don't reload it
+        self.image_path = image_path
         if image_path:
-            try:
-                full_path = os.path.join(SCRIPT_DIR, image_path)
-                self.image = pygame.image.load(full_path)
-                # Scale image to player size
-                self.image = pygame.transform.scale(self.image, (self.width, self.height))
-            except Exception as e:
-                print(f"Could not load image: {image_path} - {e}")
+            SpriteCache.load(image_path, (self.width, self.height))
 
         # Stats
         self.health = 100
         self.max_health = 100
+        self.damage_dealt = 0  # Damage this player has done after armor
         self.base_speed = 6
         self.speed = self.base_speed
 
@@ -275,8 +839,9 @@ class Player:
         self.ai_target_x = x
         self.ai_target_y = y
         self.ai_reaction_time = 0  # Delay for AI attacks
+        self.rng = random  # Replaced by a per-match generator when added to a Match
 
-    def update(self, keys, caves, opponent=None):
+    def update(self, buttons, grid, opponent=None):
         if not self.alive:
             return
 
@@ -286,19 +851,31 @@ class Player:
 
         # AI behavior
         if self.is_ai and opponent:
-            self.ai_update(opponent, caves)
+            self.ai_update(opponent, grid)
             return
 
+        self.move(buttons)
+
+        # Check caves for healing gems
+        self.collect_gems(grid)
+
+        # Death check
+        if self.health <= 0:
+            self.alive = False
+
+    def move(self, buttons):
+        """Movement, boundaries and cooldown for one tick - everything an online
+        client needs to predict its own player"""
         # Movement
-        if keys[self.controls['left']]:
+        if buttons & INPUT_LEFT:
             self.x -= self.speed
             self.facing_right = False
-        if keys[self.controls['right']]:
+        if buttons & INPUT_RIGHT:
             self.x += self.speed
             self.facing_right = True
-        if keys[self.controls['up']]:
+        if buttons & INPUT_UP:
             self.y -= self.speed
-        if keys[self.controls['down']]:
+        if buttons & INPUT_DOWN:
             self.y += self.speed
 
         # Boundaries
@@ -309,24 +886,23 @@ class Player:
         if self.attack_cooldown > 0:
             self.attack_cooldown -= 1
 
-        # Check cave for healing gems
-        player_rect = pygame.Rect(self.x, self.y, self.width, self.height)
-        for cave in caves:
-            cave_rect = pygame.Rect(cave.x, cave.y, cave.width, cave.height)
-            if player_rect.colliderect(cave_rect):
-                for gem in cave.gems:
-                    if not gem.collected:
-                        gem_rect = pygame.Rect(gem.x - gem.radius, gem.y - gem.radius,
-                                             gem.radius * 2, gem.radius * 2)
-                        if player_rect.colliderect(gem_rect):
-                            gem.collected = True
-                            self.health = min(self.max_health, self.health + gem.heal_amount)
-
-        # Death check
-        if self.health <= 0:
-            self.alive = False
-
-    def ai_update(self, opponent, caves):
+    def collect_gems(self, grid):
+        """Pick up any healing gem we're touching"""
+        # Reuse one Rect rather than allocating a new one every tick
+        # (int() truncates like the Rect constructor - attribute assignment would round)
+        self.rect.x = int(self.x)
+        self.rect.y = int(self.y)
+        for cave in grid.query(self.x, self.y, self.width, self.height, Cave):
+            if not cave.available_gems or not self.rect.colliderect(cave.gem_bounds):
+                continue
+            # Backwards, since collecting removes the gem from the list
+            for i in range(len(cave.available_gems) - 1, -1, -1):
+                gem = cave.available_gems[i]
+                if self.rect.colliderect(gem.rect):
+                    gem.collected = True
+                    self.health = min(self.max_health, self.health + gem.heal_amount)
+
+    def ai_update(self, opponent, grid):
         """AI behavior - attacks and seeks healing"""
         self.ai_timer += 1
 
@@ -348,16 +924,8 @@ class Player:
         if self.ai_timer % decision_delay == 0:
             # Check if need healing (based on difficulty threshold)
             if self.health < health_threshold:
-                # Find nearest cave with gems
-                nearest_cave = None
-                min_dist = float('inf')
-                for cave in caves:
-                    for gem in cave.gems:
-                        if not gem.collected:
-                            dist = math.sqrt((self.x - gem.x)**2 + (self.y - gem.y)**2)
-                            if dist < min_dist:
-                                min_dist = dist
-                                nearest_cave = gem
+                # Find nearest uncollected gem
+                nearest_cave = grid.nearest(self.x, self.y, HealingGem)
 
                 if nearest_cave:
                     self.ai_action = 'heal'
@@ -395,10 +963,10 @@ class Player:
             optimal_range = weapon['range'] * 0.8
 
             # Apply accuracy - sometimes make mistakes on easy/medium
-            if random.random() > accuracy:
+            if self.rng.random() > accuracy:
                 # Make a mistake - move in random direction
-                dx = random.choice([-1, 1]) * 50
-                dy = random.choice([-1, 1]) * 50
+                dx = self.rng.choice([-1, 1]) * 50
+                dy = self.rng.choice([-1, 1]) * 50
 
             # Slower movement on easy
             move_speed = self.speed * (0.7 if self.ai_difficulty == 'easy' else 1.0)
@@ -428,18 +996,8 @@ class Player:
         if self.attack_cooldown > 0:
             self.attack_cooldown -= 1
 
-        # Check cave for healing gems
-        player_rect = pygame.Rect(self.x, self.y, self.width, self.height)
-        for cave in caves:
-            cave_rect = pygame.Rect(cave.x, cave.y, cave.width, cave.height)
-            if player_rect.colliderect(cave_rect):
-                for gem in cave.gems:
-                    if not gem.collected:
-                        gem_rect = pygame.Rect(gem.x - gem.radius, gem.y - gem.radius,
-                                             gem.radius * 2, gem.radius * 2)
-                        if player_rect.colliderect(gem_rect):
-                            gem.collected = True
-                            self.health = min(self.max_health, self.health + gem.heal_amount)
+        # Check caves for healing gems
+        self.collect_gems(grid)
 
         # Death check for AI
         if self.health <= 0:
@@ -475,111 +1033,470 @@ class Player:
         armor = ARMOR_TYPES[self.armor]
         actual_damage = int(damage * armor['defense'])
         self.health -= actual_damage
+        return actual_damage
+
+    def bounds(self, alpha=1.0):
+        """Screen area draw() can touch - weapon, bars and name included"""
+        x = int(self.prev_x + (self.x - self.prev_x) * alpha)
+        y = int(self.prev_y + (self.y - self.prev_y) * alpha)
+        name_width = TextCache.render(self.name, TextCache.font(22), WHITE).get_width()
+        right = max(self.width + 31, name_width) + 2
+        return pygame.Rect(x - 36, y - 46, right + 36, self.height + 47)
+
+    def draw(self, screen, alpha=1.0, scale=1.0):
+        # Blend between the last two ticks, then map onto the render target
+        x = (self.prev_x + (self.x - self.prev_x) * alpha) * scale
+        y = (self.prev_y + (self.y - self.prev_y) * alpha) * scale
+        width = self.width * scale
+        height = self.height * scale
+        s = scale
 
-    def draw(self, screen):
         if not self.alive:
-            pygame.draw.rect(screen, GRAY, (self.x, self.y + 50, self.width, 20))
-            font = pygame.font.Font(None, 24)
-            text = font.render("DEAD", True, RED)
-            screen.blit(text, (self.x, self.y + 25))
+            pygame.draw.rect(screen, GRAY, (x, y + 50 * s, width, 20 * s))
+            text = TextCache.render("DEAD", TextCache.font(round(24 * s)), RED)
+            screen.blit(text, (x, y + 25 * s))
             return
 
-        # Draw player image or fallback to rectangle
-        if self.image:
-            # Flip image if facing left
-            image_to_draw = self.image if self.facing_right else pygame.transform.flip(self.image, True, False)
-            screen.blit(image_to_draw, (self.x, self.y))
+        # Draw player image (pre-flipped when facing left) or fallback to rectangle
+        image = None
+        if self.image_path:
+            image = SpriteCache.get(self.image_path, scale_size(PLAYER_SIZE, s), self.facing_right)
+        if image:
+            screen.blit(image, (x, y))
         else:
             # Fallback to original rectangle drawing
-            pygame.draw.rect(screen, self.color, (self.x, self.y, self.width, self.height))
-            pygame.draw.rect(screen, WHITE, (self.x, self.y, self.width, self.height), 3)
+            pygame.draw.rect(screen, self.color, (x, y, width, height))
+            pygame.draw.rect(screen, WHITE, (x, y, width, height), max(1, round(3 * s)))
 
             # Armor overlay
             armor = ARMOR_TYPES[self.armor]
-            pygame.draw.rect(screen, armor['color'], (self.x + 5, self.y + 5, self.width - 10, 20))
+            pygame.draw.rect(screen, armor['color'], (x + 5 * s, y + 5 * s, width - 10 * s, 20 * s))
 
             # Face
-            eye_x = self.x + (35 if self.facing_right else 15)
-            pygame.draw.circle(screen, WHITE, (eye_x, int(self.y + 20)), 5)
+            eye_x = x + (35 if self.facing_right else 15) * s
+            pygame.draw.circle(screen, WHITE, (eye_x, int(y + 20 * s)), max(1, round(5 * s)))
 
         # Weapon
         weapon = WEAPONS[self.weapon]
-        weapon_img = WEAPON_IMAGES.get(self.weapon)
+        weapon_img = SpriteCache.get(weapon['image'], scale_size(WEAPON_IMAGE_SIZE, s), self.facing_right)
 
         if weapon_img:
             # Position weapon to the side of the player
-            weapon_x = self.x + (self.width - 5) if self.facing_right else self.x - 30
-            weapon_y = self.y + 20
+            weapon_x = x + (self.width - 5) * s if self.facing_right else x - 30 * s
+            weapon_y = y + 20 * s
 
-            # Flip weapon if facing left
-            weapon_to_draw = weapon_img if self.facing_right else pygame.transform.flip(weapon_img, True, False)
-            screen.blit(weapon_to_draw, (weapon_x, weapon_y))
+            screen.blit(weapon_img, (weapon_x, weapon_y))
         else:
             # Fallback to rectangle
-            weapon_x = self.x + (self.width if self.facing_right else -35)
-            weapon_y = self.y + 30
+            weapon_x = x + (self.width if self.facing_right else -35) * s
+            weapon_y = y + 30 * s
             if weapon.get('projectile', False):
-                pygame.draw.rect(screen, weapon['color'], (weapon_x, weapon_y, 30, 8))
+                pygame.draw.rect(screen, weapon['color'], (weapon_x, weapon_y, 30 * s, 8 * s))
             else:
-                pygame.draw.rect(screen, weapon['color'], (weapon_x, weapon_y, 28, 10))
+                pygame.draw.rect(screen, weapon['color'], (weapon_x, weapon_y, 28 * s, 10 * s))
 
         # Health bar
         health_percent = self.health / self.max_health
-        pygame.draw.rect(screen, BLACK, (self.x - 5, self.y - 25, self.width + 10, 12))
-        pygame.draw.rect(screen, GREEN, (self.x, self.y - 23, int(self.width * health_percent), 8))
+        pygame.draw.rect(screen, BLACK, (x - 5 * s, y - 25 * s, width + 10 * s, 12 * s))
+        pygame.draw.rect(screen, GREEN, (x, y - 23 * s, int(width * health_percent), 8 * s))
 
         # Cooldown bar
         if self.attack_cooldown > 0:
             cooldown_percent = self.attack_cooldown / WEAPONS[self.weapon]['cooldown']
-            pygame.draw.rect(screen, YELLOW, (self.x, self.y - 15, int(self.width * (1 - cooldown_percent)), 4))
+            pygame.draw.rect(screen, YELLOW, (x, y - 15 * s, int(width * (1 - cooldown_percent)), 4 * s))
 
         # Name
-        font = pygame.font.Font(None, 22)
-        name_text = font.render(self.name, True, WHITE)
-        screen.blit(name_text, (self.x, self.y - 45))
+        name_text = TextCache.render(self.name, TextCache.font(round(22 * s)), WHITE)
+        screen.blit(name_text, (x, y - 45 * s))
+
+class Match:
+    """Simulation state for one match - players, projectiles and caves.
+
+    Nothing here needs a display, Surface or clock, so matches can be stepped
+    headlessly as fast as the CPU allows (balance runs, regression checks, servers).
+
+    All randomness comes from generators derived from seed, so the same seed and
+    inputs always play out the same match. World generation and each AI get their
+    own stream, so a change to one doesn't shift the others.
+    """
+    def __init__(self, player1, player2, seed=None):
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.rng = random.Random(f"{seed}/world")  # Caves, gem placement and respawns
+        self.rng_state = None  # self.rng.getstate() cached between draws, for save_state
+        self.player1 = player1
+        self.player2 = player2
+        player1.rng = random.Random(f"{seed}/player1")
+        player2.rng = random.Random(f"{seed}/player2")
+        self.projectiles = ProjectileStore()
+        self.caves = []
+        self.grid = SpatialGrid()  # Players, caves and uncollected gems
+        self.tick = 0
+        self.on_hit = None  # Called with (attacker, defender, damage) after every hit - for effects
+        self.on_gem = None  # Called with a gem whenever it is collected or respawns
+        self.create_world()
+        for player in (player1, player2):
+            self.grid.insert(player, player.x, player.y, player.width, player.height)
+
+    @classmethod
+    def headless(cls, p1_weapon='sword', p1_armor='light', p2_weapon='sword', p2_armor='light',
+                 p1_ai=True, p2_ai=True, ai_difficulty='medium', seed=None):
+        """Create a match without player images - AI on both sides by default"""
+        player1 = Player(200, SCREEN_HEIGHT // 2, RED, P1_CONTROLS, "Player 1",
+                         is_ai=p1_ai, ai_difficulty=ai_difficulty)
+        player1.weapon = p1_weapon
+        player1.armor = p1_armor
+
+        player2 = Player(SCREEN_WIDTH - 250, SCREEN_HEIGHT // 2, BLUE, P2_CONTROLS, "Player 2",
+                         is_ai=p2_ai, ai_difficulty=ai_difficulty)
+        player2.weapon = p2_weapon
+        player2.armor = p2_armor
+        return cls(player1, player2, seed)
+
+    @classmethod
+    def from_replay(cls, header):
+        """Rebuild the starting state of a recorded match"""
+        return cls.headless(header.p1_weapon, header.p1_armor, header.p2_weapon, header.p2_armor,
+                            p1_ai=False, p2_ai=(header.game_mode == 'ai'),
+                            ai_difficulty=header.ai_difficulty, seed=header.seed)
+
+    def create_world(self):
+        # Create caves with healing gems
+        self.caves = [Cave(x, y, width, height, self.rng) for x, y, width, height in CAVE_LAYOUT]
+        self.gems = [gem for cave in self.caves for gem in cave.gems]  # Caves in order
+        for cave in self.caves:
+            self.grid.insert(cave, cave.x, cave.y, cave.width, cave.height)
+            cave.on_gem_change = self.gem_changed
+            for gem in cave.gems:
+                self.grid.insert(gem, *gem.rect)
+
+    def gem_changed(self, gem):
+        self.rng_state = None  # A respawn draws from the world generator
+        # Keep the grid to uncollected gems, for the AI's nearest-gem search
+        if gem.collected:
+            self.grid.remove(gem)
+        else:
+            self.grid.insert(gem, *gem.rect)
+        if self.on_gem:
+            self.on_gem(gem)
+
+    @property
+    def over(self):
+        return not self.player1.alive or not self.player2.alive
+
+    @property
+    def winner(self):
+        """The surviving player once the match is over, otherwise None"""
+        if not self.over:
+            return None
+        return self.player1 if self.player1.alive else self.player2
+
+    def fire(self, player, target_x, target_y):
+        """Ranged attack towards a point - returns True if a projectile was fired"""
+        result = player.attack(target_x, target_y)
+        if isinstance(result, Projectile):
+            self.projectiles.add(result, self.player_index(player))
+            return True
+        return False
+
+    def player_index(self, player):
+        return 0 if player is self.player1 else 1
+
+    def hit(self, attacker, defender, damage):
+        """Apply damage to defender and credit it to attacker"""
+        dealt = defender.take_damage(damage)
+        attacker.damage_dealt += dealt
+        if self.on_hit:
+            self.on_hit(attacker, defender, dealt)
+
+    def melee(self, attacker, defender):
+        """Melee attack - hits if the defender is within weapon range"""
+        weapon = WEAPONS[attacker.weapon]
+        reach = weapon['range']
+        in_reach = self.grid.query(attacker.x - reach, attacker.y - reach, reach * 2, reach * 2, Player)
+        if attacker.attack_cooldown == 0 and defender.alive and defender in in_reach:
+            dx = defender.x - attacker.x
+            dy = defender.y - attacker.y
+            dist = math.sqrt(dx**2 + dy**2)
+
+            if dist <= weapon['range']:
+                self.hit(attacker, defender, weapon['damage'])
+                attacker.attack_cooldown = weapon['cooldown']
+                return True
+        return False
+
+    def ai_attack(self, ai, target):
+        """AI auto-attack with reaction time based on difficulty"""
+        # Reaction time delays
+        if ai.ai_difficulty == 'easy':
+            attack_delay = 45  # Slow attacks
+        elif ai.ai_difficulty == 'medium':
+            attack_delay = 25
+        else:  # hard
+            attack_delay = 10  # Very fast attacks
+
+        ai.ai_reaction_time += 1
+
+        if ai.attack_cooldown == 0 and ai.ai_reaction_time >= attack_delay:
+            # Calculate distance to target
+            dx = target.x - ai.x
+            dy = target.y - ai.y
+            dist = math.sqrt(dx**2 + dy**2)
+
+            weapon = WEAPONS[ai.weapon]
+            # Attack if in range
+            if dist <= weapon['range']:
+                result = ai.attack(target.x + target.width // 2, target.y + target.height // 2)
+                if isinstance(result, Projectile):
+                    self.projectiles.add(result, self.player_index(ai))
+                elif result == 'melee_hit':
+                    self.hit(ai, target, weapon['damage'])
+                ai.ai_reaction_time = 0  # Reset reaction timer
+
+    def step(self, p1_input=NO_INPUT, p2_input=NO_INPUT):
+        """Advance the simulation by one tick"""
+        p1_buttons, p1_aim = p1_input
+        p2_buttons, p2_aim = p2_input
+
+        # Attacks land before movement, as they did when applied straight from events
+        for player, opponent, buttons, aim in ((self.player1, self.player2, p1_buttons, p1_aim),
+                                               (self.player2, self.player1, p2_buttons, p2_aim)):
+            if not player.alive:
+                continue
+            if buttons & INPUT_FIRE and aim:
+                self.fire(player, aim[0], aim[1])
+            if buttons & INPUT_MELEE:
+                self.melee(player, opponent)
+
+        # Remember last tick's positions for interpolated rendering
+        for player in (self.player1, self.player2):
+            player.prev_x = player.x
+            player.prev_y = player.y
+
+        # Normal movement for both players
+        self.player1.update(p1_buttons, self.grid, self.player2)
+        self.player2.update(p2_buttons, self.grid, self.player1)
+        for player in (self.player1, self.player2):
+            self.grid.move(player, player.x, player.y, player.width, player.height)
+
+        for ai, target in ((self.player2, self.player1), (self.player1, self.player2)):
+            if ai.is_ai and ai.alive and target.alive:
+                self.ai_attack(ai, target)
+
+        # Update projectiles
+        self.projectiles.update()
+
+        # Only hit opponent, not the player who fired it - Player 1 is checked first
+        store = self.projectiles
+        if store.count:
+            store.index(self.grid)
+            p1_hits = store.hits(self.player1, 0, self.grid)
+            p2_hits = store.hits(self.player2, 1, self.grid)
+            if len(p1_hits) and len(p2_hits):
+                p2_hits = np.setdiff1d(p2_hits, p1_hits)
+            players = (self.player1, self.player2)
+            for target, hits in ((self.player1, p1_hits), (self.player2, p2_hits)):
+                for i in hits:
+                    self.hit(players[store.owner[i]], target, int(store.damage[i]))
+            if len(p1_hits) or len(p2_hits):
+                dead = np.zeros(store.count, dtype=bool)
+                dead[p1_hits] = True
+                dead[p2_hits] = True
+                store.remove(dead)
+
+        # Update gems
+        for gem in self.gems:
+            gem.update()
+
+        self.tick += 1
+
+    def save_state(self):
+        """Everything step() can change, as plain values - restore with load_state.
+        Cheap enough to save every tick for rollback netcode."""
+        players = []
+        for player in (self.player1, self.player2):
+            values = [getattr(player, field) for field in Player.STATE_FIELDS]
+            # Only the AI draws from its generator
+            players.append((values, player.rng.getstate() if player.is_ai else None))
+        gems = [(gem.collected, gem.respawn_timer, gem.respawn_time, gem.image_index, gem.pulse)
+                for gem in self.gems]
+        # Availability order decides which gem is picked up first
+        available = [[cave.gems.index(gem) for gem in cave.available_gems] for cave in self.caves]
+        if self.rng_state is None:
+            self.rng_state = self.rng.getstate()
+        return (self.tick, players, self.projectiles.save_state(), gems, available, self.rng_state)
+
+    def load_state(self, state):
+        """Put the match back exactly as it was when state was saved"""
+        self.tick, players, projectiles, gems, available, world_rng = state
+        for player, (values, rng_state) in zip((self.player1, self.player2), players):
+            for field, value in zip(Player.STATE_FIELDS, values):
+                setattr(player, field, value)
+            if rng_state is not None:
+                player.rng.setstate(rng_state)
+            self.grid.move(player, player.x, player.y, player.width, player.height)
+        self.projectiles.load_state(projectiles)
+        for gem, (collected, respawn_timer, respawn_time, image_index, pulse) in zip(self.gems, gems):
+            gem.collected = collected
+            gem.respawn_timer = respawn_timer
+            gem.respawn_time = respawn_time
+            gem.image_index = image_index
+            gem.pulse = pulse
+        for cave, indices in zip(self.caves, available):
+            cave.available_gems[:] = [cave.gems[i] for i in indices]
+        if world_rng is not self.rng_state:
+            self.rng.setstate(world_rng)
+            self.rng_state = world_rng
+
+    def run(self, max_ticks=60 * 60 * 5):
+        """Step until someone dies or max_ticks is reached - returns ticks played"""
+        while not self.over and self.tick < max_ticks:
+            self.step()
+        return self.tick
+
+class AssetLoader:
+    """Loads images into SpriteCache a few at a time, within a per-frame time
+    budget, so startup never blocks the window (or, under pygbag, the browser).
+    Anything drawn before it finishes is still loaded on demand."""
+    def __init__(self, assets):
+        self.pending = list(assets)  # (path, size) still to load
+        self.total = len(self.pending)
+
+    @property
+    def done(self):
+        return not self.pending
+
+    @property
+    def progress(self):
+        return 1.0 - len(self.pending) / self.total if self.total else 1.0
+
+    def step(self, budget=LOAD_BUDGET):
+        # Always load at least one, so a slow device still makes progress
+        start = time.perf_counter()
+        while self.pending:
+            path, size = self.pending.pop(0)
+            SpriteCache.load(path, size)
+            if time.perf_counter() - start >= budget:
+                break
+
+def game_assets():
+    """Every image the game draws, as (path, size) for SpriteCache"""
+    assets = [(weapon['image'], WEAPON_IMAGE_SIZE) for weapon in WEAPONS.values()]
+    assets += [(path, PLAYER_SIZE) for path in (P1_IMAGE, P2_IMAGE)]
+    assets += [(path, GEM_SIZE) for path in GEM_IMAGE_PATHS]
+    assets += [(Cave.image_path, size) for size in sorted({(w, h) for x, y, w, h in CAVE_LAYOUT})]
+    return assets
 
 class TouchButton:
+    __slots__ = ('rect', 'text', 'color', 'pressed', 'faces')
+
     def __init__(self, x, y, width, height, text, color):
         self.rect = pygame.Rect(x, y, width, height)
         self.text = text
         self.color = color
         self.pressed = False
+        self.faces = {}  # (text, font, size, pressed) -> pre-composited button Surface
+
+    def face(self, font):
+        """The whole button - fill, border and label - as one translucent Surface,
+        built the first time each look is needed instead of every frame"""
+        key = (self.text, font, self.rect.size, self.pressed)
+        surface = self.faces.get(key)
+        if surface is None:
+            # Label or size changed - the old faces won't be needed again
+            if len(self.faces) >= 2:
+                self.faces.clear()
+
+            surface = pygame.Surface(self.rect.size, pygame.SRCALPHA)
+            # More opaque and bright yellow when pressed, thicker border
+            if self.pressed:
+                surface.fill((255, 255, 100, 220))
+            else:
+                surface.fill((*self.color, 150))
+            border_width = 3 if self.pressed else 2
+            pygame.draw.rect(surface, WHITE, surface.get_rect(), border_width)
 
-    def draw(self, screen, font):
-        # Draw button with transparency and better visual feedback
-        s = pygame.Surface((self.rect.width, self.rect.height))
-        if self.pressed:
-            s.set_alpha(220)  # More opaque when pressed
-            s.fill((255, 255, 100))  # Bright yellow when pressed
-        else:
-            s.set_alpha(150)
-            s.fill(self.color)
-        screen.blit(s, (self.rect.x, self.rect.y))
+            text_surf = TextCache.render(self.text, font, BLACK if self.pressed else WHITE)
+            surface.blit(text_surf, text_surf.get_rect(center=surface.get_rect().center))
 
-        # Draw border - thicker when pressed
-        border_width = 3 if self.pressed else 2
-        pygame.draw.rect(screen, WHITE, self.rect, border_width)
+            if pygame.display.get_surface():
+                surface = surface.convert_alpha()
+            self.faces[key] = surface
+        return surface
 
-        # Draw text
-        text_surf = font.render(self.text, True, BLACK if self.pressed else WHITE)
-        text_rect = text_surf.get_rect(center=self.rect.center)
-        screen.blit(text_surf, text_rect)
+    def draw(self, screen, font):
+        screen.blit(self.face(font), self.rect)
 
     def is_pressed(self, pos):
         return self.rect.collidepoint(pos)
 
+def local_ip():
+    """This machine's address on its local network"""
+    try:
+        # Create a temporary socket to find the local IP
+        temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        temp_socket.connect(('8.8.8.8', 80))  # Connect to Google DNS
+        address = temp_socket.getsockname()[0]
+        temp_socket.close()
+        return address
+    except:
+        # Fallback to hostname method
+        hostname = socket.gethostname()
+        return socket.gethostbyname(hostname)
+
+
 class PvPGame:
-    def __init__(self):
-        self.screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-        pygame.display.set_caption("PvP Battle Arena - With Armor & Healing!")
+    def __init__(self, screen=None):
+        pygame.init()
+
+        # Pass an offscreen Surface to draw without opening a window
+        if screen is None:
+            screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+            pygame.display.set_caption("PvP Battle Arena - With Armor & Healing!")
+        self.screen = screen
         self.clock = pygame.time.Clock()
         self.running = True
 
-        self.state = 'menu'
-        self.player1 = None
-        self.player2 = None
-        self.projectiles = []
-        self.caves = []
+        # Fixed timestep - leftover real time and how far we are into the next tick
+        self.accumulator = 0.0
+        self.alpha = 1.0
+        self.time_scale = 1  # Sim ticks per real tick - raised for fast replay playback
+
+        # Replays
+        self.recorder = None  # ReplayRecorder for the match being played
+        self.record_replays = RECORD_REPLAYS
+        self.replay_ticks = None  # Recorded inputs when watching a replay
+
+        # Images load over the first few frames behind a progress bar
+        self.loader = AssetLoader(game_assets())
+
+        self.state = 'loading'
+        self.match = None  # Current Match - holds players, projectiles and caves
+
+        # Hit sparks and projectile trails
+        self.particles = ParticleSystem()
+
+        # The arena can be drawn at a lower resolution and scaled up (see draw_game)
+        self.canvas = self.screen
+        self.render_scale = 1.0
+        self.auto_render_scale = RENDER_SCALE == 'auto'
+        self.render_time = 0.0  # Smoothed seconds per render() in automatic mode
+        self.scale_cooldown = 0  # Frames before automatic mode may change scale again
+        self.set_render_scale(RENDER_SCALES[0] if self.auto_render_scale else RENDER_SCALE)
+
+        # Fill, grid and cave art for the current match, drawn once per world
+        self.background = None
+        self.background_match = None
+
+        # Dirty-rect rendering - only changed areas are redrawn and presented
+        self.dirty_rendering = DIRTY_RECT_RENDERING
+        self.updated_rects = None  # Areas to present this frame, None for the whole screen
+        self.render_key = None  # What the last full render showed
+        self.had_events = True  # Menus only change in response to input
+        self.drawn_rects = []  # Everything drawn over the background last frame
+        self.moving_rects = []  # Players, projectiles, gems and crosshair last frame
+        self.overlay_looks = {}  # HUD area -> the surface blitted there last frame
 
         # Touch controls
         self.show_touch_controls = False
@@ -612,9 +1529,9 @@ class PvPGame:
         self.setup_buttons = []
         self.last_setup_phase = None  # Track which phase buttons were created for
 
-        self.font = pygame.font.Font(None, 56)
-        self.small_font = pygame.font.Font(None, 32)
-        self.tiny_font = pygame.font.Font(None, 24)
+        self.font = TextCache.font(56)
+        self.small_font = TextCache.font(32)
+        self.tiny_font = TextCache.font(24)
 
         # Selections
         self.game_mode = '2p'  # '2p', 'ai', or 'online'
@@ -627,19 +1544,77 @@ class PvPGame:
         self.select_phase = 'mode'
 
         # Online multiplayer
-        self.online_mode = None  # 'host' or 'join'
+        self.online_mode = None  # 'host', 'join' or 'quick' (until the matchmaker says which)
         self.connection = None
         self.socket = None
         self.connected = False
         self.host_ip = ''
         self.network_thread = None
-        self.received_data = None
+        self.udp_socket = None  # Host - listens for UDP handshakes next to the TCP socket
+        self.transport_choice = NET_TRANSPORT  # 'udp' or 'tcp', picked on the join screen
+        self.rollback_netcode = NET_ROLLBACK  # Picked by the host while waiting for a player
+        self.rollback = None  # RollbackSession while playing a rollback match
+        self.online_player = 1  # Index of the player an online client controls - set by the host
+        self.matchmaker = None  # matchmaking.MatchmakingClient while looking for a quick match
+        self.quick_match = False  # This online game came from the matchmaker
+        self.match_found = False  # Paired - waiting for the opponent to connect
+        self.match_found_at = 0.0  # When we told the matchmaker we were ready to host
+        self.matchmaker_host = MATCHMAKER_HOST
+        self.queue_size = 0  # Players in our matchmaking queue when we joined it
+
+        # State sync - the host simulates and sends snapshots, the client applies them
+        self.snapshots = None  # net.SnapshotSender on the host, net.SnapshotReceiver on the client
+        self.remote_inputs = net.InputQueue()  # The client's inputs waiting for their tick (host)
+        self.gem_indices = {}  # Gem -> its index in snapshots and gem events (host)
+        self.sync_targets = None  # Player positions from the last snapshot (client)
+        self.sync_steps = 1  # Ticks left to glide players to sync_targets (client)
+
+        # Client-side prediction - our own player moves as soon as we press a key
+        self.input_seq = 1  # Of the next input sent (client)
+        self.input_buffer = [None] * net.INPUT_BUFFER_SIZE  # (seq, buttons, aim) by seq, a ring (client)
+        self.input_acked = 0  # Newest of our inputs the host had applied by the latest snapshot (client)
+        self.predicted = None  # Where our player is by our own inputs (client)
+        self.correction = [0.0, 0.0]  # Prediction error still being smoothed out (client)
+
+        # Attacks from events, applied on the next simulation tick
+        self.pending_attacks = {}
 
         # Player 2 aiming system
         self.p2_aiming = False
         self.p2_aim_x = SCREEN_WIDTH // 2
         self.p2_aim_y = SCREEN_HEIGHT // 2
 
+    @property
+    def player1(self):
+        return self.match.player1 if self.match else None
+
+    @property
+    def player2(self):
+        return self.match.player2 if self.match else None
+
+    @property
+    def caves(self):
+        return self.match.caves if self.match else []
+
+    @property
+    def net_role(self):
+        """'host' or 'client' while connected for an online match, otherwise None"""
+        if self.game_mode != 'online' or not self.connection:
+            return None
+        return 'host' if self.online_mode == 'host' else 'client'
+
+    @property
+    def local_player(self):
+        """The player driven by player 1's controls - an online client's is picked by the host"""
+        if self.net_role == 'client' and self.online_player == 0:
+            return self.player1
+        return self.player2 if self.net_role == 'client' else self.player1
+
+    @property
+    def opponent(self):
+        """Whoever local_player is up against"""
+        return self.player2 if self.local_player is self.player1 else self.player1
+
     def create_keyboard(self):
         """Create on-screen keyboard for IP entry"""
         keys = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '0', '.']
@@ -664,6 +1639,10 @@ class PvPGame:
         cancel_btn = TouchButton(start_x + 360, start_y + 80, 120, button_height, 'CANCEL', GRAY)
         self.keyboard_buttons.append(cancel_btn)
 
+        # Switches between UDP and TCP - the label shows the current choice
+        transport_btn = TouchButton(start_x + 500, start_y + 80, 160, button_height, 'VIA UDP', PURPLE)
+        self.keyboard_buttons.append(transport_btn)
+
     def create_menu_buttons(self):
         """Create touch buttons for main menu"""
         button_width = 400
@@ -698,41 +1677,145 @@ class PvPGame:
             btn = TouchButton(start_x, y, button_width, button_height, f"Option {i+1}", colors[i])
             self.setup_buttons.append(btn)
 
-    def create_world(self):
-        # Create caves with healing gems
-        self.caves = [
-            Cave(100, 100, 200, 150),
-            Cave(SCREEN_WIDTH - 300, 100, 200, 150),
-            Cave(SCREEN_WIDTH // 2 - 100, SCREEN_HEIGHT - 200, 200, 150),
-            Cave(50, SCREEN_HEIGHT // 2 - 75, 180, 150),
-            Cave(SCREEN_WIDTH - 230, SCREEN_HEIGHT // 2 - 75, 180, 150)
-        ]
-
-    def reset_game(self):
-        self.player1 = Player(200, SCREEN_HEIGHT // 2, RED,
-                            {'left': pygame.K_a, 'right': pygame.K_d, 'up': pygame.K_w,
-                             'down': pygame.K_s, 'attack': pygame.K_SPACE}, "Player 1",
-                            image_path="PvP images/PvP red.png")
-        self.player1.weapon = self.p1_weapon
-        self.player1.armor = self.p1_armor
+    def reset_game(self, seed=None):
+        player1 = Player(200, SCREEN_HEIGHT // 2, RED, P1_CONTROLS, "Player 1",
+                         image_path=P1_IMAGE)
+        player1.weapon = self.p1_weapon
+        player1.armor = self.p1_armor
 
         # Create Player 2 (either human or AI)
         is_ai = (self.game_mode == 'ai')
         player2_name = "AI Opponent" if is_ai else "Player 2"
 
-        self.player2 = Player(SCREEN_WIDTH - 250, SCREEN_HEIGHT // 2, BLUE,
-                            {'left': pygame.K_LEFT, 'right': pygame.K_RIGHT, 'up': pygame.K_UP,
-                             'down': pygame.K_DOWN, 'attack': pygame.K_RETURN}, player2_name,
-                            is_ai=is_ai, ai_difficulty=self.ai_difficulty,
-                            image_path="PvP images/PvP blue.png")
-        self.player2.weapon = self.p2_weapon
-        self.player2.armor = self.p2_armor
+        player2 = Player(SCREEN_WIDTH - 250, SCREEN_HEIGHT // 2, BLUE, P2_CONTROLS, player2_name,
+                         is_ai=is_ai, ai_difficulty=self.ai_difficulty,
+                         image_path=P2_IMAGE)
+        player2.weapon = self.p2_weapon
+        player2.armor = self.p2_armor
+
+        # New match - also creates the world
+        self.stop_recording()
+        self.rollback = None
+        self.pending_attacks = {}
+        self.match = Match(player1, player2, seed)
+        self.match.on_hit = self.hit_effect
+        self.particles.clear()
+        self.build_background()
+        # The client only mirrors the host's match, so there is nothing of its own to record
+        if self.record_replays and self.replay_ticks is None and self.net_role != 'client':
+            self.start_recording()
+        if self.net_role == 'host':
+            self.start_sync()
+
+    def set_render_scale(self, scale):
+        """Draw the arena at scale x the screen resolution from the next frame"""
+        self.render_scale = scale
+        if scale == 1.0:
+            self.canvas = self.screen
+        else:
+            size = scale_size(self.screen.get_size(), scale)
+            self.canvas = pygame.Surface(size).convert(self.screen)
+
+    def adapt_render_scale(self, render_time):
+        """Automatic mode - step the arena resolution down while rendering eats
+        too much of the frame budget, and back up once there is headroom"""
+        self.render_time += (render_time - self.render_time) * 0.1
+        self.scale_cooldown -= 1
+        if self.scale_cooldown > 0 or self.state != 'playing':
+            return
 
-        self.projectiles = []
-        self.create_world()
+        budget = 1.0 / FPS
+        step = RENDER_SCALES.index(self.render_scale)
+        if self.render_time > budget * AUTO_SCALE_DOWN and step < len(RENDER_SCALES) - 1:
+            step += 1
+        elif self.render_time < budget * AUTO_SCALE_UP and step > 0:
+            step -= 1
+        else:
+            return
+        self.set_render_scale(RENDER_SCALES[step])
+        self.scale_cooldown = FPS  # Let the average settle before judging again
+
+    def build_background(self):
+        """Pre-render everything in the arena that never moves, at render scale"""
+        background = pygame.Surface(self.canvas.get_size()).convert(self.screen)
+        background.fill((30, 30, 50))
+
+        # Grid
+        scale = self.render_scale
+        width, height = background.get_size()
+        for x in range(0, SCREEN_WIDTH, 50):
+            pygame.draw.line(background, (40, 40, 60), (int(x * scale), 0), (int(x * scale), height), 1)
+        for y in range(0, SCREEN_HEIGHT, 50):
+            pygame.draw.line(background, (40, 40, 60), (0, int(y * scale)), (width, int(y * scale)), 1)
+
+        # Caves
+        for cave in self.caves:
+            cave.draw_background(background, scale)
+
+        self.background = background
+        self.background_match = self.match
+
+    def hit_effect(self, attacker, defender, damage):
+        """Sparks where a hit landed - a bigger burst in the loser's color for the killing blow"""
+        # Health first - alive only drops at the defender's next update
+        killed = defender.health <= 0
+        self.sparks(defender, killed)
+        if self.net_role == 'host' and not self.rollback:
+            self.send_data({'t': 'hit', 'attacker': self.match.player_index(attacker),
+                            'damage': damage, 'killed': int(killed)})
+
+    def sparks(self, defender, killed):
+        x = defender.x + defender.width / 2
+        y = defender.y + defender.height / 2
+        if killed:
+            self.particles.burst(x, y, 48, 9, 40, 4, defender.color)
+        else:
+            self.particles.burst(x, y, 12, 6, 16, 3, YELLOW)
+
+    def gem_event(self, gem):
+        """Host - pickups and respawns reach the client straight away, not at the next snapshot"""
+        self.send_data({'t': 'gem', 'gem': self.gem_indices[gem], 'collected': int(gem.collected)})
+
+    def replay_header(self):
+        return replay.ReplayHeader(self.match.seed, self.game_mode, self.ai_difficulty,
+                                   self.p1_weapon, self.p1_armor, self.p2_weapon, self.p2_armor)
+
+    def start_recording(self):
+        try:
+            os.makedirs(REPLAY_DIR, exist_ok=True)
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.match.seed}.pvpr"
+            self.recorder = replay.ReplayRecorder(os.path.join(REPLAY_DIR, name), self.replay_header())
+        except Exception as e:
+            print(f"Could not record replay: {e}")
+            self.recorder = None
+
+    def stop_recording(self):
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+    def watch_replay(self, path, speed=1):
+        """Play back a recorded match at speed x real time"""
+        header, ticks = replay.load_replay(path)
+        self.game_mode = header.game_mode
+        self.ai_difficulty = header.ai_difficulty
+        self.p1_weapon = header.p1_weapon
+        self.p1_armor = header.p1_armor
+        self.p2_weapon = header.p2_weapon
+        self.p2_armor = header.p2_armor
+
+        self.replay_ticks = iter(ticks)
+        self.reset_game(seed=header.seed)
+        self.time_scale = speed
+        self.state = 'playing'
+
+    def end_replay(self):
+        self.replay_ticks = None
+        self.time_scale = 1
 
     def handle_events(self):
         for event in pygame.event.get():
+            self.had_events = True
             if event.type == pygame.QUIT:
                 self.running = False
 
@@ -760,7 +1843,7 @@ class PvPGame:
                                 self.select_phase = 'online_mode'
 
                 # Handle setup buttons (weapon mode, difficulty, online mode, etc.)
-                if self.state == 'setup' and self.select_phase not in ['enter_ip', 'waiting_for_player']:
+                if self.state == 'setup' and self.select_phase not in ['enter_ip', 'waiting_for_player', 'waiting_for_host', 'matchmaking']:
                     for i, button in enumerate(self.setup_buttons):
                         if button.is_pressed(pos):
                             button.pressed = True
@@ -780,10 +1863,12 @@ class PvPGame:
                                 self.host_ip = self.host_ip[:-1]
                             elif button.text == 'CONNECT':
                                 if self.connect_to_host(self.host_ip):
-                                    self.select_phase = 'weapon_mode'
+                                    self.select_phase = 'waiting_for_host'
                             elif button.text == 'CANCEL':
                                 self.state = 'menu'
                                 self.host_ip = ''
+                            elif button.text.startswith('VIA'):
+                                self.toggle_transport()
 
                 # Check toggle button (always available during playing)
                 if self.state == 'playing' and self.touch_toggle_button.is_pressed(pos):
@@ -797,26 +1882,18 @@ class PvPGame:
                             button.pressed = True
 
                             # Handle attack buttons immediately on press
-                            if key == 'p1_attack' and self.player1 and self.player1.alive:
-                                weapon = WEAPONS[self.player1.weapon]
+                            if key == 'p1_attack' and self.player1 and self.local_player.alive:
+                                weapon = WEAPONS[self.local_player.weapon]
 
                                 if weapon.get('projectile', False):
                                     # Projectile weapons aim at opponent
-                                    target_x = self.player2.x + self.player2.width // 2
-                                    target_y = self.player2.y + self.player2.height // 2
-                                    result = self.player1.attack(target_x, target_y)
-                                    if isinstance(result, Projectile):
-                                        self.projectiles.append(result)
+                                    target = self.opponent
+                                    target_x = target.x + target.width // 2
+                                    target_y = target.y + target.height // 2
+                                    self.queue_attack(1, INPUT_FIRE, (target_x, target_y))
                                 else:
                                     # Melee weapons - check if opponent is in range
-                                    if self.player1.attack_cooldown == 0:
-                                        dx = self.player2.x - self.player1.x
-                                        dy = self.player2.y - self.player1.y
-                                        dist = math.sqrt(dx**2 + dy**2)
-
-                                        if dist <= weapon['range']:
-                                            self.player2.take_damage(weapon['damage'])
-                                            self.player1.attack_cooldown = weapon['cooldown']
+                                    self.queue_attack(1, INPUT_MELEE)
 
                             elif key == 'p2_attack' and self.player2 and not self.player2.is_ai and self.player2.alive:
                                 weapon = WEAPONS[self.player2.weapon]
@@ -825,19 +1902,10 @@ class PvPGame:
                                     # Projectile weapons aim at opponent
                                     target_x = self.player1.x + self.player1.width // 2
                                     target_y = self.player1.y + self.player1.height // 2
-                                    result = self.player2.attack(target_x, target_y)
-                                    if isinstance(result, Projectile):
-                                        self.projectiles.append(result)
+                                    self.queue_attack(2, INPUT_FIRE, (target_x, target_y))
                                 else:
                                     # Melee weapons - check if opponent is in range
-                                    if self.player2.attack_cooldown == 0:
-                                        dx = self.player1.x - self.player2.x
-                                        dy = self.player1.y - self.player2.y
-                                        dist = math.sqrt(dx**2 + dy**2)
-
-                                        if dist <= weapon['range']:
-                                            self.player1.take_damage(weapon['damage'])
-                                            self.player2.attack_cooldown = weapon['cooldown']
+                                    self.queue_attack(2, INPUT_MELEE)
 
             if event.type == pygame.MOUSEBUTTONUP:
                 pos = event.pos
@@ -905,23 +1973,27 @@ class PvPGame:
                     if event.key == pygame.K_ESCAPE:
                         self.state = 'menu'
                         self.host_ip = ''
-                        # Clean up any network connections
-                        if self.socket:
-                            try:
-                                self.socket.close()
-                            except:
-                                pass
-                            self.socket = None
-                        self.connection = None
-                        self.connected = False
+                        self.disconnect()
+                    elif self.select_phase == 'waiting_for_host':
+                        pass  # The host picks the loadouts
+                    elif self.select_phase == 'waiting_for_player':
+                        if event.key == pygame.K_r:
+                            self.rollback_netcode = not self.rollback_netcode
+                    elif self.select_phase == 'matchmaking':
+                        # Switching netcode means a different queue
+                        if event.key == pygame.K_r and self.matchmaker and not self.match_found:
+                            self.rollback_netcode = not self.rollback_netcode
+                            self.queue_for_match()
                     # IP entry mode
                     elif self.select_phase == 'enter_ip':
                         if event.key == pygame.K_RETURN:
                             # Try to connect
                             if self.connect_to_host(self.host_ip):
-                                self.select_phase = 'weapon_mode'
+                                self.select_phase = 'waiting_for_host'
                         elif event.key == pygame.K_BACKSPACE:
                             self.host_ip = self.host_ip[:-1]
+                        elif event.key == pygame.K_TAB:
+                            self.toggle_transport()
                         elif len(self.host_ip) < 15:
                             # Only allow IP-valid characters
                             if event.unicode in '0123456789.':
@@ -942,36 +2014,21 @@ class PvPGame:
                 elif self.state == 'playing':
                     if event.key == pygame.K_ESCAPE:
                         self.state = 'menu'
-                        # Clean up any network connections
-                        if self.socket:
-                            try:
-                                self.socket.close()
-                            except:
-                                pass
-                            self.socket = None
-                        self.connection = None
-                        self.connected = False
+                        self.stop_recording()
+                        self.end_replay()
+                        self.disconnect()
 
                     # Player 1 attack
-                    if self.player1 and self.player2 and event.key == self.player1.controls['attack'] and self.player1.alive:
-                        weapon = WEAPONS[self.player1.weapon]
+                    if self.player1 and self.player2 and event.key == self.player1.controls['attack'] and self.local_player.alive:
+                        weapon = WEAPONS[self.local_player.weapon]
 
                         if weapon.get('projectile', False):
                             # Projectile weapons use mouse for aiming
                             mx, my = pygame.mouse.get_pos()
-                            result = self.player1.attack(mx, my)
-                            if isinstance(result, Projectile):
-                                self.projectiles.append(result)
+                            self.queue_attack(1, INPUT_FIRE, (mx, my))
                         else:
                             # Melee weapons - check if opponent is in range
-                            if self.player1.attack_cooldown == 0 and self.player2.alive:
-                                dx = self.player2.x - self.player1.x
-                                dy = self.player2.y - self.player1.y
-                                dist = math.sqrt(dx**2 + dy**2)
-
-                                if dist <= weapon['range']:
-                                    self.player2.take_damage(weapon['damage'])
-                                    self.player1.attack_cooldown = weapon['cooldown']
+                            self.queue_attack(1, INPUT_MELEE)
 
                     # Player 2 melee attack (ENTER key for melee weapons only)
                     if self.player1 and self.player2 and not self.player2.is_ai and event.key == self.player2.controls['attack'] and self.player2.alive:
@@ -979,36 +2036,30 @@ class PvPGame:
 
                         if not weapon.get('projectile', False):
                             # Melee weapons - check if opponent is in range
-                            if self.player2.attack_cooldown == 0 and self.player1.alive:
-                                dx = self.player1.x - self.player2.x
-                                dy = self.player1.y - self.player2.y
-                                dist = math.sqrt(dx**2 + dy**2)
-
-                                if dist <= weapon['range']:
-                                    self.player1.take_damage(weapon['damage'])
-                                    self.player2.attack_cooldown = weapon['cooldown']
+                            self.queue_attack(2, INPUT_MELEE)
 
                     # Player 2 shoot (SHIFT key for ranged weapons - always ready)
                     if self.player2 and not self.player2.is_ai and (event.key == pygame.K_LSHIFT or event.key == pygame.K_RSHIFT) and self.player2.alive:
                         weapon = WEAPONS[self.player2.weapon]
                         if weapon.get('projectile', False):
                             # Ranged weapons shoot at crosshair position
-                            result = self.player2.attack(self.p2_aim_x, self.p2_aim_y)
-                            if isinstance(result, Projectile):
-                                self.projectiles.append(result)
+                            self.queue_attack(2, INPUT_FIRE, (self.p2_aim_x, self.p2_aim_y))
 
                 elif self.state == 'game_over':
-                    if event.key == pygame.K_SPACE:
+                    if event.key == pygame.K_SPACE and self.net_role != 'client':
                         self.reset_game()
                         self.state = 'playing'
                     elif event.key == pygame.K_RETURN or event.key == pygame.K_ESCAPE:
                         self.state = 'menu'
+                        self.disconnect()
 
     def handle_selection(self, choice):
         if self.select_phase == 'online_mode':
-            modes = ['host', 'join']
+            modes = ['quick', 'host', 'join']
             self.online_mode = modes[choice]
-            if self.online_mode == 'host':
+            if self.online_mode == 'quick':
+                self.select_phase = 'weapon_mode'  # Players are matched by weapon mode
+            elif self.online_mode == 'host':
                 self.start_host()
             else:
                 self.select_phase = 'enter_ip'
@@ -1017,7 +2068,9 @@ class PvPGame:
             modes = ['melee_only', 'ranged_only', 'any']
             self.weapon_mode = modes[choice]
             # Go to AI difficulty if AI mode, otherwise go to weapon selection
-            if self.game_mode == 'ai':
+            if self.game_mode == 'online' and self.online_mode == 'quick':
+                self.start_quick_match()
+            elif self.game_mode == 'ai':
                 self.select_phase = 'ai_difficulty'
             else:
                 self.select_phase = 'p1_weapon'
@@ -1066,11 +2119,7 @@ class PvPGame:
         try:
             # Clean up any existing socket first
             if self.socket:
-                try:
-                    self.socket.close()
-                except:
-                    pass
-                self.socket = None
+                self.disconnect()
                 time.sleep(0.5)  # Give OS time to release the port
 
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -1081,22 +2130,16 @@ class PvPGame:
             except AttributeError:
                 pass  # Not available on all platforms
 
-            self.socket.bind(('0.0.0.0', 5555))
+            self.socket.bind(('0.0.0.0', NET_PORT))
             self.socket.listen(1)
 
-            # Get local IP address (better method)
-            try:
-                # Create a temporary socket to find the local IP
-                temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                temp_socket.connect(('8.8.8.8', 80))  # Connect to Google DNS
-                self.host_ip = temp_socket.getsockname()[0]
-                temp_socket.close()
-            except:
-                # Fallback to hostname method
-                hostname = socket.gethostname()
-                self.host_ip = socket.gethostbyname(hostname)
-
-            self.select_phase = 'waiting_for_player'
+            # Clients that pick UDP say hello on the same port number
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_socket.bind(('0.0.0.0', NET_PORT))
+
+            self.host_ip = local_ip()
+            if not self.quick_match:
+                self.select_phase = 'waiting_for_player'
 
             # Start accepting connections in background
             self.network_thread = threading.Thread(target=self.accept_connection, daemon=True)
@@ -1108,67 +2151,471 @@ class PvPGame:
             self.state = 'menu'
 
     def accept_connection(self):
-        """Accept incoming connection"""
+        """Accept incoming connection - a TCP connect or a UDP hello, whichever comes first"""
         try:
-            # Set timeout so we can check if socket was closed
-            self.socket.settimeout(1.0)
             while self.socket:
-                try:
-                    self.connection, addr = self.socket.accept()
-                    self.connected = True
-                    print(f"Connected to {addr}")
-                    break
-                except socket.timeout:
-                    # Check if socket still exists
-                    if not self.socket:
-                        break
+                # Time out so we can check if the sockets were closed
+                readable, _, _ = select.select([self.socket, self.udp_socket], [], [], 1.0)
+                if self.socket in readable:
+                    sock, addr = self.socket.accept()
+                    self.connection = net.TcpTransport(sock)
+                elif self.udp_socket in readable:
+                    data, addr = self.udp_socket.recvfrom(net.RECEIVE_SIZE)
+                    transport = net.UdpTransport(self.udp_socket, addr)
+                    transport.handle(data)
+                    hello = transport.receive()
+                    if not hello or hello[0]['t'] != 'hello' or hello[0]['version'] != net.PROTOCOL_VERSION:
+                        continue
+                    transport.send({'t': 'welcome', 'version': net.PROTOCOL_VERSION}, reliable=True)
+                    self.connection = transport
+                else:
                     continue
+                self.connected = True
+                print(f"Connected to {addr} over {self.connection.name.upper()}")
+                break
         except Exception as e:
             if self.socket:  # Only print if socket wasn't intentionally closed
                 print(f"Error accepting connection: {e}")
 
+    def start_quick_match(self):
+        """Ask the matchmaker for an opponent - it decides which of us hosts"""
+        try:
+            self.matchmaker = matchmaking.connect(self.matchmaker_host, MATCHMAKER_PORT)
+        except Exception as e:
+            print(f"Error reaching the matchmaker at {self.matchmaker_host}:{MATCHMAKER_PORT}: {e}")
+            print("Start one with 'python3 matchmaking.py', or pass --matchmaker with its address")
+            self.state = 'menu'
+            return
+        self.quick_match = True
+        self.select_phase = 'matchmaking'
+        self.queue_for_match()
+
+    def queue_for_match(self):
+        self.match_found = False
+        self.queue_size = 0
+        mode = 'rollback' if self.rollback_netcode else 'snapshot'
+        try:
+            self.matchmaker.queue(mode, self.weapon_mode, MATCHMAKER_REGION, local_ip())
+        except Exception as e:
+            self.lose_matchmaker(e)
+
+    def matchmaking_update(self):
+        """Follow the matchmaker until our opponent is connected"""
+        try:
+            alive = self.matchmaker.poll()
+            messages = self.matchmaker.receive()
+        except Exception as e:
+            self.lose_matchmaker(e)
+            return
+        for message in messages:
+            if message['t'] == 'queued':
+                self.match_found = False
+                self.queue_size = message['waiting']
+            elif message['t'] == 'found' and message['role'] == matchmaking.HOST:
+                self.match_found = True
+                self.online_mode = 'host'
+                if not self.socket:
+                    self.start_host()
+                if not self.socket:
+                    self.disconnect()  # Couldn't listen - the matchmaker gives our opponent to someone else
+                    self.state = 'menu'
+                    return
+                try:
+                    self.matchmaker.ready()
+                except Exception as e:
+                    self.lose_matchmaker(e)
+                    return
+                self.match_found_at = time.monotonic()
+            elif message['t'] == 'found':
+                # Drop anything left from hosting for an opponent who never came
+                self.close_connections()
+                self.match_found = False
+                self.online_mode = 'join'
+                if self.connect_to_host(message['address']):
+                    self.leave_matchmaking()
+                    self.select_phase = 'waiting_for_host'
+                else:
+                    # They can't be reached - there is no NAT traversal - so look for someone else
+                    self.online_mode = 'quick'
+                    self.queue_for_match()
+                return
+        if self.connected:
+            # Our opponent is here - the rest is an ordinary online match
+            self.leave_matchmaking()
+            self.select_phase = 'p1_weapon'
+        elif not alive:
+            self.lose_matchmaker("it closed the connection")
+        elif self.match_found and time.monotonic() - self.match_found_at > MATCH_CONNECT_TIMEOUT:
+            # They can't reach us - there is no NAT traversal - so look for someone else
+            print("Opponent never connected - looking for another")
+            self.queue_for_match()
+
+    def lose_matchmaker(self, reason):
+        print(f"Lost the matchmaker: {reason}")
+        self.disconnect()
+        self.state = 'menu'
+
+    def leave_matchmaking(self):
+        if self.matchmaker:
+            self.matchmaker.close()
+            self.matchmaker = None
+
+    def toggle_transport(self):
+        self.transport_choice = 'tcp' if self.transport_choice == 'udp' else 'udp'
+        for button in self.keyboard_buttons:
+            if button.text.startswith('VIA'):
+                button.text = f"VIA {self.transport_choice.upper()}"
+
     def connect_to_host(self, ip):
-        """Connect to a host"""
+        """Connect to a host over the chosen transport - UDP falls back to TCP"""
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((ip, 5555))
-            self.connection = self.socket
+            transport = None
+            if self.transport_choice == 'udp':
+                transport = net.connect_udp(ip, NET_PORT)
+                if transport is None:
+                    print("No answer over UDP - trying TCP")
+            if transport is None:
+                # A host that drops the attempt would otherwise stall the game for minutes
+                self.socket = socket.create_connection((ip, NET_PORT), timeout=MATCH_CONNECT_TIMEOUT)
+                transport = net.TcpTransport(self.socket)  # Non-blocking from here on
+            self.connection = transport
             self.connected = True
-            print(f"Connected to {ip}")
+            print(f"Connected to {ip} over {transport.name.upper()}")
         except Exception as e:
             print(f"Error connecting: {e}")
             return False
         return True
 
-    def send_data(self, data):
-        """Send data over network"""
+    def disconnect(self):
+        """Close any network connections"""
+        self.leave_matchmaking()
+        self.quick_match = False
+        self.close_connections()
+
+    def close_connections(self):
+        """Close the connection to the other player, and any host sockets - but not
+        the matchmaker"""
+        for sock in (self.connection, self.socket, self.udp_socket):
+            if sock:
+                try:
+                    sock.close()
+                except:
+                    pass
+        self.socket = None
+        self.udp_socket = None
+        self.connection = None
+        self.connected = False
+        self.snapshots = None
+        self.rollback = None
+
+    def send_data(self, data, reliable=True):
+        """Send a message - unreliable ones may be lost over UDP"""
         if self.connection:
             try:
-                message = json.dumps(data) + '\n'
-                self.connection.sendall(message.encode())
+                self.connection.send(data, reliable)
             except Exception as e:
                 print(f"Error sending data: {e}")
                 self.connected = False
 
-    def receive_data(self):
-        """Receive data from network (non-blocking)"""
-        if self.connection:
-            try:
-                self.connection.setblocking(0)
-                data = self.connection.recv(4096).decode()
-                if data:
-                    # Handle multiple messages
-                    for line in data.strip().split('\n'):
-                        if line:
-                            return json.loads(line)
-            except BlockingIOError:
-                pass
-            except Exception as e:
-                print(f"Error receiving data: {e}")
+    def poll_network(self):
+        """Move bytes in and out - called every tick while connected, whatever the state"""
+        try:
+            if not self.connection.poll():
+                print("Connection closed")
                 self.connected = False
-        return None
+        except Exception as e:
+            print(f"Error receiving data: {e}")
+            self.connected = False
+
+    def receive_data(self):
+        """Every message that has arrived since the last call"""
+        return self.connection.receive() if self.connection else []
+
+    def start_sync(self):
+        """Host - tell the client about the new match and start sending snapshots,
+        or with rollback netcode just our inputs"""
+        self.remote_inputs = net.InputQueue()
+        if self.rollback_netcode:
+            self.snapshots = None
+            self.rollback = rollback.RollbackSession(self.match, 0, record=self.recorder is not None)
+        else:
+            self.snapshots = net.SnapshotSender()
+            self.gem_indices = {gem: i for i, gem in enumerate(self.match.gems)}
+            self.match.on_gem = self.gem_event
+        self.send_data({'t': 'start', 'seed': self.match.seed, 'weapon_mode': self.weapon_mode,
+                        'p1_weapon': self.p1_weapon, 'p1_armor': self.p1_armor,
+                        'p2_weapon': self.p2_weapon, 'p2_armor': self.p2_armor,
+                        'rollback': int(self.rollback_netcode), 'player': 1})
+
+    def host_receive(self):
+        """Host - queue the client's inputs and note which snapshot it has"""
+        for message in self.receive_data():
+            if message.get('t') == 'in':
+                self.snapshots.ack(message['k'])
+                self.remote_inputs.add(message)
+
+    def remote_input(self):
+        """Host - the client's input for this tick, holding its last movement if none arrived"""
+        return self.remote_inputs.next()
+
+    def client_start(self, message):
+        """Client - set up the match the host just started"""
+        self.weapon_mode = message['weapon_mode']
+        for field in ('p1_weapon', 'p1_armor', 'p2_weapon', 'p2_armor'):
+            setattr(self, field, message[field])
+        self.online_player = message.get('player', 1)
+        self.reset_game(seed=message['seed'])
+        if message.get('rollback'):
+            self.snapshots = None
+            self.rollback = rollback.RollbackSession(self.match, self.online_player)
+        else:
+            self.snapshots = net.SnapshotReceiver()
+            self.sync_targets = None
+            self.input_seq = 1
+            self.input_acked = 0
+            self.predicted = None
+            self.correction = [0.0, 0.0]
+        self.state = 'playing'
+
+    def rollback_update(self):
+        """Either side of a rollback match - both run it and only swap inputs"""
+        session = self.rollback
+        for message in self.receive_data():
+            if message.get('t') == 'inputs':
+                session.receive(message)
+            elif message.get('t') == 'start' and self.net_role == 'client':
+                self.client_start(message)  # Rematch
+                return
+
+        if self.state == 'playing':
+            if session.can_advance:
+                # Read from player 1's controls on both machines, like a client's input
+                session.add_local_input(self.take_input(1, pygame.key.get_pressed()))
+                session.advance()
+            else:
+                session.resolve()  # Waiting for the other side - late inputs may still change things
+            if self.recorder:
+                for p1_input, p2_input in session.confirmed_inputs():
+                    self.recorder.record(p1_input, p2_input)
+
+        # Sent every tick, even after the match ends, until the other side has them all
+        self.send_data(session.message(), reliable=False)
+
+        store = self.match.projectiles
+        n = store.count
+        if n and self.state == 'playing':
+            self.particles.emit(store.prev_x[:n], store.prev_y[:n], 0.0, 0.0, 8, 4, store.color[:n],
+                                limit=TRAIL_BUDGET)
+
+        # A predicted kill only counts once both sides' inputs agree it happened
+        if self.state == 'playing' and self.match.over and session.settled:
+            self.state = 'game_over'
+            self.stop_recording()
+
+    def client_update(self):
+        """Client - follow the host's match instead of simulating one"""
+        state = None
+        for message in self.receive_data():
+            if message.get('t') == 'start':
+                self.client_start(message)
+                if self.rollback:
+                    return
+                state = None
+            elif message.get('t') == 'snap' and self.snapshots:
+                received = self.snapshots.receive(message)
+                if received:
+                    state = received
+                    self.input_acked = message.get('n', 0)
+            elif message.get('t') == 'hit' and self.match:
+                defender = self.player1 if message['attacker'] else self.player2
+                self.sparks(defender, message['killed'])
+            elif message.get('t') == 'gem' and self.match:
+                self.match.gems[message['gem']].collected = bool(message['collected'])
+
+        if self.state != 'playing':
+            return
+
+        # Our input goes to the host for our player - read from player 1's controls,
+        # which are the ones a player on their own machine uses
+        buttons, aim = self.take_input(1, pygame.key.get_pressed())
+        seq = self.input_seq
+        self.input_seq = (seq + 1) & 0xffffffff
+        self.input_buffer[seq % net.INPUT_BUFFER_SIZE] = (seq, buttons, aim)
+        message = {'t': 'in', 'b': buttons, 'k': self.snapshots.latest['tick'], 'n': seq}
+        if aim:
+            message['a'] = aim
+        # Held movement is resent every tick anyway - only attacks must not be lost
+        self.send_data(message, reliable=bool(buttons & (INPUT_FIRE | INPUT_MELEE)))
+
+        self.client_step(state, (buttons, aim))
+        if self.match.over:
+            self.state = 'game_over'
+
+    def client_step(self, state, local_input=NO_INPUT):
+        """Client - one tick of the mirrored match. Our own player is predicted
+        from our inputs straight away; a new snapshot corrects it and replaces
+        everything else. Between snapshots projectiles fly on and the other
+        player glides towards where the last snapshot put them."""
+        match = self.match
+        players = (match.player1, match.player2)
+        ours = self.online_player
+        local = players[ours]
+        remote = players[1 - ours]
+        for player in players:
+            player.prev_x = player.x
+            player.prev_y = player.y
+        if self.predicted:
+            # Predict from where our inputs put us, not where we're drawn
+            local.x, local.y = self.predicted
+
+        if state:
+            match.tick = state['tick']
+            states = [dict(zip(net.PLAYER_FIELDS, values)) for values in state['players']]
+            for player, values in zip(players, states):
+                player.health = values['health']
+                player.alive = bool(values['alive'])
+                player.damage_dealt = values['damage_dealt']
+            remote.facing_right = bool(states[1 - ours]['facing_right'])
+            remote.attack_cooldown = states[1 - ours]['attack_cooldown']
+            if self.sync_targets is None:
+                for player, values in zip(players, states):
+                    player.x = player.prev_x = values['x']
+                    player.y = player.prev_y = values['y']
+                local.facing_right = bool(states[ours]['facing_right'])
+            self.sync_targets = (states[1 - ours]['x'], states[1 - ours]['y'])
+            self.sync_steps = net.SNAPSHOT_INTERVAL
+            self.reconcile(local, remote, states[ours], self.input_acked)
+
+            for gem, (collected, image_index) in zip(match.gems, state['gems']):
+                gem.collected = bool(collected)
+                gem.image_index = image_index
+
+            # Rebuild the projectiles where they are at this tick
+            store = match.projectiles
+            store.clear()
+            for shot_id, (tick, x, y, vx, vy, owner) in state['shots'].items():
+                age = match.tick - tick
+                store.spawn(x + vx * age, y + vy * age, vx, vy, 0, WEAPONS[players[owner].weapon]['color'],
+                            owner, PROJECTILE_LIFETIME - age, shot_id)
+            n = store.count
+            store.prev_x[:n] -= store.vx[:n]
+            store.prev_y[:n] -= store.vy[:n]
+        else:
+            match.tick += 1
+            match.projectiles.update()
+
+        if self.sync_targets:
+            self.predict(local, remote, local_input)
+            self.predicted = (local.x, local.y)
+
+            # Ease out corrections instead of jumping - draw with what's left of the error
+            correction = self.correction
+            correction[0] *= net.CORRECTION_DECAY
+            correction[1] *= net.CORRECTION_DECAY
+            if abs(correction[0]) + abs(correction[1]) < 0.5:
+                correction[0] = correction[1] = 0.0
+            local.x += correction[0]
+            local.y += correction[1]
+
+            x, y = self.sync_targets
+            remote.x += (x - remote.x) / self.sync_steps
+            remote.y += (y - remote.y) / self.sync_steps
+            self.sync_steps = max(1, self.sync_steps - 1)
+
+        for cave in match.caves:
+            for gem in cave.gems:
+                gem.pulse += 0.1
+
+    def predict(self, player, opponent, player_input):
+        """Client - what the host's Match.step will do to our player for one input.
+        Damage and kills are left to the host; only cooldown and movement matter here."""
+        if not player.alive:
+            return
+        buttons, aim = player_input
+        weapon = WEAPONS[player.weapon]
+        if player.attack_cooldown == 0:
+            if buttons & INPUT_FIRE and aim:
+                player.attack_cooldown = weapon['cooldown']
+            elif buttons & INPUT_MELEE and opponent.alive and \
+                    math.hypot(opponent.x - player.x, opponent.y - player.y) <= weapon['range']:
+                player.attack_cooldown = weapon['cooldown']
+        player.speed = player.base_speed * ARMOR_TYPES[player.armor]['speed_mult']
+        player.move(buttons)
+
+    def reconcile(self, player, opponent, values, acked):
+        """Client - restart our prediction from the host's state after input `acked`
+        and replay the inputs it hasn't applied yet. Whatever the replay disagrees
+        with our old prediction by is smoothed out over the next few ticks."""
+        old = self.predicted
+        player.x = values['x']
+        player.y = values['y']
+        player.attack_cooldown = values['attack_cooldown']
+
+        # Inputs after `acked`, except this tick's - client_step predicts that one next
+        newest = (self.input_seq - 2) & 0xffffffff
+        unacked = (newest - acked) & 0xffffffff
+        if unacked < net.INPUT_BUFFER_SIZE:
+            for i in range(unacked):
+                seq = (acked + 1 + i) & 0xffffffff
+                entry = self.input_buffer[seq % net.INPUT_BUFFER_SIZE]
+                if entry and entry[0] == seq:
+                    self.predict(player, opponent, entry[1:])
+        if old is None:
+            return  # First snapshot - nothing drawn yet to smooth from
+
+        correction = self.correction
+        correction[0] += old[0] - player.x
+        correction[1] += old[1] - player.y
+        if math.hypot(*correction) > net.CORRECTION_SNAP:
+            correction[0] = correction[1] = 0.0  # Too far to glide - just jump there
+
+    def queue_attack(self, player_number, button, aim=None):
+        """Hold an attack from an event until the next simulation tick"""
+        if aim is not None:
+            # Whole pixels, so a recorded replay aims exactly like the live match
+            aim = (int(aim[0]), int(aim[1]))
+        self.pending_attacks[player_number] = (button, aim)
+
+    def take_input(self, player_number, keys):
+        """Build one tick's (buttons, aim) for a player from keys, touch buttons and queued attacks"""
+        player = self.player1 if player_number == 1 else self.player2
+        buttons = 0
+        for direction, bit in (('left', INPUT_LEFT), ('right', INPUT_RIGHT),
+                               ('up', INPUT_UP), ('down', INPUT_DOWN)):
+            if keys[player.controls[direction]]:
+                buttons |= bit
+            elif self.show_touch_controls and self.touch_buttons[f'p{player_number}_{direction}'].pressed:
+                buttons |= bit
+
+        aim = None
+        attack = self.pending_attacks.pop(player_number, None)
+        if attack:
+            buttons |= attack[0]
+            aim = attack[1]
+        return (buttons, aim)
 
     def update(self):
+        # Effects keep fading behind the game over screen
+        self.particles.update()
+
+        if self.connection and self.connected:
+            self.poll_network()
+        if self.game_mode == 'online' and self.connection and not self.connected:
+            print("Lost connection")
+            self.disconnect()
+            self.stop_recording()
+            self.state = 'menu'
+            return
+        if self.matchmaker:
+            self.matchmaking_update()
+            return
+        if self.rollback:
+            self.rollback_update()
+            return
+        if self.net_role == 'client':
+            self.client_update()
+            return
+
         if self.state != 'playing':
             return
 
@@ -1179,46 +2626,6 @@ class PvPGame:
         # Get keyboard state
         keys = pygame.key.get_pressed()
 
-        # Handle touch controls for movement - use a wrapper class to handle large key codes
-        if self.show_touch_controls:
-            # Create a wrapper that can handle any key code safely
-            class KeyWrapper:
-                def __init__(self, original_keys):
-                    self.keys = original_keys
-                    self.overrides = {}
-
-                def __getitem__(self, key):
-                    if key in self.overrides:
-                        return self.overrides[key]
-                    if key < len(self.keys):
-                        return self.keys[key]
-                    return 0
-
-            key_wrapper = KeyWrapper(keys)
-
-            # Player 1 controls
-            if self.touch_buttons['p1_left'].pressed:
-                key_wrapper.overrides[pygame.K_a] = 1
-            if self.touch_buttons['p1_right'].pressed:
-                key_wrapper.overrides[pygame.K_d] = 1
-            if self.touch_buttons['p1_up'].pressed:
-                key_wrapper.overrides[pygame.K_w] = 1
-            if self.touch_buttons['p1_down'].pressed:
-                key_wrapper.overrides[pygame.K_s] = 1
-
-            # Player 2 controls
-            if self.player2 and not self.player2.is_ai:
-                if self.touch_buttons['p2_left'].pressed:
-                    key_wrapper.overrides[pygame.K_LEFT] = 1
-                if self.touch_buttons['p2_right'].pressed:
-                    key_wrapper.overrides[pygame.K_RIGHT] = 1
-                if self.touch_buttons['p2_up'].pressed:
-                    key_wrapper.overrides[pygame.K_UP] = 1
-                if self.touch_buttons['p2_down'].pressed:
-                    key_wrapper.overrides[pygame.K_DOWN] = 1
-
-            keys = key_wrapper
-
         # Player 2 crosshair control - use IJKL to move crosshair (always active)
         if self.player2 and not self.player2.is_ai:
             aim_speed = 8
@@ -1235,90 +2642,193 @@ class PvPGame:
             self.p2_aim_x = max(0, min(self.p2_aim_x, SCREEN_WIDTH))
             self.p2_aim_y = max(0, min(self.p2_aim_y, SCREEN_HEIGHT))
 
-        # Normal movement for both players
-        self.player1.update(keys, self.caves, self.player2)
-        self.player2.update(keys, self.caves, self.player1)
-
-        # AI auto-attack with reaction time based on difficulty
-        if self.player2.is_ai and self.player2.alive and self.player1.alive:
-            # Reaction time delays
-            if self.ai_difficulty == 'easy':
-                attack_delay = 45  # Slow attacks
-            elif self.ai_difficulty == 'medium':
-                attack_delay = 25
-            else:  # hard
-                attack_delay = 10  # Very fast attacks
-
-            self.player2.ai_reaction_time += 1
-
-            if self.player2.attack_cooldown == 0 and self.player2.ai_reaction_time >= attack_delay:
-                # Calculate distance to player
-                dx = self.player1.x - self.player2.x
-                dy = self.player1.y - self.player2.y
-                dist = math.sqrt(dx**2 + dy**2)
-
-                weapon = WEAPONS[self.player2.weapon]
-                # Attack if in range
-                if dist <= weapon['range']:
-                    result = self.player2.attack(self.player1.x + 25, self.player1.y + 35)
-                    if isinstance(result, Projectile):
-                        self.projectiles.append(result)
-                    elif result == 'melee_hit':
-                        self.player1.take_damage(weapon['damage'])
-                    self.player2.ai_reaction_time = 0  # Reset reaction timer
+        # This tick's input for each player - held movement plus any queued attack
+        if self.replay_ticks is not None:
+            ticks = next(self.replay_ticks, None)
+            if ticks is None:
+                # Recording stopped before anyone won
+                self.end_replay()
+                self.state = 'menu'
+                return
+            p1_input, p2_input = ticks
+        else:
+            # An AI player ignores the keys anyway - record what was actually played
+            p1_input = NO_INPUT if self.player1.is_ai else self.take_input(1, keys)
+            if self.net_role == 'host':
+                self.host_receive()
+                p2_input = self.remote_input()
+            elif self.player2.is_ai:
+                p2_input = NO_INPUT
+            else:
+                p2_input = self.take_input(2, keys)
+            if self.recorder:
+                self.recorder.record(p1_input, p2_input)
+
+        # Players, AI, projectiles and gems
+        self.match.step(p1_input, p2_input)
+        if self.snapshots and (self.match.tick % net.SNAPSHOT_INTERVAL == 0 or self.match.over):
+            self.send_data({'t': 'snap', 'n': self.remote_inputs.applied, **self.snapshots.snapshot(self.match)},
+                           reliable=False)
+
+        # Projectile trails - a fading dot where each one was last tick
+        store = self.match.projectiles
+        n = store.count
+        if n:
+            self.particles.emit(store.prev_x[:n], store.prev_y[:n], 0.0, 0.0, 8, 4, store.color[:n],
+                                limit=TRAIL_BUDGET)
 
-        # Update projectiles
-        for proj in self.projectiles[:]:
-            proj.update()
-            if not proj.alive:
-                self.projectiles.remove(proj)
-                continue
+        # Check game over
+        if self.match.over:
+            self.state = 'game_over'
+            self.stop_recording()
+            self.end_replay()
+
+    def advance(self, frame_time):
+        """Run as many fixed ticks as the elapsed real time calls for"""
+        if self.state == 'loading':
+            self.loader.step()
+            if self.loader.done:
+                self.state = 'menu'
+            return
 
-            p1_rect = pygame.Rect(self.player1.x, self.player1.y, self.player1.width, self.player1.height)
-            p2_rect = pygame.Rect(self.player2.x, self.player2.y, self.player2.width, self.player2.height)
-            proj_rect = pygame.Rect(proj.x - proj.radius, proj.y - proj.radius, proj.radius * 2, proj.radius * 2)
+        self.accumulator += frame_time * self.time_scale
+        steps = 0
+        while self.accumulator >= SIM_DT and steps < MAX_CATCHUP_STEPS * self.time_scale:
+            self.update()
+            self.accumulator -= SIM_DT
+            steps += 1
 
-            # Only hit opponent, not the player who fired it
-            if p1_rect.colliderect(proj_rect) and proj.owner != self.player1:
-                self.player1.take_damage(proj.damage)
-                proj.alive = False
-            elif p2_rect.colliderect(proj_rect) and proj.owner != self.player2:
-                self.player2.take_damage(proj.damage)
-                proj.alive = False
+        # Too far behind - drop the backlog and slow down rather than spiral
+        if self.accumulator >= SIM_DT:
+            self.accumulator = 0.0
 
-        # Update gems
-        for cave in self.caves:
-            for gem in cave.gems:
-                gem.update()
-
-        # Check game over
-        if not self.player1.alive or not self.player2.alive:
-            self.state = 'game_over'
+        # Fraction of the next tick already elapsed, used to blend drawing
+        self.alpha = self.accumulator / SIM_DT if self.state == 'playing' else 1.0
 
     def draw(self):
-        self.screen.fill((30, 30, 50))
+        if self.auto_render_scale:
+            start = time.perf_counter()
+            self.render()
+            self.adapt_render_scale(time.perf_counter() - start)
+        else:
+            self.render()
+        if self.updated_rects is None:
+            pygame.display.flip()
+        elif self.updated_rects:
+            pygame.display.update(self.updated_rects)
+
+    def render(self):
+        """Draw the current frame to self.screen without presenting it.
+
+        Afterwards self.updated_rects lists the areas that changed, or is None
+        when the whole screen has to be presented.
+        """
+        self.updated_rects = None
+        # Dirty rects only work at full resolution - a scaled arena is presented whole
+        if self.dirty_rendering and self.canvas is self.screen:
+            key = (self.state, self.select_phase, self.connected, self.match, self.screen.get_size(),
+                   self.render_scale, len(self.loader.pending))
+            if key == self.render_key:
+                if self.state == 'playing':
+                    self.render_dirty()
+                    return
+                if not self.had_events:
+                    # Menus, setup and the game over screen are static between inputs
+                    self.updated_rects = []
+                    return
+            self.render_key = key
+            self.had_events = False
+
+        if self.state in ('playing', 'game_over'):
+            # New world or new render resolution - the cached layer is stale
+            if (self.background_match is not self.match or
+                    self.background.get_size() != self.canvas.get_size()):
+                self.build_background()
+            self.canvas.blit(self.background, (0, 0))
+        else:
+            self.screen.fill((30, 30, 50))
 
-        if self.state == 'menu':
+        # Start tracking drawn areas afresh for render_dirty
+        tracking = self.dirty_rendering and self.canvas is self.screen
+        self.moving_rects = []
+        overlays = [] if tracking else None
+
+        if self.state == 'loading':
+            self.draw_loading()
+        elif self.state == 'menu':
             self.draw_menu()
         elif self.state == 'setup':
             self.draw_setup()
         elif self.state == 'playing':
-            self.draw_game()
+            self.draw_game(self.moving_rects if tracking else None, overlays)
         elif self.state == 'game_over':
             self.draw_game()
             self.draw_game_over()
 
-        pygame.display.flip()
+        if overlays is not None:
+            self.overlay_looks = {tuple(rect): look for rect, look in overlays}
+            self.drawn_rects = self.moving_rects + [rect for rect, look in overlays]
+
+    def render_dirty(self):
+        """Redraw only what moved or changed since the last frame.
+
+        Everything drawn over the background last frame is restored from the
+        cached background layer, then the game is drawn again on top. The screen
+        surface ends up exactly as a full render would leave it, but only the old
+        and new positions of moving things, plus HUD pieces whose look changed,
+        need presenting.
+        """
+        background = self.background
+        for rect in self.drawn_rects:
+            self.screen.blit(background, rect, rect)
+
+        moving = []
+        overlays = []
+        self.draw_game(moving, overlays)
+
+        updated = self.moving_rects + moving
+        looks = {tuple(rect): look for rect, look in overlays}
+        for rect, look in self.overlay_looks.items():
+            if looks.get(rect) is not look:
+                updated.append(rect)  # Changed or gone
+        for rect, look in looks.items():
+            if rect not in self.overlay_looks:
+                updated.append(rect)  # Newly shown
+
+        self.overlay_looks = looks
+        self.moving_rects = moving
+        self.drawn_rects = moving + [rect for rect, look in overlays]
+        self.updated_rects = updated if len(updated) <= DIRTY_RECT_LIMIT else None
+
+    def draw_overlay(self, surface, pos, overlays):
+        # HUD pieces stay put, so render_dirty only presents them when they change
+        rect = self.screen.blit(surface, pos)
+        if overlays is not None:
+            overlays.append((rect, surface))
+
+    def draw_loading(self):
+        title = TextCache.render("PvP BATTLE ARENA", self.font, YELLOW)
+        self.screen.blit(title, (SCREEN_WIDTH // 2 - 250, 150))
+
+        # Progress bar
+        bar = pygame.Rect(SCREEN_WIDTH // 2 - 200, SCREEN_HEIGHT // 2, 400, 30)
+        pygame.draw.rect(self.screen, DARK_GRAY, bar)
+        pygame.draw.rect(self.screen, GREEN, (bar.x, bar.y, int(bar.width * self.loader.progress), bar.height))
+        pygame.draw.rect(self.screen, WHITE, bar, 2)
+
+        loaded = self.loader.total - len(self.loader.pending)
+        text = TextCache.render(f"Loading... {loaded}/{self.loader.total}", self.tiny_font, WHITE)
+        self.screen.blit(text, (bar.x, bar.y + 45))
 
     def draw_menu(self):
-        title = self.font.render("PvP BATTLE ARENA", True, YELLOW)
+        title = TextCache.render("PvP BATTLE ARENA", self.font, YELLOW)
         self.screen.blit(title, (SCREEN_WIDTH // 2 - 250, 150))
 
-        subtitle = self.small_font.render("With Weapons, Armor & Healing Gems!", True, WHITE)
+        subtitle = TextCache.render("With Weapons, Armor & Healing Gems!", self.small_font, WHITE)
         self.screen.blit(subtitle, (SCREEN_WIDTH // 2 - 300, 230))
 
         # Mode selection
-        mode_title = self.small_font.render("Choose Game Mode:", True, WHITE)
+        mode_title = TextCache.render("Choose Game Mode:", self.small_font, WHITE)
         self.screen.blit(mode_title, (SCREEN_WIDTH // 2 - 160, 320))
 
         # Draw touch buttons for menu
@@ -1326,13 +2836,13 @@ class PvPGame:
             button.draw(self.screen, self.small_font)
 
         # Also show keyboard shortcuts on the side
-        mode_1 = self.tiny_font.render("Press 1", True, GRAY)
+        mode_1 = TextCache.render("Press 1", self.tiny_font, GRAY)
         self.screen.blit(mode_1, (SCREEN_WIDTH // 2 + 230, 470))
 
-        mode_2 = self.tiny_font.render("Press 2", True, GRAY)
+        mode_2 = TextCache.render("Press 2", self.tiny_font, GRAY)
         self.screen.blit(mode_2, (SCREEN_WIDTH // 2 + 230, 560))
 
-        mode_3 = self.tiny_font.render("Press 3", True, GRAY)
+        mode_3 = TextCache.render("Press 3", self.tiny_font, GRAY)
         self.screen.blit(mode_3, (SCREEN_WIDTH // 2 + 230, 650))
 
         info = [
@@ -1348,24 +2858,25 @@ class PvPGame:
 
         y = 720
         for line in info:
-            text = self.tiny_font.render(line, True, GRAY)
+            text = TextCache.render(line, self.tiny_font, GRAY)
             self.screen.blit(text, (SCREEN_WIDTH // 2 - 250, y))
             y += 25
 
     def draw_setup(self):
         # Online mode selection
         if self.select_phase == 'online_mode':
-            title = self.font.render("Around The World Mode", True, GREEN)
+            title = TextCache.render("Around The World Mode", self.font, GREEN)
             self.screen.blit(title, (SCREEN_WIDTH // 2 - 300, 50))
 
-            subtitle = self.small_font.render("Choose how to connect:", True, WHITE)
+            subtitle = TextCache.render("Choose how to connect:", self.small_font, WHITE)
             self.screen.blit(subtitle, (SCREEN_WIDTH // 2 - 180, 150))
 
             # Create buttons if not already created for this phase
             if self.last_setup_phase != 'online_mode':
-                self.create_setup_buttons('online_mode', 2, [YELLOW, BLUE])
-                self.setup_buttons[0].text = "HOST GAME"
-                self.setup_buttons[1].text = "JOIN GAME"
+                self.create_setup_buttons('online_mode', 3, [GREEN, YELLOW, BLUE])
+                self.setup_buttons[0].text = "QUICK MATCH"
+                self.setup_buttons[1].text = "HOST GAME"
+                self.setup_buttons[2].text = "JOIN GAME"
                 self.last_setup_phase = 'online_mode'
 
             # Draw buttons
@@ -1373,35 +2884,62 @@ class PvPGame:
                 button.draw(self.screen, self.small_font)
 
             # Draw descriptions below buttons
-            host_desc = self.tiny_font.render("Create a game and share your IP with a friend", True, GRAY)
-            self.screen.blit(host_desc, (SCREEN_WIDTH // 2 - 250, 330))
+            quick_desc = TextCache.render("Play whoever is looking for a game right now", self.tiny_font, GRAY)
+            self.screen.blit(quick_desc, (SCREEN_WIDTH // 2 - 250, 330))
+
+            host_desc = TextCache.render("Create a game and share your IP with a friend", self.tiny_font, GRAY)
+            self.screen.blit(host_desc, (SCREEN_WIDTH // 2 - 250, 480))
 
-            join_desc = self.tiny_font.render("Enter your friend's IP address to join their game", True, GRAY)
-            self.screen.blit(join_desc, (SCREEN_WIDTH // 2 - 250, 480))
+            join_desc = TextCache.render("Enter your friend's IP address to join their game", self.tiny_font, GRAY)
+            self.screen.blit(join_desc, (SCREEN_WIDTH // 2 - 250, 630))
 
             # Show keyboard hints
-            hint1 = self.tiny_font.render("Press 1", True, GRAY)
-            self.screen.blit(hint1, (SCREEN_WIDTH // 2 + 270, 270))
-            hint2 = self.tiny_font.render("Press 2", True, GRAY)
-            self.screen.blit(hint2, (SCREEN_WIDTH // 2 + 270, 420))
+            for i in range(3):
+                hint = TextCache.render(f"Press {i + 1}", self.tiny_font, GRAY)
+                self.screen.blit(hint, (SCREEN_WIDTH // 2 + 270, 270 + i * 150))
+            return
+
+        # Quick match - queued with the matchmaker
+        if self.select_phase == 'matchmaking':
+            title = TextCache.render("Quick Match", self.font, GREEN)
+            self.screen.blit(title, (SCREEN_WIDTH // 2 - 160, 150))
+
+            if self.match_found:
+                status = "Opponent found - waiting for them to connect..."
+            else:
+                status = f"Looking for an opponent... ({self.queue_size} in your queue)"
+            status_text = TextCache.render(status, self.small_font, WHITE)
+            self.screen.blit(status_text, (SCREEN_WIDTH // 2 - 320, 300))
+
+            weapons = {'melee_only': 'Melee only', 'ranged_only': 'Ranged only', 'any': 'Any weapon'}[self.weapon_mode]
+            netcode = "ROLLBACK" if self.rollback_netcode else "SNAPSHOTS"
+            settings = TextCache.render(f"{weapons} - Netcode: {netcode} - press R to switch", self.tiny_font, PURPLE)
+            self.screen.blit(settings, (SCREEN_WIDTH // 2 - 250, 460))
+
+            esc_hint = TextCache.render("Press ESC to cancel and return to menu", self.tiny_font, RED)
+            self.screen.blit(esc_hint, (SCREEN_WIDTH // 2 - 180, 520))
             return
 
         # Waiting for player
         if self.select_phase == 'waiting_for_player':
-            title = self.font.render("Waiting for Player...", True, YELLOW)
+            title = TextCache.render("Waiting for Player...", self.font, YELLOW)
             self.screen.blit(title, (SCREEN_WIDTH // 2 - 280, 150))
 
-            ip_text = self.small_font.render(f"Your IP Address: {self.host_ip}", True, GREEN)
+            ip_text = TextCache.render(f"Your IP Address: {self.host_ip}", self.small_font, GREEN)
             self.screen.blit(ip_text, (SCREEN_WIDTH // 2 - 200, 300))
 
-            instruction = self.small_font.render("Share this IP with your friend!", True, WHITE)
+            instruction = TextCache.render("Share this IP with your friend!", self.small_font, WHITE)
             self.screen.blit(instruction, (SCREEN_WIDTH // 2 - 250, 380))
 
-            waiting = self.tiny_font.render("Waiting for connection...", True, GRAY)
+            waiting = TextCache.render("Waiting for connection...", self.tiny_font, GRAY)
             self.screen.blit(waiting, (SCREEN_WIDTH // 2 - 120, 460))
 
+            netcode = "ROLLBACK (both run the match)" if self.rollback_netcode else "SNAPSHOTS (you run the match)"
+            netcode_text = TextCache.render(f"Netcode: {netcode} - press R to switch", self.tiny_font, PURPLE)
+            self.screen.blit(netcode_text, (SCREEN_WIDTH // 2 - 250, 490))
+
             # Add ESC hint
-            esc_hint = self.tiny_font.render("Press ESC to cancel and return to menu", True, RED)
+            esc_hint = TextCache.render("Press ESC to cancel and return to menu", self.tiny_font, RED)
             self.screen.blit(esc_hint, (SCREEN_WIDTH // 2 - 180, 520))
 
             # Check if connected
@@ -1409,23 +2947,36 @@ class PvPGame:
                 self.select_phase = 'weapon_mode'
             return
 
+        # Joined - the host picks the weapons and starts the match
+        if self.select_phase == 'waiting_for_host':
+            via = self.connection.name.upper() if self.connection else ''
+            title = TextCache.render(f"Connected over {via}!", self.font, GREEN)
+            self.screen.blit(title, (SCREEN_WIDTH // 2 - 260, 150))
+
+            waiting = TextCache.render("Waiting for the host to choose loadouts...", self.small_font, WHITE)
+            self.screen.blit(waiting, (SCREEN_WIDTH // 2 - 280, 300))
+
+            esc_hint = TextCache.render("Press ESC to cancel and return to menu", self.tiny_font, RED)
+            self.screen.blit(esc_hint, (SCREEN_WIDTH // 2 - 180, 520))
+            return
+
         # Enter IP screen
         if self.select_phase == 'enter_ip':
-            title = self.font.render("Join Game", True, BLUE)
+            title = TextCache.render("Join Game", self.font, BLUE)
             self.screen.blit(title, (SCREEN_WIDTH // 2 - 150, 100))
 
-            instruction = self.small_font.render("Enter Host IP Address:", True, WHITE)
+            instruction = TextCache.render("Enter Host IP Address:", self.small_font, WHITE)
             self.screen.blit(instruction, (SCREEN_WIDTH // 2 - 200, 250))
 
             # Draw input box
             input_box = pygame.Rect(SCREEN_WIDTH // 2 - 200, 320, 400, 50)
             pygame.draw.rect(self.screen, WHITE, input_box, 3)
 
-            ip_display = self.font.render(self.host_ip if self.host_ip else '___.___.___', True, YELLOW if self.host_ip else GRAY)
+            ip_display = TextCache.render(self.host_ip if self.host_ip else '___.___.___', self.font, YELLOW if self.host_ip else GRAY)
             self.screen.blit(ip_display, (SCREEN_WIDTH // 2 - 190, 330))
 
-            hint = self.tiny_font.render("Use keyboard below or type with keyboard", True, GRAY)
-            self.screen.blit(hint, (SCREEN_WIDTH // 2 - 180, 400))
+            hint = TextCache.render("Use keyboard below or type with keyboard (TAB switches UDP/TCP)", self.tiny_font, GRAY)
+            self.screen.blit(hint, (SCREEN_WIDTH // 2 - 280, 400))
 
             # Draw on-screen keyboard
             for button in self.keyboard_buttons:
@@ -1435,7 +2986,7 @@ class PvPGame:
 
         # Weapon mode selection
         if self.select_phase == 'weapon_mode':
-            title = self.font.render("Choose Weapon Type", True, YELLOW)
+            title = TextCache.render("Choose Weapon Type", self.font, YELLOW)
             self.screen.blit(title, (SCREEN_WIDTH // 2 - 250, 50))
 
             modes = [
@@ -1460,18 +3011,18 @@ class PvPGame:
 
                 # Draw description below button
                 name, desc, color = modes[i]
-                desc_text = self.tiny_font.render(desc, True, GRAY)
+                desc_text = TextCache.render(desc, self.tiny_font, GRAY)
                 self.screen.blit(desc_text, (SCREEN_WIDTH // 2 - 250, y + 85))
 
                 # Keyboard hint
-                hint = self.tiny_font.render(f"Press {i+1}", True, GRAY)
+                hint = TextCache.render(f"Press {i+1}", self.tiny_font, GRAY)
                 self.screen.blit(hint, (SCREEN_WIDTH // 2 + 270, y + 25))
                 y += 150
             return
 
         # Difficulty selection
         if self.select_phase == 'ai_difficulty':
-            title = self.font.render("Choose AI Difficulty", True, YELLOW)
+            title = TextCache.render("Choose AI Difficulty", self.font, YELLOW)
             self.screen.blit(title, (SCREEN_WIDTH // 2 - 250, 50))
 
             difficulties = [
@@ -1496,26 +3047,26 @@ class PvPGame:
 
                 # Draw description below button
                 name, desc, color = difficulties[i]
-                desc_text = self.tiny_font.render(desc, True, GRAY)
+                desc_text = TextCache.render(desc, self.tiny_font, GRAY)
                 self.screen.blit(desc_text, (SCREEN_WIDTH // 2 - 200, y + 85))
 
                 # Keyboard hint
-                hint = self.tiny_font.render(f"Press {i+1}", True, GRAY)
+                hint = TextCache.render(f"Press {i+1}", self.tiny_font, GRAY)
                 self.screen.blit(hint, (SCREEN_WIDTH // 2 + 270, y + 25))
                 y += 150
             return
 
         if 'p1' in self.select_phase:
-            title = self.font.render("Player 1 Setup", True, RED)
+            title = TextCache.render("Player 1 Setup", self.font, RED)
             player_color = RED
         else:
-            title = self.font.render("Player 2 Setup", True, BLUE)
+            title = TextCache.render("Player 2 Setup", self.font, BLUE)
             player_color = BLUE
 
         self.screen.blit(title, (SCREEN_WIDTH // 2 - 200, 50))
 
         if 'weapon' in self.select_phase:
-            subtitle = self.small_font.render("Choose Your Weapon:", True, WHITE)
+            subtitle = TextCache.render("Choose Your Weapon:", self.small_font, WHITE)
             self.screen.blit(subtitle, (SCREEN_WIDTH // 2 - 180, 150))
 
             # Get available weapons based on mode
@@ -1541,16 +3092,16 @@ class PvPGame:
                 weapon = WEAPONS[weapon_key]
                 weapon_type = "Ranged" if weapon.get('projectile', False) else "Melee"
                 desc = f"({weapon_type}, DMG: {weapon['damage']}, Range: {weapon['range']})"
-                desc_text = self.tiny_font.render(desc, True, GRAY)
+                desc_text = TextCache.render(desc, self.tiny_font, GRAY)
                 self.screen.blit(desc_text, (SCREEN_WIDTH // 2 - 220, y + 85))
 
                 # Keyboard hint
-                hint = self.tiny_font.render(f"Press {i+1}", True, GRAY)
+                hint = TextCache.render(f"Press {i+1}", self.tiny_font, GRAY)
                 self.screen.blit(hint, (SCREEN_WIDTH // 2 + 270, y + 25))
                 y += 130
 
         else:  # armor
-            subtitle = self.small_font.render("Choose Your Armor:", True, WHITE)
+            subtitle = TextCache.render("Choose Your Armor:", self.small_font, WHITE)
             self.screen.blit(subtitle, (SCREEN_WIDTH // 2 - 180, 150))
 
             # Create buttons for armor
@@ -1571,34 +3122,46 @@ class PvPGame:
                 # Draw armor details below button
                 key, armor = armor_list[i]
                 desc = f"(DMG Reduction: {int((1-armor['defense'])*100)}%, Speed: {int(armor['speed_mult']*100)}%)"
-                desc_text = self.tiny_font.render(desc, True, GRAY)
+                desc_text = TextCache.render(desc, self.tiny_font, GRAY)
                 self.screen.blit(desc_text, (SCREEN_WIDTH // 2 - 220, y + 85))
 
                 # Keyboard hint
-                hint = self.tiny_font.render(f"Press {i+1}", True, GRAY)
+                hint = TextCache.render(f"Press {i+1}", self.tiny_font, GRAY)
                 self.screen.blit(hint, (SCREEN_WIDTH // 2 + 270, y + 25))
                 y += 130
 
-    def draw_game(self):
-        # Grid
-        for x in range(0, SCREEN_WIDTH, 50):
-            pygame.draw.line(self.screen, (40, 40, 60), (x, 0), (x, SCREEN_HEIGHT), 1)
-        for y in range(0, SCREEN_HEIGHT, 50):
-            pygame.draw.line(self.screen, (40, 40, 60), (0, y), (SCREEN_WIDTH, y), 1)
+    def draw_game(self, rects=None, overlays=None):
+        """Draw everything over the background layer blitted in render(). For
+        render_dirty, areas of moving things are appended to rects and HUD
+        pieces to overlays.
 
-        # Caves
+        The arena is drawn on self.canvas at self.render_scale and, when that is
+        a low-resolution target, scaled up into the frame in one go. The
+        crosshair and HUD are drawn afterwards at full resolution, so they stay
+        sharp and keep using screen coordinates for input.
+        """
+        canvas = self.canvas
+        scale = self.render_scale
+
+        # Gems
         for cave in self.caves:
-            cave.draw(self.screen)
+            cave.draw(canvas, rects, scale)
+        self.particles.draw_sparkles(canvas, self.caves, scale)
 
-        # Projectiles
-        for proj in self.projectiles:
-            proj.draw(self.screen)
+        # Projectiles, then trails and sparks
+        if self.match:
+            self.match.projectiles.draw(canvas, self.alpha, rects, scale)
+        self.particles.draw(canvas, scale, rects)
 
         # Players
-        if self.player1:
-            self.player1.draw(self.screen)
-        if self.player2:
-            self.player2.draw(self.screen)
+        for player in (self.player1, self.player2):
+            if player:
+                player.draw(canvas, self.alpha, scale)
+                if rects is not None:
+                    rects.append(player.bounds(self.alpha))
+
+        if canvas is not self.screen:
+            pygame.transform.scale(canvas, self.screen.get_size(), self.screen)
 
         # Player 2 aiming crosshair - always visible and active for Player 2
         if self.player2 and not self.player2.is_ai:
@@ -1621,32 +3184,39 @@ class PvPGame:
                            (self.p2_aim_x, self.p2_aim_y - crosshair_size), line_width)
             pygame.draw.line(self.screen, outer_color, (self.p2_aim_x, self.p2_aim_y + crosshair_size),
                            (self.p2_aim_x, self.p2_aim_y + crosshair_size + 5), line_width)
+            if rects is not None:
+                reach = crosshair_size + 8
+                rects.append(pygame.Rect(int(self.p2_aim_x) - reach, int(self.p2_aim_y) - reach,
+                                         reach * 2 + 1, reach * 2 + 1))
 
         # Always draw the toggle button
-        self.touch_toggle_button.draw(self.screen, self.tiny_font)
+        toggle = self.touch_toggle_button
+        self.draw_overlay(toggle.face(self.tiny_font), toggle.rect, overlays)
 
         # Touch controls
         if self.show_touch_controls:
             # Draw Player 1 controls
             for key in ['p1_left', 'p1_right', 'p1_up', 'p1_down', 'p1_attack']:
-                self.touch_buttons[key].draw(self.screen, self.tiny_font)
+                button = self.touch_buttons[key]
+                self.draw_overlay(button.face(self.tiny_font), button.rect, overlays)
 
             # Only draw Player 2 controls if not playing against AI (check game mode)
             if self.game_mode != 'ai':
                 for key in ['p2_left', 'p2_right', 'p2_up', 'p2_down', 'p2_attack']:
-                    self.touch_buttons[key].draw(self.screen, self.tiny_font)
+                    button = self.touch_buttons[key]
+                    self.draw_overlay(button.face(self.tiny_font), button.rect, overlays)
 
         # HUD
         hint_text = "Find healing gems in caves! ESC: Menu"
-        hint = self.tiny_font.render(hint_text, True, GRAY)
-        self.screen.blit(hint, (10, SCREEN_HEIGHT - 30))
+        hint = TextCache.render(hint_text, self.tiny_font, GRAY)
+        self.draw_overlay(hint, (10, SCREEN_HEIGHT - 30), overlays)
 
         if self.show_touch_controls:
-            touch_status = self.tiny_font.render("Touch Controls: ON", True, GREEN)
-            self.screen.blit(touch_status, (SCREEN_WIDTH // 2 - 80, 55))
+            touch_status = TextCache.render("Touch Controls: ON", self.tiny_font, GREEN)
+            self.draw_overlay(touch_status, (SCREEN_WIDTH // 2 - 80, 55), overlays)
         else:
-            touch_status = self.tiny_font.render("Touch Controls: OFF", True, RED)
-            self.screen.blit(touch_status, (SCREEN_WIDTH // 2 - 85, 55))
+            touch_status = TextCache.render("Touch Controls: OFF", self.tiny_font, RED)
+            self.draw_overlay(touch_status, (SCREEN_WIDTH // 2 - 85, 55), overlays)
 
     def draw_game_over(self):
         overlay = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
@@ -1656,30 +3226,40 @@ class PvPGame:
 
         if self.player1.alive:
             if self.game_mode == 'ai':
-                winner = self.font.render("YOU WIN!", True, RED)
+                winner = TextCache.render("YOU WIN!", self.font, RED)
             else:
-                winner = self.font.render("PLAYER 1 WINS!", True, RED)
+                winner = TextCache.render("PLAYER 1 WINS!", self.font, RED)
         else:
             if self.game_mode == 'ai':
-                winner = self.font.render("AI WINS!", True, BLUE)
+                winner = TextCache.render("AI WINS!", self.font, BLUE)
             else:
-                winner = self.font.render("PLAYER 2 WINS!", True, BLUE)
+                winner = TextCache.render("PLAYER 2 WINS!", self.font, BLUE)
 
         self.screen.blit(winner, (SCREEN_WIDTH // 2 - 250, SCREEN_HEIGHT // 2 - 50))
 
-        restart = self.small_font.render("SPACE: Rematch  |  ENTER: Menu", True, WHITE)
+        restart = TextCache.render("SPACE: Rematch  |  ENTER: Menu", self.small_font, WHITE)
         self.screen.blit(restart, (SCREEN_WIDTH // 2 - 280, SCREEN_HEIGHT // 2 + 50))
 
     def run(self):
         while self.running:
+            # FPS only caps rendering - the simulation runs at SIM_HZ regardless
+            frame_time = self.clock.tick(FPS) / 1000.0
             self.handle_events()
-            self.update()
+            self.advance(frame_time)
             self.draw()
-            self.clock.tick(FPS)
+        self.stop_recording()
         pygame.quit()
 
 def main():
+    parser = argparse.ArgumentParser(description="PvP Battle Arena")
+    parser.add_argument('--record', action='store_true', help=f"save a replay of every match to {REPLAY_DIR}")
+    parser.add_argument('--matchmaker', default=MATCHMAKER_HOST, metavar='HOST',
+                        help=f"address of the matchmaking service for QUICK MATCH (default {MATCHMAKER_HOST})")
+    args = parser.parse_args()
+
     game = PvPGame()
+    game.record_replays = args.record or RECORD_REPLAYS
+    game.matchmaker_host = args.matchmaker
     game.run()
 
 if __name__ == '__main__':
@@ -9,7 +9,7 @@ def show_mac_instructions():
 ```bash
 git clone https://huggingface.co/spaces/ethan-codecub/PvP-Battle
 cd PvP-Battle
-pip3 install pygame
+pip3 install pygame numpy
 python3 PvP.py
 ```
 
@@ -24,7 +24,7 @@ def show_windows_instructions():
 ```bash
 git clone https://huggingface.co/spaces/ethan-codecub/PvP-Battle
 cd PvP-Battle
-pip install pygame
+pip install pygame numpy
 python PvP.py
 ```
 
@@ -0,0 +1,134 @@
+# Balance sweep for PvP Battle Arena
+# Plays headless AI-vs-AI matches for every weapon x armor x difficulty combination
+# across a process pool and writes win rates, time-to-kill and damage to a CSV file.
+#
+# Usage: python3 balance_sweep.py --matches 15 --out balance.csv
+
+import argparse
+import csv
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Workers never open a window
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from PvP import Match, WEAPONS, ARMOR_TYPES, SIM_HZ
+
+DIFFICULTIES = ['easy', 'medium', 'hard']
+
+CSV_FIELDS = [
+    'difficulty', 'p1_weapon', 'p1_armor', 'p2_weapon', 'p2_armor',
+    'matches', 'p1_wins', 'p2_wins', 'draws', 'p1_win_rate',
+    'avg_time_to_kill', 'avg_p1_damage', 'avg_p2_damage',
+]
+
+
+def all_matchups():
+    """Every (difficulty, p1 loadout, p2 loadout) combination"""
+    loadouts = list(itertools.product(WEAPONS.keys(), ARMOR_TYPES.keys()))
+    for difficulty in DIFFICULTIES:
+        for (w1, a1), (w2, a2) in itertools.product(loadouts, loadouts):
+            yield (difficulty, w1, a1, w2, a2)
+
+
+def play_matchup(matchup, matches, seed, max_ticks):
+    """Play one matchup several times - runs inside a worker process.
+
+    Returns totals rather than per-match rows so each task sends one small
+    result back to the parent, keeping pickling overhead off the hot path.
+    """
+    difficulty, w1, a1, w2, a2 = matchup
+    p1_wins = p2_wins = draws = 0
+    ttk_ticks = 0
+    p1_damage = p2_damage = 0
+
+    for i in range(matches):
+        match = Match.headless(w1, a1, w2, a2, ai_difficulty=difficulty, seed=seed + i)
+        match.run(max_ticks)
+
+        winner = match.winner
+        if winner is None:
+            draws += 1
+        else:
+            ttk_ticks += match.tick
+            if winner is match.player1:
+                p1_wins += 1
+            else:
+                p2_wins += 1
+        p1_damage += match.player1.damage_dealt
+        p2_damage += match.player2.damage_dealt
+
+    return matchup, (p1_wins, p2_wins, draws, ttk_ticks, p1_damage, p2_damage)
+
+
+def summarize(matchup, totals, matches):
+    difficulty, w1, a1, w2, a2 = matchup
+    p1_wins, p2_wins, draws, ttk_ticks, p1_damage, p2_damage = totals
+    decided = p1_wins + p2_wins
+    return {
+        'difficulty': difficulty,
+        'p1_weapon': w1, 'p1_armor': a1,
+        'p2_weapon': w2, 'p2_armor': a2,
+        'matches': matches,
+        'p1_wins': p1_wins, 'p2_wins': p2_wins, 'draws': draws,
+        'p1_win_rate': round(p1_wins / matches, 4),
+        # Seconds of game time, only over matches that had a winner
+        'avg_time_to_kill': round(ttk_ticks / decided / SIM_HZ, 3) if decided else '',
+        'avg_p1_damage': round(p1_damage / matches, 2),
+        'avg_p2_damage': round(p2_damage / matches, 2),
+    }
+
+
+def run_sweep(matches, out_path, workers=None, seed=0, max_ticks=SIM_HZ * 120):
+    matchups = list(all_matchups())
+    total = len(matchups) * matches
+    print(f"Running {total} matches ({len(matchups)} matchups x {matches}) "
+          f"on {workers or os.cpu_count()} workers")
+
+    start = time.perf_counter()
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Each matchup gets its own seed range so results are repeatable
+        futures = [pool.submit(play_matchup, matchup, matches, seed + i * matches, max_ticks)
+                   for i, matchup in enumerate(matchups)]
+        for done, future in enumerate(as_completed(futures), 1):
+            matchup, totals = future.result()
+            rows.append(summarize(matchup, totals, matches))
+            if done % 50 == 0 or done == len(futures):
+                print(f"  {done}/{len(futures)} matchups done")
+
+    # Stable output order regardless of completion order
+    rows.sort(key=lambda r: (DIFFICULTIES.index(r['difficulty']), r['p1_weapon'],
+                             r['p1_armor'], r['p2_weapon'], r['p2_armor']))
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {len(rows)} rows to {out_path} in {elapsed:.1f}s "
+          f"({total / elapsed:.0f} matches/s)")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI-vs-AI balance sweep for PvP Battle Arena")
+    parser.add_argument('--matches', type=int, default=15,
+                        help="matches per matchup (675 matchups, default 15 = ~10k matches)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes (default: one per CPU core)")
+    parser.add_argument('--seed', type=int, default=0, help="base random seed")
+    parser.add_argument('--max-seconds', type=int, default=120,
+                        help="game seconds before a match counts as a draw")
+    parser.add_argument('--out', default='balance.csv', help="output CSV path")
+    args = parser.parse_args()
+
+    run_sweep(args.matches, args.out, workers=args.workers, seed=args.seed,
+              max_ticks=args.max_seconds * SIM_HZ)
+
+
+if __name__ == '__main__':
+    main()
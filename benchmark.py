@@ -0,0 +1,267 @@
+# Performance benchmarks for PvP Battle Arena
+# Runs scripted scenarios through PvPGame.update and PvPGame.render (to an offscreen
+# surface) and reports per-tick update time, per-frame draw time, allocation churn
+# and p50/p99 latencies. Results are written as JSON so runs can be compared.
+#
+# Usage: python3 benchmark.py --out bench.json
+#        python3 benchmark.py --out new.json --compare bench.json
+
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import numpy as np
+import pygame
+
+import PvP
+from PvP import (PvPGame, SCREEN_WIDTH, SCREEN_HEIGHT, INPUT_LEFT, INPUT_RIGHT,
+                 INPUT_UP, INPUT_DOWN, INPUT_FIRE, NO_INPUT)
+
+
+def new_game(p1_weapon='sword', p2_weapon='sword', game_mode='2p', difficulty='medium'):
+    """A PvPGame in the middle of a match, drawing to an offscreen surface"""
+    PvP.RECORD_REPLAYS = False
+    game = PvPGame(screen=pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)))
+    game.game_mode = game_mode
+    game.ai_difficulty = difficulty
+    game.p1_weapon = p1_weapon
+    game.p2_weapon = p2_weapon
+    game.reset_game(seed=1234)
+    game.state = 'playing'
+    return game
+
+
+def keep_alive(game):
+    # Scenarios measure steady state, so nobody is allowed to win
+    for player in (game.player1, game.player2):
+        player.health = player.max_health
+        player.alive = True
+
+
+def idle_arena():
+    game = new_game()
+    game.take_input = lambda number, keys: NO_INPUT
+    return game, keep_alive
+
+
+def duel():
+    """Two scripted players - P1 chases and shoots, P2 strafes and shoots back"""
+    game = new_game('gun', 'magic')
+
+    def scripted(number, keys):
+        me = game.player1 if number == 1 else game.player2
+        other = game.player2 if number == 1 else game.player1
+        tick = game.match.tick
+        if number == 1:
+            buttons = INPUT_RIGHT if other.x > me.x + 200 else INPUT_LEFT
+        else:
+            buttons = INPUT_UP if (tick // 45) % 2 else INPUT_DOWN
+        if tick % 20 == number * 5:
+            return (buttons | INPUT_FIRE, (int(other.x + 25), int(other.y + 35)))
+        return (buttons, None)
+
+    game.take_input = scripted
+    return game, keep_alive
+
+
+def duel_dirty_rects():
+    """The duel drawn with dirty-rect rendering"""
+    game, driver = duel()
+    game.dirty_rendering = True
+    return game, driver
+
+
+def duel_half_res():
+    """The duel with the arena drawn at half resolution and scaled up"""
+    game, driver = duel()
+    game.set_render_scale(0.5)
+    return game, driver
+
+
+def projectile_storm(count=500):
+    """Keeps `count` projectiles alive, bouncing around the arena"""
+    game = new_game()
+    game.take_input = lambda number, keys: NO_INPUT
+    rng = np.random.default_rng(1)
+
+    def top_up(game):
+        keep_alive(game)
+        store = game.match.projectiles
+        while store.count < count:
+            angle = rng.uniform(0, 2 * math.pi)
+            store.spawn(rng.uniform(0, SCREEN_WIDTH), rng.uniform(0, SCREEN_HEIGHT),
+                        math.cos(angle) * 15, math.sin(angle) * 15, 20,
+                        (138, 43, 226), int(rng.integers(0, 2)), lifetime=1000)
+
+    return game, top_up
+
+
+def gems_respawning():
+    """Every gem collected as soon as it respawns, so all timers are running"""
+    game = new_game()
+    game.take_input = lambda number, keys: NO_INPUT
+
+    def collect_all(game):
+        keep_alive(game)
+        for cave in game.caves:
+            for gem in cave.gems:
+                gem.collected = True
+
+    return game, collect_all
+
+
+def touch_controls():
+    game, driver = duel()
+    game.show_touch_controls = True
+    game.touch_buttons['p1_left'].pressed = True
+    return game, driver
+
+
+def ai_vs_ai_hard():
+    game = new_game('bow', 'axe', game_mode='ai', difficulty='hard')
+    game.player1.is_ai = True
+    game.player1.ai_difficulty = 'hard'
+    game.take_input = lambda number, keys: NO_INPUT
+    return game, keep_alive
+
+
+SCENARIOS = {
+    'idle_arena': idle_arena,
+    'duel': duel,
+    'duel_dirty_rects': duel_dirty_rects,
+    'duel_half_res': duel_half_res,
+    'projectiles_500': projectile_storm,
+    'gems_respawning': gems_respawning,
+    'touch_controls': touch_controls,
+    'ai_vs_ai_hard': ai_vs_ai_hard,
+}
+
+
+def summarize(samples_ns):
+    us = np.array(samples_ns) / 1000.0
+    return {
+        'mean_us': round(float(us.mean()), 2),
+        'p50_us': round(float(np.percentile(us, 50)), 2),
+        'p99_us': round(float(np.percentile(us, 99)), 2),
+        'max_us': round(float(us.max()), 2),
+    }
+
+
+def run_scenario(name, frames, warmup):
+    game, driver = SCENARIOS[name]()
+    clock = time.perf_counter_ns
+
+    for _ in range(warmup):
+        driver(game)
+        game.update()
+        game.render()
+
+    update_times = []
+    draw_times = []
+    gc_before = gc.get_stats()[0]['collections']
+    for _ in range(frames):
+        driver(game)
+        start = clock()
+        game.update()
+        mid = clock()
+        game.render()
+        end = clock()
+        update_times.append(mid - start)
+        draw_times.append(end - mid)
+    gc_collections = gc.get_stats()[0]['collections'] - gc_before
+
+    # Allocation pass on its own - tracing slows everything down, so it isn't timed
+    alloc_frames = min(frames, 300)
+    tracemalloc.start()
+    base_current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    blocks_before = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    for _ in range(alloc_frames):
+        driver(game)
+        game.update()
+        game.render()
+    current, peak = tracemalloc.get_traced_memory()
+    blocks_after = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+
+    return {
+        'frames': frames,
+        'update': summarize(update_times),
+        'draw': summarize(draw_times),
+        'gc_gen0_per_1000_frames': round(gc_collections * 1000 / frames, 2),
+        'alloc_peak_kib': round((peak - base_current) / 1024, 1),
+        'alloc_retained_kib': round((current - base_current) / 1024, 1),
+        'alloc_retained_blocks': blocks_after - blocks_before,
+        'live_projectiles': game.match.projectiles.count,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=PvP.SCRIPT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['scenarios']
+    print(f"\nChange vs {baseline_path} (p50):")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for phase in ('update', 'draw'):
+            old = baseline[name][phase]['p50_us']
+            new = result[phase]['p50_us']
+            change = (new - old) / old * 100 if old else 0.0
+            flag = '  <-- slower' if change > 10 else ''
+            print(f"  {name:18} {phase:6} {old:9.1f} -> {new:9.1f} us  ({change:+.0f}%){flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PvPGame update and draw")
+    parser.add_argument('--frames', type=int, default=1000, help="measured frames per scenario")
+    parser.add_argument('--warmup', type=int, default=120, help="unmeasured frames first")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="run only this scenario (repeatable)")
+    parser.add_argument('--out', default='bench_results.json', help="JSON output path")
+    parser.add_argument('--compare', help="earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        result = run_scenario(name, args.frames, args.warmup)
+        results[name] = result
+        print(f"{name:18} update p50 {result['update']['p50_us']:8.1f} us  p99 {result['update']['p99_us']:8.1f} us"
+              f"  |  draw p50 {result['draw']['p50_us']:8.1f} us  p99 {result['draw']['p99_us']:8.1f} us"
+              f"  |  gc {result['gc_gen0_per_1000_frames']:.1f}/1k frames")
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pygame': pygame.version.ver,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'scenarios': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.out}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,12 @@
+# /// script
+# dependencies = [
+#  "pygame-ce",
+#  "numpy",
+# ]
+# ///
 # Pygbag/WebAssembly compatible version of PvP Battle Arena
-# This is the entry point for the web version
+# This is the entry point for the web version. Pygbag only preloads what this file
+# declares or imports itself, so the packages PvP.py needs are listed above.
 
 import asyncio
 import sys
@@ -13,10 +20,11 @@ async def main():
 
     # Async game loop - required for Pygbag
     while game.running:
+        # Fixed-timestep simulation - slow frames catch up instead of slowing the game
+        frame_time = game.clock.tick(FPS) / 1000.0
         game.handle_events()
-        game.update()
+        game.advance(frame_time)
         game.draw()
-        game.clock.tick(FPS)
 
         # CRITICAL: Yield control back to browser
         # This allows the browser to handle events and render
@@ -0,0 +1,382 @@
+# Matchmaking for PvP Battle Arena
+# QUICK MATCH asks the matchmaker for an opponent instead of swapping IP addresses.
+# Players are queued by netcode mode, weapon mode, region and latency bucket (their
+# ping to the matchmaker, in LATENCY_BUCKET_MS steps). Every PAIR_INTERVAL the queues
+# are paired in one batch, longest waiting first. Someone who has waited WIDEN_AFTER
+# seconds will also take an opponent one latency bucket away, two buckets after
+# twice that, and so on.
+#
+# One of each pair hosts. The matchmaker tells it it was found a match, and once it is
+# listening ('ready') sends the other player its address. From there on it is an
+# ordinary online match - the matchmaker has no part in it.
+#
+# Each queue is a heap on when the player joined, so joining and pairing are
+# O(log n) however many are waiting. Leaving only marks the ticket, which is
+# skipped when it reaches the top. A player whose opponent vanished before the
+# match started goes back in with their original place.
+#
+# LocalMatchmaker runs the same matchmaker in-process, with no sockets, for tests
+# and for trying QUICK MATCH with two games in one process.
+#
+# Usage: python3 matchmaking.py
+#        python3 matchmaking.py --port 5556 --interval 0.25
+
+import argparse
+import asyncio
+import heapq
+import itertools
+import socket
+import time
+
+import net
+
+MATCHMAKER_PORT = 5556
+PAIR_INTERVAL = 0.5  # Seconds between pairing batches
+LATENCY_BUCKET_MS = 50  # Width of a latency bucket
+LATENCY_BUCKETS = 6  # The last one takes everybody slower
+WIDEN_AFTER = 10.0  # Seconds of waiting per extra latency bucket a player will accept
+READY_TIMEOUT = 5.0  # Seconds a host has to start listening before its opponent is queued again
+CONNECT_TIMEOUT = 3.0  # Seconds a client waits to reach the matchmaker
+COMPACT_MIN = 1024  # Queues smaller than this never bother removing cancelled tickets
+REPORT_INTERVAL = 10  # Seconds between the service's status lines
+
+HOST = 0
+JOIN = 1
+
+
+def latency_bucket(ping):
+    return min(ping // LATENCY_BUCKET_MS, LATENCY_BUCKETS - 1)
+
+
+class Ticket:
+    """One player waiting for a match"""
+    def __init__(self, peer, mode, weapon_mode, region, ping, lan, since, seq):
+        self.peer = peer
+        self.mode = mode
+        self.weapon_mode = weapon_mode
+        self.region = region
+        self.bucket = latency_bucket(ping)
+        self.lan = lan  # The player's own idea of its address, for opponents behind the same router
+        self.since = since
+        self.seq = seq  # Breaks ties between tickets queued at the same time
+        self.cancelled = False
+
+    @property
+    def key(self):
+        return (self.mode, self.weapon_mode, self.region, self.bucket)
+
+    @property
+    def order(self):
+        return (self.since, self.seq)
+
+    def reach(self, now):
+        """How many latency buckets away this player will now accept an opponent from"""
+        return min(int((now - self.since) // WIDEN_AFTER), LATENCY_BUCKETS - 1)
+
+
+class MatchQueue:
+    """Tickets with the same key, longest waiting first - a heap on (since, seq)"""
+    def __init__(self):
+        self.heap = []
+        self.live = 0  # Tickets in heap that aren't cancelled
+
+    def __len__(self):
+        return self.live
+
+    def push(self, ticket):
+        heapq.heappush(self.heap, (ticket.since, ticket.seq, ticket))
+        self.live += 1
+
+    def cancel(self, ticket):
+        ticket.cancelled = True
+        self.live -= 1
+        # Mostly dead weight - rebuild rather than let every pop wade through it
+        if len(self.heap) >= COMPACT_MIN and self.live < len(self.heap) // 2:
+            self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+
+    def peek(self):
+        heap = self.heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+        return heap[0][2] if heap else None
+
+    def pop(self):
+        ticket = self.peek()
+        heapq.heappop(self.heap)
+        self.live -= 1
+        return ticket
+
+
+class Matchmaker:
+    """Queues and pairs players. Transport-agnostic: a peer is anything with send,
+    receive, maintain, close and an address - a net.StreamPeer or a LocalLink."""
+    def __init__(self):
+        self.queues = {}  # Ticket key -> MatchQueue
+        self.tickets = {}  # Peer -> its Ticket while it is queued
+        self.pending = {}  # Host peer -> [host ticket, opponent ticket (None once gone), deadline]
+        self.opponents = {}  # Opponent peer -> the host peer it is waiting on
+        self.seq = itertools.count()
+        self.matches_made = 0
+        self.pair_time = 0.0  # Seconds the last batch took
+
+    @property
+    def waiting(self):
+        return len(self.tickets)
+
+    def enqueue(self, ticket):
+        queue = self.queues.get(ticket.key)
+        if queue is None:
+            queue = self.queues[ticket.key] = MatchQueue()
+        ticket.cancelled = False
+        queue.push(ticket)
+        self.tickets[ticket.peer] = ticket
+        ticket.peer.send({'t': 'queued', 'waiting': len(queue)})
+
+    def leave(self, peer):
+        ticket = self.tickets.pop(peer, None)
+        if ticket:
+            self.queues[ticket.key].cancel(ticket)
+
+    def read(self, peer, now):
+        """Handle everything peer has sent - and forget it if it has gone"""
+        for message in peer.receive():
+            self.handle(peer, message, now)
+        if not peer.maintain():
+            self.drop(peer)
+
+    def handle(self, peer, message, now):
+        kind = message['t']
+        if kind == 'queue':
+            self.drop(peer)  # Asking again (say for another mode) starts over
+            self.enqueue(Ticket(peer, message['mode'], message['weapon_mode'], message['region'],
+                                message['ping'], message['lan'], now, next(self.seq)))
+        elif kind == 'ready':
+            pending = self.pending.pop(peer, None)
+            if pending:
+                self.start(*pending[:2])
+
+    def start(self, host, opponent):
+        """The host is listening - send its opponent there"""
+        if opponent is None:
+            self.enqueue(host)  # Nobody to play after all - back in line, same place
+            return
+        del self.opponents[opponent.peer]
+        address = host.peer.address[0]
+        if address == opponent.peer.address[0] and host.lan:
+            address = host.lan  # Same public address - they share a network
+        opponent.peer.send({'t': 'found', 'role': JOIN, 'address': address})
+        self.matches_made += 1
+
+    def drop(self, peer):
+        self.leave(peer)
+        pending = self.pending.pop(peer, None)
+        if pending and pending[1]:
+            # A host that never got going - its opponent keeps its place
+            del self.opponents[pending[1].peer]
+            self.enqueue(pending[1])
+        host = self.opponents.pop(peer, None)
+        if host:
+            self.pending[host][1] = None
+
+    def batch(self, now):
+        """Pair everyone who can be, tell each pair's host, and give up on hosts
+        that never said they were ready"""
+        for host_peer, (host, opponent, deadline) in list(self.pending.items()):
+            if now > deadline:
+                self.drop(host_peer)
+                host_peer.close()
+
+        start = time.perf_counter()
+        pairs = self.pair(now)
+        for host, opponent in pairs:
+            del self.tickets[host.peer]
+            del self.tickets[opponent.peer]
+            self.pending[host.peer] = [host, opponent, now + READY_TIMEOUT]
+            self.opponents[opponent.peer] = host.peer
+            host.peer.send({'t': 'found', 'role': HOST, 'address': ''})
+        self.pair_time = time.perf_counter() - start
+        return pairs
+
+    def pair(self, now):
+        """Take every pair that can be made out of the queues - [(older, newer), ...]"""
+        pairs = []
+        for queue in self.queues.values():
+            while len(queue) >= 2:
+                pairs.append((queue.pop(), queue.pop()))
+
+        # Whoever is left alone in their queue may take someone from a nearby latency
+        # bucket, once both have waited long enough for that distance
+        alone = {key: queue.peek() for key, queue in self.queues.items() if queue}
+        for ticket in sorted(alone.values(), key=lambda ticket: ticket.order):
+            if alone.get(ticket.key) is not ticket:
+                continue  # Already taken
+            mode, weapon_mode, region, bucket = ticket.key
+            for distance in range(1, ticket.reach(now) + 1):
+                candidates = [alone.get((mode, weapon_mode, region, bucket + step)) for step in (-distance, distance)]
+                candidates = [other for other in candidates if other and other.reach(now) >= distance]
+                if candidates:
+                    other = min(candidates, key=lambda other: other.order)
+                    for taken in (ticket, other):
+                        del alone[taken.key]
+                        self.queues[taken.key].pop()
+                    pairs.append((ticket, other) if ticket.order < other.order else (other, ticket))
+                    break
+        return pairs
+
+
+class MatchmakingClient:
+    """The game's side of the matchmaker - over TCP, or a LocalLink to the stand-in"""
+    def __init__(self, transport, ping):
+        self.transport = transport
+        self.ping = ping  # Milliseconds, as measured connecting
+
+    def queue(self, mode, weapon_mode, region, lan=''):
+        self.transport.send({'t': 'queue', 'mode': mode, 'weapon_mode': weapon_mode,
+                             'region': region, 'ping': self.ping, 'lan': lan})
+
+    def ready(self):
+        """Tell the matchmaker we are listening for our opponent"""
+        self.transport.send({'t': 'ready'})
+
+    def poll(self):
+        """Read whatever has arrived - returns False once the matchmaker has gone"""
+        return self.transport.poll()
+
+    def receive(self):
+        return self.transport.receive()
+
+    def close(self):
+        self.transport.close()
+
+
+class LocalLink:
+    """One end of an in-process connection. Messages still go through net.encode and
+    a FrameReader, so the stand-in exercises the real codecs."""
+    name = 'local'
+
+    def __init__(self, local=None):
+        self.local = local  # The LocalMatchmaker to run when this end polls (client end)
+        self.other = None
+        self.address = ('127.0.0.1', 0)
+        self.frames = net.FrameReader()
+        self.connected = True
+
+    @classmethod
+    def pair(cls, local):
+        """(client end, matchmaker end)"""
+        client, service = cls(local), cls()
+        client.other, service.other = service, client
+        return client, service
+
+    def send(self, message, reliable=True):
+        if self.connected and self.other.connected:
+            self.other.frames.feed(net.encode(message))
+
+    def poll(self):
+        if self.local:
+            self.local.pump()
+        return self.maintain()
+
+    def maintain(self):
+        return self.connected and self.other.connected
+
+    def receive(self):
+        return self.frames.messages()
+
+    def close(self):
+        self.connected = False
+
+
+class LocalMatchmaker:
+    """The matchmaker in-process. It runs whenever one of its clients polls, so
+    nothing else needs driving."""
+    def __init__(self, interval=PAIR_INTERVAL):
+        self.matchmaker = Matchmaker()
+        self.interval = interval
+        self.peers = []  # Our ends of the clients' links
+        self.next_batch = 0.0
+
+    def connect(self, ping=0):
+        """A new client - ping stands in for its measured latency"""
+        client, service = LocalLink.pair(self)
+        self.peers.append(service)
+        return MatchmakingClient(client, ping)
+
+    def pump(self):
+        now = time.monotonic()
+        for peer in self.peers:
+            self.matchmaker.read(peer, now)
+        self.peers = [peer for peer in self.peers if peer.maintain()]
+        if now >= self.next_batch:
+            self.matchmaker.batch(now)
+            self.next_batch = now + self.interval
+
+
+local_matchmaker = None  # Shared by every game in the process, made on first use
+
+
+def connect(host, port=MATCHMAKER_PORT):
+    """A MatchmakingClient for the matchmaker at host - with host None, for the
+    in-process stand-in"""
+    global local_matchmaker
+    if host is None:
+        if local_matchmaker is None:
+            local_matchmaker = LocalMatchmaker()
+        return local_matchmaker.connect()
+    start = time.monotonic()
+    sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+    ping = int((time.monotonic() - start) * 1000)  # One round trip, for the TCP handshake
+    return MatchmakingClient(net.TcpTransport(sock), ping)
+
+
+class MatchmakingService:
+    """The matchmaker over TCP on one asyncio event loop. Messages are handled as
+    they arrive; pairing runs every interval."""
+    def __init__(self, interval=PAIR_INTERVAL):
+        self.matchmaker = Matchmaker()
+        self.interval = interval
+
+    def on_data(self, peer):
+        self.matchmaker.read(peer, time.monotonic())
+
+    def report(self):
+        matchmaker = self.matchmaker
+        queues = sum(1 for queue in matchmaker.queues.values() if queue)
+        print(f"{matchmaker.waiting} waiting in {queues} queues, {len(matchmaker.pending)} hosts getting ready, "
+              f"{matchmaker.matches_made} matches made | last batch {matchmaker.pair_time * 1000:.2f} ms")
+
+    async def serve(self, port=MATCHMAKER_PORT, host='0.0.0.0'):
+        async def accept(reader, writer):
+            net.StreamPeer(reader, writer, on_data=self.on_data)
+
+        server = await asyncio.start_server(accept, host, port)
+        print(f"Matchmaking on port {port}, pairing every {self.interval}s")
+        next_report = time.monotonic() + REPORT_INTERVAL
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self.matchmaker.batch(now)
+                if now >= next_report:
+                    self.report()
+                    next_report = now + REPORT_INTERVAL
+        finally:
+            server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Matchmaking service for PvP Battle Arena quick matches")
+    parser.add_argument('--port', type=int, default=MATCHMAKER_PORT, help="TCP port to listen on")
+    parser.add_argument('--interval', type=float, default=PAIR_INTERVAL, help="seconds between pairing batches")
+    args = parser.parse_args()
+
+    service = MatchmakingService(args.interval)
+    try:
+        asyncio.run(service.serve(args.port))
+    except KeyboardInterrupt:
+        print("Matchmaker stopped")
+
+
+if __name__ == '__main__':
+    main()
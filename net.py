@@ -0,0 +1,858 @@
+# Online state synchronisation for PvP Battle Arena
+# The host runs the only real simulation. Every SNAPSHOT_INTERVAL ticks it captures
+# the match (players, gems, projectiles) and sends the client just what changed
+# since the last snapshot the client acknowledged. The client rebuilds each full
+# state from the base it already has, applies it to its Match and acks the tick.
+#
+# A snapshot is plain data:
+#   tick    - match tick it was taken at
+#   players - one tuple of PLAYER_FIELDS per player
+#   gems    - (collected, image_index) for every gem, caves in order
+#   shots   - projectile id -> (tick, x, y, vx, vy, owner) where (x, y) is where it
+#             was at that tick. Projectiles fly in straight lines, so this never
+#             changes while the shot lives and a delta only lists new and gone ids.
+#
+# Deltas are against an acknowledged state, so a lost or late snapshot costs
+# nothing but a slightly larger next delta.
+#
+# Wire format - every message is one frame:
+#   header  - payload length (uint16), message type, message version (FRAME)
+#   payload - struct-packed fields for that type and version, little-endian
+# Messages are dicts with a 't' key naming their type, so callers never see bytes.
+# A reader that meets a type or version it doesn't know skips the frame by length.
+#
+# Transports - the same messages go over any of:
+#   TcpTransport - one stream of frames. Everything arrives, in order, but one lost
+#                  segment stalls everything behind it until it is resent.
+#   StreamPeer   - the server side of a TCP connection, on an asyncio event loop.
+#   UdpTransport - one datagram per send: PACKET header, then a block of reliable
+#                  frames, then unreliable frames. Reliable messages (match start,
+#                  hits, gem pickups, attacks) ride along in every packet until a
+#                  packet carrying them is acked; per-tick state is sent once, and
+#                  a lost snapshot or input is simply superseded by the next one.
+
+import asyncio
+import socket
+import struct
+import time
+from collections import deque
+
+SNAPSHOT_INTERVAL = 3  # Ticks between snapshots - 20 per second at 60 Hz
+SNAPSHOT_HISTORY = 32  # Sent (host) or rebuilt (client) states kept as delta bases
+INPUT_QUEUE_LIMIT = 4  # Remote inputs buffered before the oldest are dropped
+NO_INPUT = (0, None)  # Nothing held - as in PvP.py
+MOVEMENT_BUTTONS = 0x0f  # INPUT_LEFT | INPUT_RIGHT | INPUT_UP | INPUT_DOWN in PvP.py
+ATTACK_BUTTONS = 0x30  # INPUT_FIRE | INPUT_MELEE
+INPUT_BUFFER_SIZE = 128  # Client inputs kept for replaying over snapshots (~2 s)
+CORRECTION_DECAY = 0.8  # Share of a prediction error still drawn after each tick
+CORRECTION_SNAP = 100  # Errors this many pixels or more are jumped rather than smoothed
+
+PLAYER_FIELDS = ('x', 'y', 'health', 'alive', 'facing_right', 'attack_cooldown', 'damage_dealt')
+PLAYER_ROUNDING = {'x': 1, 'y': 1}  # Decimal places kept for float fields
+
+EMPTY = {'tick': -1, 'players': (), 'gems': (), 'shots': {}}
+
+FRAME = struct.Struct('<HBB')  # Payload length, type, version
+MAX_PAYLOAD = 0xffff
+RECEIVE_SIZE = 65536  # Most bytes read from the socket at once
+
+PROTOCOL_VERSION = 1  # Sent in the UDP handshake
+PACKET = struct.Struct('<HHIHH')  # Seq, newest seq received, 32 older ones as bits, first reliable id, reliable bytes
+RELIABLE_BLOCK_LIMIT = 1024  # Most bytes of unacked reliable messages carried per packet
+RESEND_INTERVAL = 0.1  # Seconds before unacked reliable messages go out again on their own
+KEEPALIVE_INTERVAL = 0.5  # Seconds of silence before an empty packet is sent
+UDP_TIMEOUT = 5.0  # Seconds without a packet before the peer counts as gone
+UDP_CONNECT_TIMEOUT = 1.5  # Seconds to wait for the host's welcome before trying TCP
+
+
+def player_state(player):
+    values = []
+    for field in PLAYER_FIELDS:
+        value = getattr(player, field)
+        if field in PLAYER_ROUNDING:
+            value = round(value, PLAYER_ROUNDING[field])
+        elif isinstance(value, bool):
+            value = int(value)
+        values.append(value)
+    return tuple(values)
+
+
+def diff(base, state):
+    """The delta that turns base into state - base may be EMPTY for a keyframe"""
+    delta = {'k': state['tick'], 'b': base['tick']}
+
+    players = []
+    for i, values in enumerate(state['players']):
+        old = base['players'][i] if i < len(base['players']) else ()
+        changed = {f: v for f, v in enumerate(values) if f >= len(old) or old[f] != v}
+        players.append(changed)
+    if any(players):
+        delta['p'] = players
+
+    gems = {i: gem for i, gem in enumerate(state['gems'])
+            if i >= len(base['gems']) or base['gems'][i] != gem}
+    if gems:
+        delta['g'] = gems
+
+    new = [(shot_id, *shot) for shot_id, shot in state['shots'].items() if shot_id not in base['shots']]
+    gone = [shot_id for shot_id in base['shots'] if shot_id not in state['shots']]
+    if new:
+        delta['new'] = new
+    if gone:
+        delta['gone'] = gone
+    return delta
+
+
+def patch(base, delta):
+    """Rebuild the state a delta was made from, given the same base"""
+    players = [list(values) for values in base['players']]
+    for i, changed in enumerate(delta.get('p', ())):
+        if i == len(players):
+            players.append([None] * len(PLAYER_FIELDS))
+        for field, value in changed.items():
+            players[i][field] = value
+
+    gems = list(base['gems'])
+    for i, gem in sorted(delta.get('g', {}).items()):
+        if i == len(gems):
+            gems.append(tuple(gem))
+        else:
+            gems[i] = tuple(gem)
+
+    shots = dict(base['shots'])
+    for shot_id in delta.get('gone', ()):
+        shots.pop(shot_id, None)
+    for shot_id, *shot in delta.get('new', ()):
+        shots[shot_id] = tuple(shot)
+
+    return {'tick': delta['k'], 'players': [tuple(values) for values in players],
+            'gems': gems, 'shots': shots}
+
+
+class SnapshotSender:
+    """Host side - captures the match and builds deltas against the client's last ack"""
+    def __init__(self):
+        self.history = {}  # tick -> state sent, kept until acked past
+        self.acked = EMPTY
+        self.shots = {}  # Projectile id -> (tick, x, y, vx, vy, owner) when first seen
+
+    def capture(self, match):
+        store = match.projectiles
+        n = store.count
+        shots = {}
+        for shot_id, x, y, vx, vy, owner in zip(store.id[:n].tolist(), store.x[:n].tolist(),
+                                                store.y[:n].tolist(), store.vx[:n].tolist(),
+                                                store.vy[:n].tolist(), store.owner[:n].tolist()):
+            shot = self.shots.get(shot_id)
+            if shot is None:
+                shot = (match.tick, round(x, 1), round(y, 1), round(vx, 3), round(vy, 3), owner)
+            shots[shot_id] = shot
+        self.shots = shots
+
+        return {
+            'tick': match.tick,
+            'players': [player_state(match.player1), player_state(match.player2)],
+            'gems': [(int(gem.collected), gem.image_index) for cave in match.caves for gem in cave.gems],
+            'shots': shots,
+        }
+
+    def snapshot(self, match, state=None):
+        """Capture the match now - returns the delta message to send. state may be
+        this tick's capture from another sender, when several clients watch one match."""
+        if state is None:
+            state = self.capture(match)
+        self.history[state['tick']] = state
+        if len(self.history) > SNAPSHOT_HISTORY:
+            # Never acked in time - later deltas stay against the older base
+            self.history.pop(min(self.history))
+        return diff(self.acked, state)
+
+    def ack(self, tick):
+        state = self.history.get(tick)
+        if state is None or tick <= self.acked['tick']:
+            return
+        self.acked = state
+        for old in [t for t in self.history if t < tick]:
+            del self.history[old]
+
+
+class InputQueue:
+    """Host side - one remote player's inputs, played one per tick in order"""
+    def __init__(self):
+        self.queue = deque()  # (buttons, aim, seq) waiting for their tick
+        self.buttons = 0  # Movement last held, played again while nothing arrives
+        self.seq = 0  # Newest input queued
+        self.applied = 0  # Newest input played - echoed in snapshots
+        self.late_attack = None  # A resent attack that arrived after newer inputs
+
+    def add(self, message):
+        """Queue an 'in' message"""
+        aim = message.get('a')
+        aim = tuple(aim) if aim else None
+        seq = message.get('n', self.seq + 1)
+        if seq <= self.seq:
+            # A resent attack overtaken by later movement - fire it with the next input
+            if message['b'] & ATTACK_BUTTONS:
+                self.late_attack = (message['b'] & ATTACK_BUTTONS, aim)
+            return
+        self.seq = seq
+        self.queue.append((message['b'], aim, seq))
+        if len(self.queue) > INPUT_QUEUE_LIMIT:
+            self.queue.popleft()  # Keep the remote player's lag bounded
+
+    def next(self):
+        """This tick's (buttons, aim)"""
+        buttons, aim = self.buttons, None
+        if self.queue:
+            buttons, aim, self.applied = self.queue.popleft()
+            self.buttons = buttons & MOVEMENT_BUTTONS
+        if self.late_attack:
+            buttons |= self.late_attack[0]
+            aim = aim or self.late_attack[1]
+            self.late_attack = None
+        return (buttons, aim)
+
+
+class SnapshotReceiver:
+    """Client side - rebuilds full states from deltas and remembers them as bases"""
+    def __init__(self):
+        self.states = {-1: EMPTY}
+        self.latest = EMPTY
+
+    def receive(self, delta):
+        """Returns the rebuilt state, or None if its base is unknown or it is stale"""
+        base = self.states.get(delta['b'])
+        if base is None or delta['k'] <= self.latest['tick']:
+            return None
+        state = patch(base, delta)
+        self.states[state['tick']] = state
+        self.latest = state
+        # The host never goes back to a base older than the last ack
+        for old in [t for t in self.states if t < delta['b']]:
+            del self.states[old]
+        return state
+
+
+# Wire format
+
+PLAYER_FORMATS = ('h', 'h', 'h', 'B', 'B', 'B', 'I')  # One per PLAYER_FIELDS entry
+PLAYER_SCALES = (10, 10, 1, 1, 1, 1, 1)  # Fixed point - x and y travel in tenths of a pixel
+PLAYER_STRUCTS = [struct.Struct('<' + f) for f in PLAYER_FORMATS]
+
+AIM_FLAG = 0x80  # Set on the buttons byte when an aim point follows
+GEM_COLLECTED = 0x80  # Set on a gem byte when it is collected, image index below
+
+START = struct.Struct('<q')  # Seed, then the loadouts as short strings
+START_V2 = struct.Struct('<qB')  # ...and whether the match uses rollback netcode
+START_V3 = struct.Struct('<qBB')  # ...and which player the receiver controls
+INPUT = struct.Struct('<Bi')  # Buttons, last snapshot tick received
+INPUT_V2 = struct.Struct('<BiI')  # ...and the input's sequence number
+AIM = struct.Struct('<hh')
+INPUTS = struct.Struct('<HiiB')  # Match tag, first tick, newest tick received from the peer, count (rollback)
+SNAPSHOT = struct.Struct('<iiB')  # Tick, base tick, player count
+SNAPSHOT_V2 = struct.Struct('<iiBI')  # ...and the newest client input applied
+SHOT = struct.Struct('<IIhhffB')  # Id, tick, x and y in tenths, vx, vy, owner
+COUNT = struct.Struct('<H')
+BYTE = struct.Struct('<B')
+START_FIELDS = ('weapon_mode', 'p1_weapon', 'p1_armor', 'p2_weapon', 'p2_armor')
+
+
+def pack_string(out, value):
+    value = value.encode()
+    out += BYTE.pack(len(value)) + value
+
+
+def unpack_string(view, offset):
+    length = view[offset]
+    return bytes(view[offset + 1:offset + 1 + length]).decode(), offset + 1 + length
+
+
+def encode_start(message):
+    out = bytearray(START_V3.pack(message['seed'], message.get('rollback', 0), message.get('player', 1)))
+    for field in START_FIELDS:
+        pack_string(out, message[field])
+    return out
+
+
+def decode_start(view):
+    seed, rollback, player = START_V3.unpack_from(view, 0)
+    return decode_start_body(view, START_V3.size,
+                             {'t': 'start', 'seed': seed, 'rollback': rollback, 'player': player})
+
+
+def decode_start_v2(view):
+    seed, rollback = START_V2.unpack_from(view, 0)
+    return decode_start_body(view, START_V2.size, {'t': 'start', 'seed': seed, 'rollback': rollback})
+
+
+def decode_start_v1(view):
+    return decode_start_body(view, START.size, {'t': 'start', 'seed': START.unpack_from(view, 0)[0]})
+
+
+def decode_start_body(view, offset, message):
+    for field in START_FIELDS:
+        message[field], offset = unpack_string(view, offset)
+    return message
+
+
+def encode_input(message):
+    aim = message.get('a')
+    if aim is None:
+        return INPUT_V2.pack(message['b'], message['k'], message['n'])
+    return INPUT_V2.pack(message['b'] | AIM_FLAG, message['k'], message['n']) + AIM.pack(*aim)
+
+
+def decode_input(view):
+    buttons, ack, seq = INPUT_V2.unpack_from(view, 0)
+    message = {'t': 'in', 'b': buttons & ~AIM_FLAG, 'k': ack, 'n': seq}
+    if buttons & AIM_FLAG:
+        message['a'] = AIM.unpack_from(view, INPUT_V2.size)
+    return message
+
+
+def decode_input_v1(view):
+    # No sequence number - from before client-side prediction
+    buttons, ack = INPUT.unpack_from(view, 0)
+    message = {'t': 'in', 'b': buttons & ~AIM_FLAG, 'k': ack}
+    if buttons & AIM_FLAG:
+        message['a'] = AIM.unpack_from(view, INPUT.size)
+    return message
+
+
+def encode_inputs(message):
+    inputs = message['inputs']
+    out = bytearray(INPUTS.pack(message['m'], message['tick'], message['k'], len(inputs)))
+    for buttons, aim in inputs:
+        if aim is None:
+            out += BYTE.pack(buttons)
+        else:
+            out += BYTE.pack(buttons | AIM_FLAG) + AIM.pack(*aim)
+    return out
+
+
+def decode_inputs(view):
+    tag, tick, ack, count = INPUTS.unpack_from(view, 0)
+    offset = INPUTS.size
+    inputs = []
+    for _ in range(count):
+        buttons = view[offset]
+        offset += 1
+        aim = None
+        if buttons & AIM_FLAG:
+            aim = AIM.unpack_from(view, offset)
+            offset += AIM.size
+        inputs.append((buttons & ~AIM_FLAG, aim))
+    return {'t': 'inputs', 'm': tag, 'tick': tick, 'k': ack, 'inputs': inputs}
+
+
+def encode_snapshot(message):
+    players = message.get('p', ())
+    out = bytearray(SNAPSHOT_V2.pack(message['k'], message['b'], len(players), message['n']))
+    for changed in players:
+        # A bitmask of the fields that follow
+        out += BYTE.pack(sum(1 << field for field in changed))
+        for field in sorted(changed):
+            out += PLAYER_STRUCTS[field].pack(round(changed[field] * PLAYER_SCALES[field]))
+
+    gems = message.get('g', {})
+    out += BYTE.pack(len(gems))
+    for i, (collected, image_index) in gems.items():
+        out += BYTE.pack(i) + BYTE.pack(image_index | (GEM_COLLECTED if collected else 0))
+
+    new = message.get('new', ())
+    out += COUNT.pack(len(new))
+    for shot_id, tick, x, y, vx, vy, owner in new:
+        out += SHOT.pack(shot_id, tick, round(x * 10), round(y * 10), vx, vy, owner)
+
+    gone = message.get('gone', ())
+    out += COUNT.pack(len(gone)) + struct.pack(f'<{len(gone)}I', *gone)
+    return out
+
+
+def decode_snapshot(view):
+    tick, base, player_count, input_seq = SNAPSHOT_V2.unpack_from(view, 0)
+    message = decode_snapshot_body(view, SNAPSHOT_V2.size, player_count)
+    message.update(k=tick, b=base, n=input_seq)
+    return message
+
+
+def decode_snapshot_v1(view):
+    tick, base, player_count = SNAPSHOT.unpack_from(view, 0)
+    message = decode_snapshot_body(view, SNAPSHOT.size, player_count)
+    message.update(k=tick, b=base)
+    return message
+
+
+def decode_snapshot_body(view, offset, player_count):
+    players = []
+    for _ in range(player_count):
+        mask = view[offset]
+        offset += 1
+        changed = {}
+        for field, packer in enumerate(PLAYER_STRUCTS):
+            if mask & (1 << field):
+                value = packer.unpack_from(view, offset)[0]
+                changed[field] = value / PLAYER_SCALES[field] if PLAYER_SCALES[field] != 1 else value
+                offset += packer.size
+        players.append(changed)
+
+    gems = {}
+    for _ in range(view[offset]):
+        gems[view[offset + 1]] = (int(view[offset + 2] >= GEM_COLLECTED), view[offset + 2] & ~GEM_COLLECTED)
+        offset += 2
+    offset += 1
+
+    count = COUNT.unpack_from(view, offset)[0]
+    offset += COUNT.size
+    new = []
+    for shot_id, shot_tick, x, y, vx, vy, owner in SHOT.iter_unpack(view[offset:offset + count * SHOT.size]):
+        new.append((shot_id, shot_tick, x / 10, y / 10, vx, vy, owner))
+    offset += count * SHOT.size
+
+    count = COUNT.unpack_from(view, offset)[0]
+    gone = list(struct.unpack_from(f'<{count}I', view, offset + COUNT.size))
+    return {'t': 'snap', 'p': players, 'g': gems, 'new': new, 'gone': gone}
+
+
+VERSION = struct.Struct('<B')
+
+
+def encode_version(message):
+    return VERSION.pack(message['version'])
+
+
+def decode_hello(view):
+    return {'t': 'hello', 'version': view[0]}
+
+
+def decode_welcome(view):
+    return {'t': 'welcome', 'version': view[0]}
+
+
+HIT = struct.Struct('<BhB')  # Attacker index, damage dealt, whether it killed
+GEM = struct.Struct('<BB')  # Gem index (caves in order), collected
+
+
+def encode_hit(message):
+    return HIT.pack(message['attacker'], message['damage'], message['killed'])
+
+
+def decode_hit(view):
+    attacker, damage, killed = HIT.unpack_from(view, 0)
+    return {'t': 'hit', 'attacker': attacker, 'damage': damage, 'killed': killed}
+
+
+def encode_gem(message):
+    return GEM.pack(message['gem'], message['collected'])
+
+
+def decode_gem(view):
+    gem, collected = GEM.unpack_from(view, 0)
+    return {'t': 'gem', 'gem': gem, 'collected': collected}
+
+
+# Matchmaking (matchmaking.py)
+QUEUE = struct.Struct('<H')  # Ping to the matchmaker in ms, then QUEUE_FIELDS as short strings
+QUEUE_FIELDS = ('mode', 'weapon_mode', 'region', 'lan')
+WAITING = struct.Struct('<I')  # Players in the same queue
+ROLE = struct.Struct('<B')  # 0 host, 1 join - then the host's address as a short string
+
+
+def encode_queue(message):
+    out = bytearray(QUEUE.pack(message['ping']))
+    for field in QUEUE_FIELDS:
+        pack_string(out, message[field])
+    return out
+
+
+def decode_queue(view):
+    message = {'t': 'queue', 'ping': QUEUE.unpack_from(view, 0)[0]}
+    offset = QUEUE.size
+    for field in QUEUE_FIELDS:
+        message[field], offset = unpack_string(view, offset)
+    return message
+
+
+def encode_queued(message):
+    return WAITING.pack(message['waiting'])
+
+
+def decode_queued(view):
+    return {'t': 'queued', 'waiting': WAITING.unpack_from(view, 0)[0]}
+
+
+def encode_found(message):
+    out = bytearray(ROLE.pack(message['role']))
+    pack_string(out, message['address'])
+    return out
+
+
+def decode_found(view):
+    address, _ = unpack_string(view, ROLE.size)
+    return {'t': 'found', 'role': ROLE.unpack_from(view, 0)[0], 'address': address}
+
+
+def encode_empty(message):
+    return b''
+
+
+def decode_ready(view):
+    return {'t': 'ready'}
+
+
+# Message name -> (type, version, encoder); decoders by (type, version), so an old
+# version can keep its decoder after a new one is added
+MESSAGE_TYPES = {
+    'start': (1, 3, encode_start),
+    'snap': (2, 2, encode_snapshot),
+    'in': (3, 2, encode_input),
+    'hello': (4, 1, encode_version),
+    'welcome': (5, 1, encode_version),
+    'hit': (6, 1, encode_hit),
+    'gem': (7, 1, encode_gem),
+    'inputs': (8, 1, encode_inputs),
+    'queue': (9, 1, encode_queue),
+    'queued': (10, 1, encode_queued),
+    'found': (11, 1, encode_found),
+    'ready': (12, 1, encode_empty),
+}
+DECODERS = {
+    (1, 1): decode_start_v1,
+    (1, 2): decode_start_v2,
+    (1, 3): decode_start,
+    (2, 1): decode_snapshot_v1,
+    (2, 2): decode_snapshot,
+    (3, 1): decode_input_v1,
+    (3, 2): decode_input,
+    (4, 1): decode_hello,
+    (5, 1): decode_welcome,
+    (6, 1): decode_hit,
+    (7, 1): decode_gem,
+    (8, 1): decode_inputs,
+    (9, 1): decode_queue,
+    (10, 1): decode_queued,
+    (11, 1): decode_found,
+    (12, 1): decode_ready,
+}
+
+
+def encode(message):
+    """One framed message, ready to send"""
+    kind, version, encoder = MESSAGE_TYPES[message['t']]
+    payload = encoder(message)
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"{message['t']} message too large ({len(payload)} bytes)")
+    return FRAME.pack(len(payload), kind, version) + payload
+
+
+class FrameReader:
+    """Turns a received byte stream back into messages.
+
+    Bytes go into one persistent buffer and frames are parsed in place through a
+    memoryview, so a message is never lost or split however the stream was
+    chunked, and payloads are never copied out before their fields are unpacked.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0  # Start of the first unparsed frame
+        self.error = None  # Why the stream stopped making sense - nothing more is read after it
+
+    def feed(self, data):
+        if self.error:
+            return
+        if self.offset:
+            # Drop what has been parsed - one move of the unparsed tail
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def messages(self):
+        """Every complete message received so far - a partial frame waits for more bytes"""
+        if self.error:
+            return []
+        try:
+            with memoryview(self.buffer) as view:
+                messages, self.offset = parse_frames(view, self.offset, len(self.buffer))
+        except ProtocolError as e:
+            # The sender is broken or hostile - its transport reports it gone
+            self.error = str(e)
+            self.buffer = bytearray()
+            self.offset = 0
+            return []
+        return [message for message in messages if message is not None]
+
+
+class ProtocolError(ValueError):
+    """A frame whose payload doesn't decode as its type and version say it should"""
+
+
+def parse_frames(view, offset, end):
+    """Decode the whole frames in view[offset:end] - returns (messages, where parsing
+    stopped). Frames of unknown type or version come back as None."""
+    messages = []
+    while end - offset >= FRAME.size:
+        length, kind, version = FRAME.unpack_from(view, offset)
+        start = offset + FRAME.size
+        if start + length > end:
+            break
+        offset = start + length
+        decoder = DECODERS.get((kind, version))
+        try:
+            messages.append(decoder(view[start:offset]) if decoder else None)
+        except (struct.error, ValueError, IndexError) as e:
+            raise ProtocolError(f"bad frame of type {kind} version {version}: {e}")
+    return messages, offset
+
+
+def seq_newer(a, b):
+    """Whether 16-bit sequence number a comes after b, allowing for wraparound"""
+    return 0 < ((a - b) & 0xffff) < 0x8000
+
+
+class TcpTransport:
+    """Messages over a connected TCP socket"""
+    name = 'tcp'
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.reader = FrameReader()
+        self.buffer = bytearray(RECEIVE_SIZE)
+        self.outgoing = bytearray()  # Frames the socket hasn't taken yet
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def send(self, message, reliable=True):
+        # Everything on a stream is reliable. Whatever the socket can't take right
+        # now waits in outgoing, so a frame is never dropped or cut short
+        self.outgoing += encode(message)
+        self.flush()
+
+    def flush(self):
+        while self.outgoing:
+            try:
+                sent = self.sock.send(self.outgoing)
+            except BlockingIOError:
+                return
+            del self.outgoing[:sent]
+            self.bytes_sent += sent
+
+    def poll(self):
+        """Send what is waiting and read whatever has arrived - returns False once
+        the peer has gone"""
+        self.flush()
+        while True:
+            try:
+                received = self.sock.recv_into(self.buffer)
+            except BlockingIOError:
+                return not self.reader.error
+            if received == 0:
+                return False
+            self.bytes_received += received
+            self.reader.feed(memoryview(self.buffer)[:received])
+
+    def receive(self):
+        return self.reader.messages()
+
+    def close(self):
+        self.sock.close()
+
+
+class StreamPeer:
+    """A peer connected over TCP to an asyncio server - TcpTransport's job done with
+    streams. on_data, if given, is called with the peer whenever bytes arrive and
+    once when it disconnects."""
+    name = 'tcp'
+
+    def __init__(self, reader, writer, on_data=None):
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        self.on_data = on_data
+        self.frames = FrameReader()
+        self.connected = True
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.task = asyncio.ensure_future(self.read(reader))
+
+    async def read(self, reader):
+        try:
+            while True:
+                data = await reader.read(RECEIVE_SIZE)
+                if not data:
+                    break
+                self.bytes_received += len(data)
+                self.frames.feed(data)
+                if self.on_data:
+                    self.on_data(self)
+        except ConnectionError:
+            pass
+        except Exception as e:
+            print(f"Error reading from {self.address}: {e}")
+        self.connected = False
+        if self.on_data:
+            self.on_data(self)
+
+    def send(self, message, reliable=True):
+        data = encode(message)
+        self.writer.write(data)
+        self.bytes_sent += len(data)
+
+    def receive(self):
+        return self.frames.messages()
+
+    def maintain(self):
+        return self.connected and not self.frames.error
+
+    def close(self):
+        self.connected = False
+        self.writer.close()
+
+
+class UdpTransport:
+    """Messages over UDP to one peer, with acks and a reliable channel"""
+    name = 'udp'
+
+    def __init__(self, sock, peer):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.peer = peer
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        self.seq = 0  # Of the next packet sent
+        self.sent = {}  # Seq -> id of the newest reliable message it carried (or None)
+        self.remote_seq = 0xffff  # Newest packet received
+        self.received_bits = 0  # Bit i set = packet remote_seq - 1 - i received
+
+        self.next_reliable_id = 0
+        self.reliable_out = []  # (id, frame) sent but not yet acked, oldest first
+        self.next_reliable_in = 0  # Id of the reliable message expected next
+        self.inbox = []
+
+        self.last_sent = 0.0
+        self.last_received = time.monotonic()
+        self.error = None  # Set when the peer sends something that doesn't decode
+
+    def send(self, message, reliable=False):
+        frame = encode(message)
+        if reliable:
+            self.reliable_out.append((self.next_reliable_id, frame))
+            self.next_reliable_id = (self.next_reliable_id + 1) & 0xffff
+            frame = b''
+        self.send_packet(frame)
+
+    def send_packet(self, frames=b''):
+        block = bytearray()
+        first_id = newest_id = self.next_reliable_id
+        for reliable_id, frame in self.reliable_out:
+            if block and len(block) + len(frame) > RELIABLE_BLOCK_LIMIT:
+                break
+            if not block:
+                first_id = reliable_id
+            block += frame
+            newest_id = reliable_id
+
+        packet = PACKET.pack(self.seq, self.remote_seq, self.received_bits, first_id, len(block)) + block + frames
+        self.sock.sendto(packet, self.peer)
+        self.bytes_sent += len(packet)
+        self.sent[self.seq] = newest_id if block else None
+        self.sent.pop((self.seq - 64) & 0xffff, None)  # Never acked - long gone
+        self.seq = (self.seq + 1) & 0xffff
+        self.last_sent = time.monotonic()
+
+    def poll(self):
+        """Read every waiting datagram, resend and keep the link alive - returns
+        False once the peer has been silent too long"""
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(RECEIVE_SIZE)
+            except BlockingIOError:
+                break
+            except ConnectionError:
+                break  # ICMP error from an earlier send - UDP_TIMEOUT decides if the peer is gone
+            if addr == self.peer:
+                self.handle(data)
+        return self.maintain()
+
+    def maintain(self):
+        """Resend and keep the link alive - returns False once the peer has been
+        silent too long. poll does this; call it directly when datagrams are fed
+        to handle by someone else (a server with one socket for every peer)."""
+        now = time.monotonic()
+        if (self.reliable_out and now - self.last_sent > RESEND_INTERVAL) or now - self.last_sent > KEEPALIVE_INTERVAL:
+            self.send_packet()
+        return now - self.last_received < UDP_TIMEOUT and not self.error
+
+    def handle(self, data):
+        """Process one datagram from the peer"""
+        if len(data) < PACKET.size:
+            return
+        seq, ack, ack_bits, first_id, block_size = PACKET.unpack_from(data)
+        if not self.mark_received(seq):
+            return  # Duplicate or too old
+        self.bytes_received += len(data)
+        self.last_received = time.monotonic()
+
+        if self.error:
+            return
+        # Whatever the peer has seen, its reliable messages need no resending
+        for i in range(33):
+            if i == 0 or ack_bits & (1 << (i - 1)):
+                newest_id = self.sent.pop((ack - i) & 0xffff, None)
+                if newest_id is not None:
+                    self.reliable_out = [(reliable_id, frame) for reliable_id, frame in self.reliable_out
+                                         if seq_newer(reliable_id, newest_id)]
+
+        try:
+            with memoryview(data) as view:
+                end = min(PACKET.size + block_size, len(data))
+                reliable, _ = parse_frames(view, PACKET.size, end)
+                unreliable, _ = parse_frames(view, end, len(data))
+        except ProtocolError as e:
+            self.error = str(e)  # The peer is broken or hostile - maintain reports it gone
+            return
+        for i, message in enumerate(reliable):
+            # In order, once each - the block always starts at the oldest unacked
+            if (first_id + i) & 0xffff == self.next_reliable_in:
+                self.next_reliable_in = (self.next_reliable_in + 1) & 0xffff
+                if message is not None:
+                    self.inbox.append(message)
+        self.inbox.extend(message for message in unreliable if message is not None)
+
+    def mark_received(self, seq):
+        """Record seq in the ack state - False if it was already seen or is too old to tell"""
+        if seq_newer(seq, self.remote_seq):
+            shift = (seq - self.remote_seq) & 0xffff
+            self.received_bits = ((self.received_bits << shift) | (1 << (shift - 1))) & 0xffffffff if shift <= 32 else 0
+            self.remote_seq = seq
+            return True
+        age = (self.remote_seq - seq) & 0xffff
+        if age == 0 or age > 32 or self.received_bits & (1 << (age - 1)):
+            return False
+        self.received_bits |= 1 << (age - 1)
+        return True
+
+    def receive(self):
+        messages = self.inbox
+        self.inbox = []
+        return messages
+
+    def close(self):
+        self.sock.close()
+
+
+def connect_udp(host, port):
+    """Handshake with a host over UDP - returns a UdpTransport, or None if no
+    welcome came back in time (UDP blocked, or nobody listening)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    transport = UdpTransport(sock, (socket.gethostbyname(host), port))
+    transport.send({'t': 'hello', 'version': PROTOCOL_VERSION}, reliable=True)
+    deadline = time.monotonic() + UDP_CONNECT_TIMEOUT
+    while time.monotonic() < deadline:
+        transport.poll()
+        for message in transport.receive():
+            if message['t'] == 'welcome' and message['version'] == PROTOCOL_VERSION:
+                return transport
+        time.sleep(0.01)
+    sock.close()
+    return None
@@ -0,0 +1,264 @@
+# Match replays for PvP Battle Arena
+# A replay is the match seed, the loadouts and every tick's player inputs. Since a
+# seeded Match is deterministic, that is enough to play the whole match back.
+#
+# File layout:
+#   header  - b'PVPR', format version, seed, then the match settings as short strings
+#   body    - zlib stream of input runs: varint tick count, p1 buttons, p2 buttons.
+#             Bit 7 of a buttons byte means that tick carries an aim point (two
+#             little-endian int16s). A run with count 0 ends the replay.
+#
+# Usage: python3 replay.py replays/match.pvpr            (watch at 1x)
+#        python3 replay.py replays/match.pvpr --speed 8
+#        python3 replay.py replays/match.pvpr --headless (simulate only, print result)
+
+import argparse
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+
+MAGIC = b'PVPR'
+VERSION = 1
+AIM_FLAG = 0x80
+BATCH_TICKS = 60  # Inputs handed to the writer at a time
+
+HEADER_FIELDS = ('game_mode', 'ai_difficulty', 'p1_weapon', 'p1_armor', 'p2_weapon', 'p2_armor')
+
+
+class ReplayHeader:
+    """Everything needed to rebuild the match a replay starts from"""
+    def __init__(self, seed, game_mode='2p', ai_difficulty='medium',
+                 p1_weapon='sword', p1_armor='light', p2_weapon='sword', p2_armor='light'):
+        self.seed = seed
+        self.game_mode = game_mode
+        self.ai_difficulty = ai_difficulty
+        self.p1_weapon = p1_weapon
+        self.p1_armor = p1_armor
+        self.p2_weapon = p2_weapon
+        self.p2_armor = p2_armor
+
+    def pack(self):
+        data = bytearray(MAGIC)
+        data += struct.pack('<Bq', VERSION, self.seed)
+        for field in HEADER_FIELDS:
+            value = getattr(self, field).encode()
+            data += struct.pack('<B', len(value)) + value
+        return bytes(data)
+
+    @classmethod
+    def unpack(cls, data):
+        """Parse a header from the start of data - returns (header, bytes used)"""
+        if data[:4] != MAGIC:
+            raise ValueError("Not a PvP replay file")
+        version, seed = struct.unpack_from('<Bq', data, 4)
+        if version != VERSION:
+            raise ValueError(f"Unsupported replay version {version}")
+        offset = 13
+        values = {}
+        for field in HEADER_FIELDS:
+            length = data[offset]
+            values[field] = data[offset + 1:offset + 1 + length].decode()
+            offset += 1 + length
+        return cls(seed, **values), offset
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class RunEncoder:
+    """Run-length encodes (p1_input, p2_input) ticks - consecutive identical ticks
+    without an aim point collapse into one run."""
+    def __init__(self):
+        self.run_buttons = None
+        self.run_count = 0
+
+    def flush_run(self, out):
+        if self.run_count:
+            write_varint(out, self.run_count)
+            out += bytes(self.run_buttons)
+            self.run_count = 0
+
+    def feed(self, ticks):
+        out = bytearray()
+        for (b1, aim1), (b2, aim2) in ticks:
+            if aim1 is None and aim2 is None:
+                if self.run_count and (b1, b2) == self.run_buttons:
+                    self.run_count += 1
+                else:
+                    self.flush_run(out)
+                    self.run_buttons = (b1, b2)
+                    self.run_count = 1
+                continue
+
+            # Ticks with an aim point are stored on their own
+            self.flush_run(out)
+            self.run_buttons = None
+            write_varint(out, 1)
+            out.append(b1 | (AIM_FLAG if aim1 is not None else 0))
+            out.append(b2 | (AIM_FLAG if aim2 is not None else 0))
+            for aim in (aim1, aim2):
+                if aim is not None:
+                    out += struct.pack('<hh', aim[0], aim[1])
+        return bytes(out)
+
+    def finish(self):
+        out = bytearray()
+        self.flush_run(out)
+        write_varint(out, 0)
+        return bytes(out)
+
+
+def decode_runs(data):
+    """Yield (p1_input, p2_input) for every tick in a decoded body"""
+    offset = 0
+    while True:
+        count, offset = read_varint(data, offset)
+        if count == 0:
+            return
+        b1 = data[offset]
+        b2 = data[offset + 1]
+        offset += 2
+        aims = []
+        for b in (b1, b2):
+            if b & AIM_FLAG:
+                aims.append(struct.unpack_from('<hh', data, offset))
+                offset += 4
+            else:
+                aims.append(None)
+        tick = ((b1 & ~AIM_FLAG, aims[0]), (b2 & ~AIM_FLAG, aims[1]))
+        for _ in range(count):
+            yield tick
+
+
+class ReplayRecorder:
+    """Records a match to a file.
+
+    record() only appends to a list; encoding, compression and file writes happen
+    on a background thread in batches, so recording costs no frame time. Browsers
+    have no threads, so under pygbag batches are written inline instead - still
+    only once per BATCH_TICKS ticks.
+    """
+    def __init__(self, path, header):
+        self.path = path
+        self.ticks = []
+        self.encoder = RunEncoder()
+        self.compressor = zlib.compressobj(9)
+        self.file = open(path, 'wb')
+        self.file.write(header.pack())
+
+        self.queue = None
+        self.thread = None
+        if sys.platform != 'emscripten':
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self.writer, daemon=True)
+            self.thread.start()
+
+    def record(self, p1_input, p2_input):
+        self.ticks.append((p1_input, p2_input))
+        if len(self.ticks) >= BATCH_TICKS:
+            self.submit(self.ticks)
+            self.ticks = []
+
+    def submit(self, batch):
+        if self.queue:
+            self.queue.put(batch)
+        else:
+            self.write(batch)
+
+    def write(self, batch):
+        if batch is None:
+            self.file.write(self.compressor.compress(self.encoder.finish()))
+            self.file.write(self.compressor.flush())
+            self.file.close()
+        else:
+            self.file.write(self.compressor.compress(self.encoder.feed(batch)))
+
+    def writer(self):
+        while True:
+            batch = self.queue.get()
+            self.write(batch)
+            if batch is None:
+                return
+
+    def close(self):
+        """Finish the file - safe to call more than once"""
+        if self.file is None:
+            return
+        if self.ticks:
+            self.submit(self.ticks)
+            self.ticks = []
+        self.submit(None)
+        if self.thread:
+            self.thread.join()
+        self.file = None
+
+
+def load_replay(path):
+    """Read a replay file - returns (header, list of (p1_input, p2_input) per tick)"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    header, offset = ReplayHeader.unpack(data)
+    return header, list(decode_runs(zlib.decompress(data[offset:])))
+
+
+def play_headless(path):
+    """Re-run a replay as fast as possible - returns the finished Match"""
+    from PvP import Match
+
+    header, ticks = load_replay(path)
+    match = Match.from_replay(header)
+    for p1_input, p2_input in ticks:
+        if match.over:
+            break
+        match.step(p1_input, p2_input)
+    return match
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play back a PvP Battle Arena replay")
+    parser.add_argument('path', help="replay file (.pvpr)")
+    parser.add_argument('--speed', type=int, default=1, choices=[1, 2, 4, 8],
+                        help="playback speed when watching")
+    parser.add_argument('--headless', action='store_true',
+                        help="simulate without a window and print the result")
+    args = parser.parse_args()
+
+    if args.headless:
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+        start = time.perf_counter()
+        match = play_headless(args.path)
+        elapsed = time.perf_counter() - start
+        winner = match.winner.name if match.winner else 'nobody'
+        print(f"{match.tick} ticks in {elapsed:.3f}s ({match.tick / elapsed:.0f} ticks/s) - "
+              f"winner: {winner}, health {match.player1.health} / {match.player2.health}")
+        return
+
+    from PvP import PvPGame
+    game = PvPGame()
+    game.watch_replay(args.path, args.speed)
+    game.run()
+
+
+if __name__ == '__main__':
+    main()
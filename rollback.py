@@ -0,0 +1,165 @@
+# Rollback netcode for PvP Battle Arena
+# Both peers run the whole match and only inputs cross the network. A peer never
+# waits for the other's input: it predicts it (the last movement held, no attack),
+# saves the match state before every tick, and when the real input turns out to
+# differ it loads the state from that tick and re-simulates up to the present.
+#
+# Local inputs are played INPUT_DELAY ticks after they are read, which hides small
+# amounts of lag without any rollback at all. A peer that gets more than
+# ROLLBACK_WINDOW ticks ahead of the last input it has from the other side waits
+# for it to catch up, so a rollback never re-runs more than that many ticks.
+#
+# Every tick each peer sends one 'inputs' message: all its inputs the other side
+# hasn't acknowledged yet, and the newest tick it has all of the other side's
+# inputs up to. A lost message is covered by the next one, so it can go unreliably.
+
+from net import NO_INPUT, MOVEMENT_BUTTONS
+
+INPUT_DELAY = 2  # Ticks between reading a local input and playing it
+ROLLBACK_WINDOW = 8  # Most ticks played on predicted input before waiting
+MAX_INPUTS_SENT = 64  # Unacknowledged inputs resent per message
+
+
+class RollbackSession:
+    """One peer's side of a rollback match.
+
+    match is a Match both peers created from the same seed and loadouts;
+    local_index is the player this peer controls (0 or 1). Each tick: read an
+    input and call add_local_input, then advance, then send message(). While
+    can_advance is False call resolve instead, so late inputs are still applied.
+    With record set, confirmed_inputs hands out every tick's inputs for a replay.
+    """
+    def __init__(self, match, local_index, delay=INPUT_DELAY, window=ROLLBACK_WINDOW, record=False):
+        self.match = match
+        self.local_index = local_index
+        self.window = window
+        self.inputs = ({}, {})  # Per player, tick -> (buttons, aim) known for certain
+        self.used = {}  # Tick -> remote input the tick was last simulated with
+        self.states = {}  # Tick -> match state saved just before that tick
+        self.confirmed = -1  # Newest tick with every remote input up to it known
+        self.acked = -1  # Newest tick the peer has every one of our inputs up to
+        self.rollback_from = None  # Earliest tick simulated with a wrong prediction
+        self.tag = match.seed & 0xffff  # Tells this match's messages from the last one's
+        self.record = record
+        self.recorded = -1  # Newest tick handed out by confirmed_inputs
+
+        # Nobody has input for the first ticks
+        local = self.inputs[local_index]
+        for tick in range(delay):
+            local[tick] = NO_INPUT
+        self.next_local = delay
+
+        # Stats
+        self.rollbacks = 0
+        self.resimulated = 0
+        self.deepest = 0
+
+    @property
+    def remote_index(self):
+        return 1 - self.local_index
+
+    @property
+    def can_advance(self):
+        """False while too far ahead of the peer - or once the match is over"""
+        return not self.match.over and self.match.tick - self.confirmed <= self.window
+
+    @property
+    def settled(self):
+        """Whether every tick so far was played with the real inputs"""
+        return self.rollback_from is None and self.confirmed >= self.match.tick - 1
+
+    def add_local_input(self, player_input):
+        self.inputs[self.local_index][self.next_local] = player_input
+        self.next_local += 1
+
+    def receive(self, message):
+        """Take in an 'inputs' message from the peer"""
+        if message['m'] != self.tag:
+            return  # Left over from before a rematch
+        self.acked = max(self.acked, message['k'])
+        remote = self.inputs[self.remote_index]
+        for tick, player_input in enumerate(message['inputs'], message['tick']):
+            if tick <= self.confirmed or tick in remote:
+                continue
+            remote[tick] = player_input
+            used = self.used.get(tick)
+            if used is not None and used != player_input:
+                if self.rollback_from is None or tick < self.rollback_from:
+                    self.rollback_from = tick
+        while self.confirmed + 1 in remote:
+            self.confirmed += 1
+
+    def message(self):
+        """The 'inputs' message to send the peer this tick"""
+        local = self.inputs[self.local_index]
+        first = self.acked + 1
+        last = min(self.next_local, first + MAX_INPUTS_SENT)
+        return {'t': 'inputs', 'm': self.tag, 'tick': first, 'k': self.confirmed,
+                'inputs': [local[tick] for tick in range(first, last)]}
+
+    def predict(self, tick):
+        """The remote input to play at tick when it hasn't arrived - the newest
+        one we have from before it, still moving but not attacking"""
+        remote = self.inputs[self.remote_index]
+        for earlier in range(tick - 1, self.confirmed - 1, -1):
+            if earlier in remote:
+                return (remote[earlier][0] & MOVEMENT_BUTTONS, None)
+        return NO_INPUT
+
+    def step(self):
+        match = self.match
+        tick = match.tick
+        self.states[tick] = match.save_state()
+        remote = self.inputs[self.remote_index].get(tick)
+        if remote is None:
+            remote = self.predict(tick)
+        self.used[tick] = remote
+        local = self.inputs[self.local_index][tick]
+        if self.local_index == 0:
+            match.step(local, remote)
+        else:
+            match.step(remote, local)
+
+    def resolve(self):
+        """Re-simulate from the earliest mispredicted tick, if there is one"""
+        match = self.match
+        if self.rollback_from is not None:
+            present = match.tick
+            # Hits and pickups were already shown the first time round - and loading
+            # the saved state would report every restored gem as a change
+            on_hit, on_gem = match.on_hit, match.on_gem
+            match.on_hit = match.on_gem = None
+            match.load_state(self.states[self.rollback_from])
+            while match.tick < present and not match.over:
+                self.step()
+            match.on_hit, match.on_gem = on_hit, on_gem
+            self.rollbacks += 1
+            self.resimulated += present - self.rollback_from
+            self.deepest = max(self.deepest, present - self.rollback_from)
+            self.rollback_from = None
+
+    def advance(self):
+        """Fix any mispredicted ticks, then play the next one"""
+        self.resolve()
+        if not self.match.over:
+            self.step()
+
+        # Nothing at or before a confirmed tick can be rolled back
+        for tick in [tick for tick in self.states if tick <= self.confirmed]:
+            del self.states[tick]
+            del self.used[tick]
+        # Inputs are kept while they may be resent, predicted from or recorded
+        if not self.record:
+            self.recorded = min(self.confirmed, self.match.tick - 1)
+        oldest = min(self.confirmed, self.acked + 1, self.recorded + 1)
+        for inputs in self.inputs:
+            for tick in [tick for tick in inputs if tick < oldest]:
+                del inputs[tick]
+
+    def confirmed_inputs(self):
+        """(p1_input, p2_input) for every tick newly played with real inputs - for replays"""
+        newest = min(self.confirmed, self.match.tick - 1)
+        while self.recorded < newest:
+            self.recorded += 1
+            tick = self.recorded
+            yield (self.inputs[0][tick], self.inputs[1][tick])
@@ -0,0 +1,329 @@
+# Dedicated server for PvP Battle Arena
+# Runs many online matches at once in one headless process. Players connect exactly
+# as they would to a friend's game - JOIN GAME with the server's address, over UDP or
+# TCP - and are paired in the order they arrive. The server plays the host's part for
+# both players: it runs the match, takes their inputs and sends each one snapshots.
+# When a match ends the result stays up for a few seconds, then both players go back
+# in the queue.
+#
+# Everything runs on one asyncio event loop. The UDP endpoint and the TCP connections
+# only queue incoming messages; one scheduler ticks every match at SIM_HZ and reports
+# how long each match's ticks take.
+#
+# One process uses one core, which holds about 100 matches (200 players). Past that
+# the scheduler can't keep up, logs that it is saturated and every match runs slow -
+# for more, run a server per core on separate ports.
+#
+# Usage: python3 server.py
+#        python3 server.py --port 5555 --weapon-mode ranged_only --report 30
+
+import argparse
+import asyncio
+import os
+import random
+import time
+from collections import deque
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import numpy as np
+
+import net
+from PvP import Match, WEAPONS, ARMOR_TYPES, NET_PORT, SIM_HZ, SIM_DT, MAX_CATCHUP_STEPS
+
+REPORT_INTERVAL = 10  # Seconds between latency reports
+REPORT_MATCHES = 10  # Slowest matches listed in each report
+RESULT_TIME = 3.0  # Seconds a finished match stays up before its players are queued again
+
+
+class SharedSocket:
+    """The server's one UDP endpoint, as the socket a net.UdpTransport sends through"""
+    def __init__(self, transport):
+        self.transport = transport
+
+    def setblocking(self, flag):
+        pass  # asyncio's transport never blocks
+
+    def sendto(self, data, addr):
+        self.transport.sendto(data, addr)
+
+    def close(self):
+        pass  # Every UDP peer shares it - it closes with the server
+
+
+class DatagramEndpoint(asyncio.DatagramProtocol):
+    """Hands each datagram to its peer's UdpTransport - a hello from a new address joins the queue"""
+    def __init__(self, server):
+        self.server = server
+        self.socket = None
+
+    def connection_made(self, transport):
+        self.socket = SharedSocket(transport)
+
+    def datagram_received(self, data, addr):
+        peer = self.server.udp_peers.get(addr)
+        if peer:
+            peer.handle(data)
+            return
+        peer = net.UdpTransport(self.socket, addr)
+        peer.handle(data)
+        hello = peer.receive()
+        if not hello or hello[0]['t'] != 'hello' or hello[0]['version'] != net.PROTOCOL_VERSION:
+            return
+        peer.send({'t': 'welcome', 'version': net.PROTOCOL_VERSION}, reliable=True)
+        self.server.udp_peers[addr] = peer
+        self.server.join(peer, addr)
+
+    def error_received(self, exc):
+        pass  # ICMP errors from earlier sends - UDP_TIMEOUT decides who has gone
+
+
+def weapons_for(weapon_mode):
+    """The weapons a weapon mode allows - as PvPGame.get_available_weapons"""
+    if weapon_mode == 'melee_only':
+        return [w for w in WEAPONS if not WEAPONS[w].get('projectile', False)]
+    if weapon_mode == 'ranged_only':
+        return [w for w in WEAPONS if WEAPONS[w].get('projectile', False)]
+    return list(WEAPONS)
+
+
+def percentiles(samples):
+    """(p50, p99, max) of a list of seconds, in milliseconds"""
+    ms = np.array(samples) * 1000.0
+    return float(np.percentile(ms, 50)), float(np.percentile(ms, 99)), float(ms.max())
+
+
+class ServerMatch:
+    """One match on the server - the host's part of PvPGame, for two remote players"""
+    def __init__(self, number, peers, seed, weapon_mode, loadouts, report_ticks):
+        self.number = number
+        self.peers = peers  # One per player, in player order
+        self.gone = [False, False]
+        self.weapon_mode = weapon_mode
+        self.match = Match.headless(*loadouts, p1_ai=False, p2_ai=False, seed=seed)
+        self.match.on_hit = self.hit
+        self.match.on_gem = self.gem_changed
+        self.gem_indices = {gem: i for i, gem in enumerate(self.match.gems)}
+        self.inputs = [net.InputQueue(), net.InputQueue()]
+        self.snapshots = [net.SnapshotSender(), net.SnapshotSender()]
+        # Matches take turns sending snapshots, so the work is spread over every tick
+        self.snapshot_offset = number % net.SNAPSHOT_INTERVAL
+        self.finished_at = None
+        self.result_ticks = 0  # Ticks since the match ended
+
+        # Seconds spent on each tick, and from when the tick was due until it was done
+        self.tick_times = deque(maxlen=report_ticks)
+        self.latencies = deque(maxlen=report_ticks)
+
+        w1, a1, w2, a2 = loadouts
+        for i, peer in enumerate(peers):
+            peer.send({'t': 'start', 'seed': seed, 'weapon_mode': weapon_mode,
+                       'p1_weapon': w1, 'p1_armor': a1, 'p2_weapon': w2, 'p2_armor': a2,
+                       'rollback': 0, 'player': i})
+
+    @property
+    def done(self):
+        """Over, and the result has been up long enough - or nobody is left"""
+        if all(self.gone):
+            return True
+        return self.finished_at is not None and time.monotonic() - self.finished_at > RESULT_TIME
+
+    def broadcast(self, message, reliable=True):
+        for peer, gone in zip(self.peers, self.gone):
+            if not gone:
+                peer.send(message, reliable)
+
+    def hit(self, attacker, defender, damage):
+        killed = defender.health <= 0
+        self.broadcast({'t': 'hit', 'attacker': self.match.player_index(attacker),
+                        'damage': damage, 'killed': int(killed)})
+
+    def gem_changed(self, gem):
+        self.broadcast({'t': 'gem', 'gem': self.gem_indices[gem], 'collected': int(gem.collected)})
+
+    def send_snapshots(self):
+        state = self.snapshots[0].capture(self.match)
+        for i, peer in enumerate(self.peers):
+            if not self.gone[i]:
+                message = self.snapshots[i].snapshot(self.match, state)
+                peer.send({'t': 'snap', 'n': self.inputs[i].applied, **message}, reliable=False)
+
+    def tick(self, due):
+        """One scheduler tick - due is the loop time it was scheduled for"""
+        start = time.monotonic()
+        match = self.match
+        for i, peer in enumerate(self.peers):
+            if self.gone[i]:
+                continue
+            if not peer.maintain():
+                # Leaving forfeits the match
+                self.gone[i] = True
+                print(f"Match {self.number}: player {i + 1} left")
+                if not match.over:
+                    (match.player1, match.player2)[i].health = 0
+                continue
+            for message in peer.receive():
+                if message.get('t') == 'in':
+                    self.snapshots[i].ack(message['k'])
+                    self.inputs[i].add(message)
+
+        if not match.over:
+            match.step(self.inputs[0].next(), self.inputs[1].next())
+            if match.over:
+                self.finished_at = time.monotonic()
+                winner = match.winner
+                print(f"Match {self.number} over after {match.tick / SIM_HZ:.0f}s - "
+                      f"{winner.name if winner else 'nobody'} won")
+                self.send_snapshots()
+            elif (match.tick + self.snapshot_offset) % net.SNAPSHOT_INTERVAL == 0:
+                self.send_snapshots()
+        else:
+            # The final snapshot goes unreliably - repeat it while the result is up
+            self.result_ticks += 1
+            if self.result_ticks % net.SNAPSHOT_INTERVAL == 0:
+                self.send_snapshots()
+
+        end = time.monotonic()
+        self.tick_times.append(end - start)
+        self.latencies.append(end - due)
+
+
+class MatchServer:
+    """Queues players, pairs them into matches and ticks every match from one scheduler"""
+    def __init__(self, weapon_mode='any', seed=None, report_interval=REPORT_INTERVAL):
+        self.weapon_mode = weapon_mode
+        self.rng = random.Random(seed)  # Match seeds and loadouts
+        self.report_interval = report_interval
+        self.waiting = deque()  # Peers without a match, first come first served
+        self.matches = []
+        self.matches_started = 0
+        self.udp_peers = {}  # Address -> UdpTransport, so datagrams find their peer
+        self.lateness = deque(maxlen=SIM_HZ * report_interval)  # How late each scheduler tick started
+        self.saturated = 0  # Times the scheduler gave up catching up since the last report
+
+    def join(self, peer, addr):
+        print(f"Player joined from {addr} over {peer.name.upper()}")
+        self.waiting.append(peer)
+
+    def forget(self, peer):
+        self.udp_peers = {addr: p for addr, p in self.udp_peers.items() if p is not peer}
+        peer.close()
+
+    def start_match(self, peers):
+        weapons = weapons_for(self.weapon_mode)
+        armors = list(ARMOR_TYPES)
+        loadouts = (self.rng.choice(weapons), self.rng.choice(armors),
+                    self.rng.choice(weapons), self.rng.choice(armors))
+        self.matches_started += 1
+        match = ServerMatch(self.matches_started, peers, self.rng.getrandbits(32), self.weapon_mode,
+                            loadouts, SIM_HZ * self.report_interval)
+        self.matches.append(match)
+
+    def tick(self, due):
+        # Anyone who left while waiting is dropped; the rest are paired in order
+        for peer in [peer for peer in self.waiting if not peer.maintain()]:
+            self.waiting.remove(peer)
+            self.forget(peer)
+        while len(self.waiting) >= 2:
+            self.start_match([self.waiting.popleft(), self.waiting.popleft()])
+
+        for match in self.matches:
+            try:
+                match.tick(due)
+            except Exception as e:
+                # One broken match mustn't take every other one down with it
+                print(f"Match {match.number} stopped: {e}")
+                match.gone = [True, True]
+
+        for match in [match for match in self.matches if match.done]:
+            self.matches.remove(match)
+            for peer, gone in zip(match.peers, match.gone):
+                if gone:
+                    self.forget(peer)
+                else:
+                    self.waiting.append(peer)
+
+    def report(self):
+        players = sum(2 - sum(match.gone) for match in self.matches)
+        line = f"{len(self.matches)} matches, {players} players, {len(self.waiting)} waiting"
+        if self.lateness:
+            p50, p99, worst = percentiles(self.lateness)
+            line += f" | scheduler late p50 {p50:.2f} ms p99 {p99:.2f} ms max {worst:.2f} ms"
+        if self.saturated:
+            line += f" | SATURATED {self.saturated}x"
+            self.saturated = 0
+        print(line)
+
+        timed = [match for match in self.matches if match.latencies]
+        if not timed:
+            return
+        all_times = [t for match in timed for t in match.tick_times]
+        p50, p99, worst = percentiles(all_times)
+        print(f"  all matches     tick p50 {p50:.3f} ms p99 {p99:.3f} ms max {worst:.3f} ms")
+        # Latency counts from when the tick was due, so it includes waiting for the matches before it
+        stats = sorted(((percentiles(match.latencies), percentiles(match.tick_times), match) for match in timed),
+                       key=lambda entry: entry[0][1], reverse=True)
+        for (lat50, lat99, lat_max), (t50, t99, _), match in stats[:REPORT_MATCHES]:
+            print(f"  match {match.number:<6} tick {match.match.tick:>6}  latency p50 {lat50:.2f} ms "
+                  f"p99 {lat99:.2f} ms max {lat_max:.2f} ms  |  own time p50 {t50:.3f} ms p99 {t99:.3f} ms")
+
+    async def serve(self, port=NET_PORT, host='0.0.0.0'):
+        loop = asyncio.get_running_loop()
+        udp, _ = await loop.create_datagram_endpoint(lambda: DatagramEndpoint(self), local_addr=(host, port))
+
+        async def accept(reader, writer):
+            self.join(net.StreamPeer(reader, writer), writer.get_extra_info('peername'))
+
+        tcp = await asyncio.start_server(accept, host, port)
+        print(f"Serving on port {port} (UDP and TCP), weapon mode '{self.weapon_mode}'")
+        try:
+            await self.run()
+        finally:
+            tcp.close()
+            udp.close()
+
+    async def run(self):
+        """The scheduler - one tick of every match each SIM_DT"""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        next_report = next_tick + self.report_interval
+        while True:
+            now = loop.time()
+            if now < next_tick:
+                await asyncio.sleep(next_tick - now)
+                continue
+            self.lateness.append(now - next_tick)
+            self.tick(next_tick)
+            next_tick += SIM_DT
+            if loop.time() - next_tick > SIM_DT * MAX_CATCHUP_STEPS:
+                next_tick = loop.time()  # Too far behind to catch up - run slow instead
+                if not self.saturated:
+                    print(f"Server saturated: {len(self.matches)} matches need more than one core "
+                          f"at {SIM_HZ} ticks per second - every match is running slow")
+                self.saturated += 1
+            if now >= next_report:
+                self.report()
+                next_report = now + self.report_interval
+            await asyncio.sleep(0)  # Let datagrams and connections in even when behind
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dedicated server for PvP Battle Arena online matches")
+    parser.add_argument('--port', type=int, default=NET_PORT, help="UDP and TCP port to listen on")
+    parser.add_argument('--weapon-mode', default='any', choices=['any', 'melee_only', 'ranged_only'],
+                        help="weapons handed out at random from this set")
+    parser.add_argument('--seed', type=int, default=None, help="seed for match seeds and loadouts")
+    parser.add_argument('--report', type=int, default=REPORT_INTERVAL,
+                        help="seconds between tick latency reports")
+    args = parser.parse_args()
+
+    server = MatchServer(args.weapon_mode, args.seed, args.report)
+    try:
+        asyncio.run(server.serve(args.port))
+    except KeyboardInterrupt:
+        print("Server stopped")
+
+
+if __name__ == '__main__':
+    main()